@@ -0,0 +1,307 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import hashlib
+import os
+import posixpath
+import sys
+import tarfile
+import zipfile
+from datetime import datetime
+
+# The checksum folder and extension used for each algorithm
+STORE_LAYOUT = {"md5": ("bm11-md5sums", ".md5", "MD5"), "sha1": ("bm11-sha1sums", ".sha1", "SHA-1")}
+
+def archive_members(archive_path):
+
+    """
+    Yield the regular file and hardlink members of a tar or zip archive one at a time, without extracting them.
+    Tar archives, including compressed ones, are read as a stream from start to end, so they can
+    also come from standard input or a tape. Zip archives need a seekable file.
+    A tar hardlink holds no data of its own and its target cannot be read again from a stream, so it is
+    yielded with the name of the earlier member it links to instead of a file object.
+    :param archive_path: The path of the archive, or "-" to read a tar stream from standard input
+    :return: A generator of (member name, file object, link target name) tuples. The file object is None for a
+    hardlink and the link target name is None otherwise. Each file object is only valid until the next member.
+    """
+
+    if archive_path != "-" and zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zip_archive:
+            for member in zip_archive.infolist():
+                if member.is_dir():
+                    continue
+                with zip_archive.open(member) as member_file:
+                    yield member.filename, member_file, None
+        return
+    if archive_path == "-":
+        tar_archive = tarfile.open(fileobj=sys.stdin.buffer, mode="r|*")
+    else:
+        tar_archive = tarfile.open(archive_path, mode="r|*")
+    with tar_archive:
+        for member in tar_archive:
+            if member.islnk():
+                yield member.name, None, member.linkname
+            elif member.isfile():
+                yield member.name, tar_archive.extractfile(member), None
+
+def member_relative_path(archive_name, member_name):
+
+    """
+    Build the virtual path a member's checksums are stored under.
+    :param archive_name: The path of the archive relative to the base directory
+    :param member_name: The name of the member inside the archive
+    :return: The virtual relative path, or None if the member name would escape the archive's folder
+    """
+
+    member_name = posixpath.normpath(member_name.lstrip("/"))
+    if member_name == "." or member_name == ".." or member_name.startswith("../"):
+        return None
+    return os.path.join(archive_name + bmc.ARCHIVE_MEMBERS_SUFFIX, *member_name.split("/"))
+
+def hash_member(member_file, algorithms, cancel_token=None):
+
+    """
+    Calculate the checksums of an archive member from its data stream.
+    :param member_file: The file object of the member
+    :param algorithms: List of hashing algorithms to use ("md5" and/or "sha1")
+    :param cancel_token: An optional CancellationToken checked between read chunks
+    :return: A dictionary mapping each algorithm to its checksum
+    """
+
+    file_hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    while True:
+        bmc.check_cancelled(cancel_token)
+        file_chunk = member_file.read(bmc.READ_CHUNK_SIZE)
+        if not file_chunk:
+            break
+        for file_hash in file_hashes:
+            file_hash.update(file_chunk)
+    return dict(zip(algorithms, [file_hash.hexdigest() for file_hash in file_hashes]))
+
+def linked_member_checksums(absolute_path, archive_name, link_name, algorithms):
+
+    """
+    Look up the checksums of a hardlink member from the stored checksums of the member it links to.
+    The target always comes earlier in a tar archive, so by the time the link is reached its checksums
+    have already been stored by a checksum run or checked against its data by a verification.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param archive_name: The path of the archive relative to the base directory
+    :param link_name: The name of the member the hardlink points to
+    :param algorithms: List of hashing algorithms to look up ("md5" and/or "sha1")
+    :return: A dictionary mapping each algorithm to its checksum, or None if the target has no stored checksums
+    """
+
+    target_path = member_relative_path(archive_name, link_name)
+    if target_path is None:
+        return None
+    member_checksums = {}
+    for algorithm in algorithms:
+        folder, extension, name = STORE_LAYOUT[algorithm]
+        try:
+            with open(os.path.join(absolute_path, folder, target_path + extension), "r") as checksum_file:
+                member_checksums[algorithm] = checksum_file.read().rstrip()
+        except FileNotFoundError:
+            return None
+    return member_checksums
+
+def resolve_archive_name(absolute_path, archive_path, archive_name):
+
+    """
+    :param absolute_path: The absolute base path
+    :param archive_path: The archive as given by the user, or "-" for standard input
+    :param archive_name: The path of the archive relative to the base directory, needed when reading standard input
+    :return: The archive's path relative to the base directory, or None if it is outside it
+    """
+
+    if archive_name is None:
+        if archive_path == "-":
+            return None
+        archive_name = os.path.relpath(os.path.abspath(archive_path), absolute_path)
+    archive_name = os.path.normpath(archive_name)
+    if archive_name.startswith(os.pardir) or os.path.isabs(archive_name):
+        return None
+    return archive_name
+
+def start_archive_checksum_process(absolute_path, archive_path, mode, message_destination=print, archive_name=None, cancel_token=None):
+
+    """
+    Calculate and store checksums for every member of a tar or zip archive, reading the members
+    straight from the archive instead of extracting them. Member checksums are stored under the
+    archive's path followed by ARCHIVE_MEMBERS_SUFFIX in the checksum folders. Existing checksums
+    are not replaced.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param archive_path: The archive to read, or "-" for a tar stream on standard input
+    :param mode: The checksums to create, as used by start_checksum_process
+    :param message_destination: The function to call to output the message
+    :param archive_name: Where the archive lives relative to the base directory. Required for standard input.
+    :param cancel_token: An optional CancellationToken that stops the operation between read chunks
+    :return: The number of members checksummed, or None if the operation failed
+    """
+
+    try:
+        archive_name = resolve_archive_name(absolute_path, archive_path, archive_name)
+        if archive_name is None:
+            bmc.output_message("The archive must be inside the base directory, or be named with --archive-name when read from standard input. Aborting...\n", message_destination)
+            return None
+        algorithms = []
+        if mode == 0 or mode == 1:
+            algorithms.append("md5")
+        if mode == 0 or mode == 2:
+            algorithms.append("sha1")
+        start_date = datetime.now()
+        bmc.output_message("Calculating checksums for the members of " + archive_name + "...", message_destination)
+        members_processed = 0
+        members_skipped = 0
+        cancelled = False
+        try:
+            for member_name, member_file, link_name in archive_members(archive_path):
+                relative_path = member_relative_path(archive_name, member_name)
+                if relative_path is None:
+                    bmc.output_message("* Skipped member outside the archive root: " + member_name, message_destination)
+                    members_skipped += 1
+                    continue
+                missing_algorithms = [algorithm for algorithm in algorithms
+                    if not os.path.exists(os.path.join(absolute_path, STORE_LAYOUT[algorithm][0], relative_path + STORE_LAYOUT[algorithm][1]))]
+                if len(missing_algorithms) == 0:
+                    continue
+                if link_name is not None:
+                    try:
+                        member_checksums = linked_member_checksums(absolute_path, archive_name, link_name, missing_algorithms)
+                    except OSError:
+                        member_checksums = None
+                    if member_checksums is None:
+                        bmc.output_message("* Skipped hardlink member whose target has no stored checksums: " + member_name, message_destination)
+                        members_skipped += 1
+                        continue
+                else:
+                    member_checksums = hash_member(member_file, missing_algorithms, cancel_token)
+                for algorithm, checksum in member_checksums.items():
+                    folder, extension, name = STORE_LAYOUT[algorithm]
+                    checksum_path = os.path.join(absolute_path, folder, relative_path + extension)
+                    os.makedirs(os.path.dirname(checksum_path), exist_ok=True)
+                    bmc.write_checksum_file(checksum_path, checksum)
+                members_processed += 1
+        except bmc.OperationCancelled:
+            cancelled = True
+        time_elapsed = datetime.now() - start_date
+        bmc.output_message("\nArchive checksum calculation " + ("cancelled" if cancelled else "complete") + ". " + str(members_processed) + " member(s) checksummed. Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        if members_skipped > 0:
+            bmc.output_message(str(members_skipped) + " member(s) skipped.\n", message_destination)
+        return members_processed
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as error:
+        bmc.output_message("* Could not read the archive " + str(archive_path) + " (" + str(error) + ")\n", message_destination)
+        return None
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
+
+def start_archive_verification_process(absolute_path, archive_path, message_destination=print, archive_name=None, cancel_token=None):
+
+    """
+    Verify every member of a tar or zip archive against the stored member checksums, reading the
+    members straight from the archive stream. Stored member checksums for members no longer in the
+    archive are reported once the whole archive has been read.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param archive_path: The archive to read, or "-" for a tar stream on standard input
+    :param message_destination: The function to call to output the message
+    :param archive_name: Where the archive lives relative to the base directory. Required for standard input.
+    :param cancel_token: An optional CancellationToken that stops the operation between read chunks
+    :return: The number of errors found, or None if the verification failed
+    """
+
+    try:
+        archive_name = resolve_archive_name(absolute_path, archive_path, archive_name)
+        if archive_name is None:
+            bmc.output_message("The archive must be inside the base directory, or be named with --archive-name when read from standard input. Aborting...\n", message_destination)
+            return None
+        algorithms = [algorithm for algorithm in ("md5", "sha1") if os.path.isdir(os.path.join(absolute_path, STORE_LAYOUT[algorithm][0], archive_name + bmc.ARCHIVE_MEMBERS_SUFFIX))]
+        if len(algorithms) == 0:
+            bmc.output_message("No member checksums could be found for " + archive_name + ". Aborting...\n", message_destination)
+            return None
+        start_date = datetime.now()
+        bmc.output_message("Verifying the members of " + archive_name + "...\n", message_destination)
+        members_processed = 0
+        checksums_processed = dict.fromkeys(algorithms, 0)
+        errors_found = 0
+        cancelled = False
+        members_seen = set()
+        try:
+            for member_name, member_file, link_name in archive_members(archive_path):
+                relative_path = member_relative_path(archive_name, member_name)
+                if relative_path is None:
+                    continue
+                members_seen.add(relative_path)
+                if link_name is not None:
+                    try:
+                        member_checksums = linked_member_checksums(absolute_path, archive_name, link_name, algorithms)
+                    except OSError as error:
+                        bmc.output_message("* Could not read the stored checksums of the target of hardlink member: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                        errors_found += 1
+                        continue
+                    if member_checksums is None:
+                        bmc.output_message("* Could not verify hardlink member, its target has no stored checksums: " + relative_path, message_destination)
+                        errors_found += 1
+                        continue
+                else:
+                    member_checksums = hash_member(member_file, algorithms, cancel_token)
+                members_processed += 1
+                for algorithm, checksum in member_checksums.items():
+                    folder, extension, name = STORE_LAYOUT[algorithm]
+                    checksum_path = os.path.join(absolute_path, folder, relative_path + extension)
+                    try:
+                        with open(checksum_path, "r") as checksum_file:
+                            stored_checksum = checksum_file.read().rstrip()
+                    except FileNotFoundError:
+                        bmc.output_message("* " + name + " checksum is missing for member: " + relative_path, message_destination)
+                        errors_found += 1
+                        continue
+                    except OSError as error:
+                        # A damaged checksum store is not a problem with the archive, so carry on with the next member
+                        bmc.output_message("* Could not read the stored " + name + " checksum of member: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                        errors_found += 1
+                        continue
+                    checksums_processed[algorithm] += 1
+                    if checksum != stored_checksum:
+                        bmc.output_message("* Member does not match " + name + " checksum: " + relative_path, message_destination)
+                        errors_found += 1
+            # Only look for removed members once the whole archive has been read
+            for algorithm in algorithms:
+                folder, extension, name = STORE_LAYOUT[algorithm]
+                members_folder = os.path.join(absolute_path, folder, archive_name + bmc.ARCHIVE_MEMBERS_SUFFIX)
+                for root, dirs, files in os.walk(members_folder):
+                    for file in files:
+                        if not file.endswith(extension):
+                            continue
+                        relative_path = os.path.relpath(os.path.join(root, file), os.path.join(absolute_path, folder))[:-len(extension)]
+                        if relative_path not in members_seen:
+                            bmc.output_message("* " + name + " checksum available for missing member: " + relative_path, message_destination)
+                            errors_found += 1
+        except bmc.OperationCancelled:
+            cancelled = True
+        time_elapsed = datetime.now() - start_date
+        bmc.output_message(("\n" if errors_found > 0 else "") + "Archive verification " + ("cancelled" if cancelled else "complete") + ". Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        bmc.output_message("Members processed: " + str(members_processed), message_destination)
+        bmc.output_message("MD5 checksums processed: " + str(checksums_processed.get("md5", 0)), message_destination)
+        bmc.output_message("SHA-1 checksums processed: " + str(checksums_processed.get("sha1", 0)), message_destination)
+        bmc.output_message("Errors found: " + str(errors_found) + "\n", message_destination)
+        return errors_found
+    except (OSError, tarfile.TarError, zipfile.BadZipFile) as error:
+        bmc.output_message("* Could not read the archive " + str(archive_path) + " (" + str(error) + ")\n", message_destination)
+        return None
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
@@ -0,0 +1,218 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import os
+import sys
+import threading
+from datetime import datetime
+
+# The commands that can be given for each base directory in a batch, and the checksum mode used to create
+BATCH_COMMANDS = {"-c": 0, "-cm": 1, "-cs": 2, "-v": None}
+
+# The default number of base directories processed at the same time across all devices
+DEFAULT_BATCH_WORKERS = 4
+
+class BatchJob:
+
+    """
+    One base directory of a batch along with the command to run on it and, once finished, its result.
+    """
+
+    def __init__(self, command, base_directory):
+
+        """
+        Create a job that has not run yet.
+        :param command: One of the commands in BATCH_COMMANDS
+        :param base_directory: The base directory as given in the batch list
+        """
+
+        self.command = command
+        self.base_directory = base_directory
+        self.absolute_path = os.path.abspath(base_directory)
+        try:
+            self.device = os.stat(self.absolute_path).st_dev
+        except OSError:
+            # The job fails when it runs, so the device only needs to be unique
+            self.device = None
+        self.messages = []
+        self.result = None
+        self.started = False
+        self.time_elapsed = None
+
+def parse_batch_entry(entry):
+
+    """
+    Read one entry of a batch list. An entry is a command followed by a space and a base directory,
+    or just a base directory, which is verified.
+    :param entry: The entry text
+    :return: A BatchJob, or None for a blank entry
+    """
+
+    entry = entry.strip("\r\n")
+    if entry.strip() == "":
+        return None
+    command, separator, base_directory = entry.partition(" ")
+    if separator and command in BATCH_COMMANDS:
+        return BatchJob(command, base_directory)
+    return BatchJob("-v", entry)
+
+def read_batch_list(list_path):
+
+    """
+    Read the jobs of a batch. A list file holds one entry per line. When list_path is "-",
+    entries are read from standard input separated by NUL characters, as written by find -print0,
+    so base directories may contain any character.
+    :param list_path: The path of the list file, or "-" for standard input
+    :return: A list of BatchJob objects in the order given
+    """
+
+    if list_path == "-":
+        entries = sys.stdin.buffer.read().split(b"\0")
+        entries = [os.fsdecode(entry) for entry in entries]
+    else:
+        with open(list_path, "r") as list_file:
+            entries = list_file.read().split("\n")
+    return [job for job in (parse_batch_entry(entry) for entry in entries) if job is not None]
+
+def start_batch_process(jobs, message_destination=print, worker_count=DEFAULT_BATCH_WORKERS, device_limit=1, profiler=None, tracer=None, cancel_token=None, read_ahead=0, cache_mode="normal", file_order="walk", hardlinks=True):
+
+    """
+    Run the jobs of a batch on one shared pool of worker threads and output a combined summary.
+    At most worker_count base directories are processed at once, and at most device_limit of them
+    on any one device, so separate disks are read in parallel without several jobs seeking on the
+    same disk. Jobs start in list order as soon as their device has a free slot. The messages of
+    each job are held until it finishes and are then output together, so jobs never interleave.
+    :param jobs: The list of BatchJob objects to run
+    :param message_destination: The function to call to output the message
+    :param worker_count: The maximum number of jobs running at once
+    :param device_limit: The maximum number of jobs running at once on a single device
+    :param profiler: An optional OperationProfiler shared by every job
+    :param tracer: An optional TraceWriter shared by every job
+    :param cancel_token: An optional CancellationToken that stops running jobs and skips the rest
+    :param read_ahead: The read_ahead setting passed to each job
+    :param cache_mode: The cache_mode setting passed to each job
+    :param file_order: The file_order setting passed to each job
+    :param hardlinks: The hardlinks setting passed to each job
+    """
+
+    try:
+        start_date = datetime.now()
+        bmc.output_message("Running " + str(len(jobs)) + " base directories on " + str(worker_count) + " worker(s), " + str(device_limit) + " per device...\n", message_destination)
+        pending_jobs = list(jobs)
+        running_per_device = {}
+        schedule_condition = threading.Condition()
+        output_lock = threading.Lock()
+
+        def take_next_job():
+            # Wait for the first pending job whose device has a free slot. None means there is no work left.
+            with schedule_condition:
+                while True:
+                    if len(pending_jobs) == 0 or bmc.is_cancelled(cancel_token):
+                        return None
+                    for job in pending_jobs:
+                        if running_per_device.get(job.device, 0) < device_limit:
+                            pending_jobs.remove(job)
+                            running_per_device[job.device] = running_per_device.get(job.device, 0) + 1
+                            return job
+                    # Wake up now and then so a cancel is noticed even while every device is busy
+                    schedule_condition.wait(1.0)
+
+        def run_jobs():
+            while True:
+                job = take_next_job()
+                if job is None:
+                    return
+                try:
+                    run_batch_job(job, profiler, tracer, cancel_token, read_ahead, cache_mode, file_order, hardlinks)
+                finally:
+                    with schedule_condition:
+                        running_per_device[job.device] -= 1
+                        schedule_condition.notify_all()
+                with output_lock:
+                    bmc.output_message("=== " + job.command + " " + job.base_directory + " ===\n", message_destination)
+                    for message in job.messages:
+                        bmc.output_message(message, message_destination)
+
+        workers = [threading.Thread(target=run_jobs, name="bmchecksum-batch-" + str(index), daemon=True) for index in range(max(1, min(worker_count, len(jobs))))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            # Join with a timeout so Ctrl-C still reaches the main thread
+            while worker.is_alive():
+                worker.join(0.5)
+
+        output_batch_summary(jobs, datetime.now() - start_date, message_destination)
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
+
+def run_batch_job(job, profiler, tracer, cancel_token, read_ahead, cache_mode, file_order, hardlinks):
+
+    """
+    Run a single job of a batch on the calling thread, keeping its messages in the job.
+    :param job: The BatchJob to run
+    The other parameters are as described in start_batch_process.
+    """
+
+    job.started = True
+    start_date = datetime.now()
+    if not os.path.isdir(job.absolute_path):
+        job.messages.append("* The base directory does not exist: " + job.base_directory + "\n")
+    elif BATCH_COMMANDS[job.command] is None:
+        job.result = bmc.start_verification_process(job.absolute_path, False, job.messages.append, profiler, tracer, None, cancel_token, read_ahead, cache_mode, file_order, hardlinks)
+    else:
+        job.result = bmc.start_checksum_process(job.absolute_path, BATCH_COMMANDS[job.command], job.messages.append, profiler, tracer, None, cancel_token, read_ahead, cache_mode, file_order, hardlinks)
+    job.time_elapsed = datetime.now() - start_date
+
+def output_batch_summary(jobs, time_elapsed, message_destination=print):
+
+    """
+    Output one line per job followed by the totals of the whole batch.
+    :param jobs: The list of BatchJob objects that were run
+    :param time_elapsed: The time the whole batch took
+    :param message_destination: The function to call to output the message
+    """
+
+    bmc.output_message("=== Batch summary ===\n", message_destination)
+    files_checksummed = 0
+    errors_found = 0
+    failed_jobs = 0
+    skipped_jobs = 0
+    for job in jobs:
+        if not job.started:
+            skipped_jobs += 1
+            outcome = "not started"
+        elif job.result is None:
+            failed_jobs += 1
+            outcome = "FAILED"
+        elif BATCH_COMMANDS[job.command] is None:
+            errors_found += job.result
+            outcome = str(job.result) + " error(s) found"
+        else:
+            files_checksummed += job.result
+            outcome = str(job.result) + " file(s) checksummed"
+        if job.time_elapsed is not None:
+            outcome += " in " + bmc.return_human_readable_time_elapsed(job.time_elapsed)
+        bmc.output_message(("* " if job.result is None or (BATCH_COMMANDS[job.command] is None and job.result > 0) else "  ") + job.command + " " + job.base_directory + ": " + outcome, message_destination)
+    bmc.output_message("\nBase directories: " + str(len(jobs)), message_destination)
+    bmc.output_message("Failed: " + str(failed_jobs), message_destination)
+    if skipped_jobs > 0:
+        bmc.output_message("Not started: " + str(skipped_jobs), message_destination)
+    bmc.output_message("Files checksummed: " + str(files_checksummed), message_destination)
+    bmc.output_message("Verification errors found: " + str(errors_found), message_destination)
+    bmc.output_message("Batch took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
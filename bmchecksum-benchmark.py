@@ -0,0 +1,210 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+def help():
+
+    """
+    Outputs help information to the user if asked for or if invalid arguments are given
+    """
+
+    print("General usage:")
+    print("\nbmchecksum-benchmark <benchmark> [options] <base directory>")
+    print("\nBenchmarks:")
+    print("\n-o = Compare hashing throughput for each file ordering (walk, inode and extent)")
+    print("-s = Measure files per second for creating and verifying checksums of many small files,")
+    print("     with and without the small file path")
+    print("\nOptions:")
+    print("\n--repeat=N = Run each case N times and report the best run (default 1)")
+    print("--files=N = The number of small files -s creates (default 50000)")
+    print("--size=N = The size in bytes of each small file -s creates (default 2048)")
+    print("\nWith -o, files are only read, never modified. Between runs the files are dropped from the page cache")
+    print("with posix_fadvise where the platform allows it, so each run reads from the disk.")
+    print("With -s, the small files are written to a temporary folder inside the base directory, so they are")
+    print("on the same disk, and removed afterwards. They stay in the page cache, which leaves the per file cost.\n")
+
+def evict_from_page_cache(file_paths):
+
+    """
+    Ask the kernel to drop the cached pages of every file so the next run reads from the disk
+    :param file_paths: The files to evict
+    :return: False if the platform cannot evict files from the page cache
+    """
+
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    for file_path in file_paths:
+        try:
+            file_descriptor = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fdatasync(file_descriptor)
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(file_descriptor)
+    return True
+
+def time_hashing(file_paths, file_order):
+
+    """
+    Order the files and hash them with both algorithms, as the -c and -v commands do
+    :param file_paths: The files from the directory walk
+    :param file_order: The order passed to order_file_list
+    :return: The seconds spent ordering, the seconds spent hashing and the bytes hashed
+    """
+
+    order_start = time.perf_counter()
+    ordered_paths = bmc.order_file_list(file_paths, file_order)
+    hash_start = time.perf_counter()
+    for file_path in ordered_paths:
+        bmc.calculate_checksums(file_path, ["md5", "sha1"])
+    hash_end = time.perf_counter()
+    bytes_hashed = sum(os.path.getsize(file_path) for file_path in ordered_paths)
+    return hash_start - order_start, hash_end - hash_start, bytes_hashed
+
+def benchmark_file_orders(absolute_path, repeat):
+
+    """
+    Compare the throughput of hashing in walk, inode and physical extent order
+    :param absolute_path: The absolute base path to benchmark
+    :param repeat: The number of runs per order
+    """
+
+    file_paths = bmc.create_file_list(absolute_path)
+    print("Benchmarking " + str(len(file_paths)) + " files in " + absolute_path + "\n")
+    if not evict_from_page_cache(file_paths):
+        print("Warning: this platform cannot drop files from the page cache, so later runs may be served from memory.\n")
+    walk_rate = None
+    print("Order".ljust(8) + "Sort (s)".rjust(10) + "Hash (s)".rjust(10) + "MB/s".rjust(10) + "vs walk".rjust(10))
+    for file_order in ("walk", "inode", "extent"):
+        best_run = None
+        for _ in range(repeat):
+            evict_from_page_cache(file_paths)
+            run = time_hashing(file_paths, file_order)
+            if best_run is None or run[0] + run[1] < best_run[0] + best_run[1]:
+                best_run = run
+        order_seconds, hash_seconds, bytes_hashed = best_run
+        rate = bytes_hashed / 1048576 / (order_seconds + hash_seconds) if order_seconds + hash_seconds > 0 else 0.0
+        if walk_rate is None:
+            walk_rate = rate
+        comparison = format(rate / walk_rate, ".2f") + "x" if walk_rate > 0 else "-"
+        print(file_order.ljust(8) + format(order_seconds, "10.2f") + format(hash_seconds, "10.2f") + format(rate, "10.1f") + comparison.rjust(10))
+    print("\nMB/s includes the time spent sorting the file list.\n")
+
+def create_small_files(absolute_path, file_count, file_size):
+
+    """
+    Write a tree of small files of random data, a hundred to each directory
+    :param absolute_path: The directory to create the files in
+    :param file_count: The number of files to create
+    :param file_size: The size of each file in bytes
+    """
+
+    for file_number in range(file_count):
+        directory_path = os.path.join(absolute_path, "d" + str(file_number // 100))
+        if file_number % 100 == 0:
+            os.makedirs(directory_path)
+        with open(os.path.join(directory_path, "f" + str(file_number)), "wb") as small_file:
+            small_file.write(os.urandom(file_size))
+
+def time_small_files(absolute_path):
+
+    """
+    Create checksums for a tree and verify them, as the -c and -v commands do
+    :param absolute_path: The tree of small files
+    :return: The seconds spent creating and the seconds spent verifying
+    """
+
+    for folder in ("bm11-md5sums", "bm11-sha1sums"):
+        shutil.rmtree(os.path.join(absolute_path, folder), ignore_errors=True)
+    quiet = lambda message: None
+    create_start = time.perf_counter()
+    bmc.start_checksum_process(absolute_path, 0, quiet)
+    verify_start = time.perf_counter()
+    bmc.start_verification_process(absolute_path, True, quiet)
+    return verify_start - create_start, time.perf_counter() - verify_start
+
+def benchmark_small_files(absolute_path, repeat, file_count, file_size):
+
+    """
+    Compare files per second for many small files with the small file path on and off
+    :param absolute_path: The absolute base path to create the temporary tree in
+    :param repeat: The number of runs per case
+    :param file_count: The number of files to create
+    :param file_size: The size of each file in bytes
+    """
+
+    tree_path = tempfile.mkdtemp(prefix="bmchecksum-small-files-", dir=absolute_path)
+    small_file_limit = bmc.SMALL_FILE_LIMIT
+    try:
+        print("Creating " + str(file_count) + " files of " + str(file_size) + " bytes in " + tree_path + "\n")
+        create_small_files(tree_path, file_count, file_size)
+        print("Small files".ljust(14) + "Create (s)".rjust(12) + "files/s".rjust(10) + "Verify (s)".rjust(12) + "files/s".rjust(10))
+        for case_name, case_limit in (("on", max(small_file_limit, file_size)), ("off", 0)):
+            bmc.SMALL_FILE_LIMIT = case_limit
+            best_create = None
+            best_verify = None
+            for _ in range(repeat):
+                create_seconds, verify_seconds = time_small_files(tree_path)
+                best_create = create_seconds if best_create is None else min(best_create, create_seconds)
+                best_verify = verify_seconds if best_verify is None else min(best_verify, verify_seconds)
+            print(case_name.ljust(14) + format(best_create, "12.2f") + format(file_count / best_create if best_create > 0 else 0.0, "10.0f")
+                + format(best_verify, "12.2f") + format(file_count / best_verify if best_verify > 0 else 0.0, "10.0f"))
+        print("\nBoth MD5 and SHA-1 checksums are created and verified. The target is 50000 files/s on a local SSD.\n")
+    finally:
+        bmc.SMALL_FILE_LIMIT = small_file_limit
+        shutil.rmtree(tree_path, ignore_errors=True)
+
+def main():
+
+    """
+    The first function run upon program start to provide the benchmark interface
+    """
+
+    print("\nBMChecksum Benchmark\n")
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    options = dict(argument[2:].partition("=")[::2] for argument in sys.argv[1:] if argument.startswith("--"))
+    if len(arguments) != 2 or not os.path.isdir(arguments[1]):
+        help()
+        sys.exit(1)
+    benchmark, base_directory = arguments
+    repeat = int(options.get("repeat") or 1)
+    if benchmark == "-o":
+        benchmark_file_orders(os.path.abspath(base_directory), repeat)
+    elif benchmark == "-s":
+        benchmark_small_files(os.path.abspath(base_directory), repeat, int(options.get("files") or 50000), int(options.get("size") or 2048))
+    else:
+        help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+
+    """
+    Runs the main function if this code is being run directly.
+    """
+
+    main()
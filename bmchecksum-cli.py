@@ -16,10 +16,29 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import archives
+import batch
+import copier
 import core as bmc
+import daemon
+import history
+import manifests
+import metrics
+import replicas
+import scrubber
+import session
+import watcher
+import cProfile
+import json
+import signal
 import sys
 import os
 
+# Options that must be given a file name with =
+VALUE_OPTIONS = ("trace", "profile-stats", "report", "state", "archive-name", "socket", "metrics")
+# Numeric options with their type and smallest allowed value. --read-ahead on its own means its default
+NUMBER_OPTIONS = {"read-ahead": (int, 0), "profile-top": (int, 1), "workers": (int, 1), "per-device": (int, 1), "cache-size": (int, 0), "settle": (float, 0), "rescan-interval": (float, 0.1)}
+
 def help():
     
     """
@@ -27,15 +46,175 @@ def help():
     """
     
     print("General usage:")
-    print("\nbmchecksum <command> <base directory>")
+    print("\nbmchecksum <command> [options] <base directory>")
     print("\nCommands:")
     print("\n-c = Create all checksums for all subdirectories in the base directory")
     print("-cm = Create only MD5 checksums for all subdirectories in the base directory")
     print("-cs = Create only SHA-1 checksums for all subdirectories in the base directory")
     print("-v = Verify file checksums in all subdirectories based on those found in the base directory")
     print("-s = Verify file checksums in all direct subdirectories found in the base directory")
+    print("-ca <base directory> <archive> = Create checksums for the members of a tar or zip archive without extracting it (- reads a tar stream from standard input)")
+    print("-va <base directory> <archive> = Verify the members of a tar or zip archive against their stored checksums (- reads a tar stream from standard input)")
+    print("-cp <base directory> <destination> = Copy the base directory to the destination, creating the destination's checksums from the same reads")
+    print("-vr <base directory> <replica directory> = Compare a replica with the base directory, reading both at the same time")
     print("-u = Upgrade checksums from checksum version 1.0 to the latest version (1.1)")
-    print("-h = Help\n")
+    print("-r = Rolling scrub: verify the files that have gone longest without verification, within a time or size budget")
+    print("-i <base directory> <manifests> = Import digests from md5sum or sha1sum manifests (either format, - for standard input) without reading any files")
+    print("-e <base directory> <manifest> = Export the stored checksums as a manifest that md5sum -c or sha1sum -c can check")
+    print("-w = Watch the base directory and add all checksums for new files as they are written")
+    print("-m <report files> = Merge the reports of a sharded verification and print the combined results")
+    print("-hr = Report devices whose read throughput or tail latency has worsened, from the history kept with --history")
+    print("-d = Run as a daemon answering verify and create requests over a Unix socket, keeping digests in memory between requests")
+    print("-dr <method> [<base directory> [<file>]] = Send a request to a running daemon (verify, verify_file, verify_subdirectories,")
+    print("     create, status, ping or shutdown) and print its JSON result")
+    print("-b <list file> = Run many base directories in one batch. Each line holds a command (-c, -cm, -cs or -v) and a base directory,")
+    print("     or just a base directory to verify. Use - to read NUL-separated entries from standard input (find -print0)")
+    print("-h = Help")
+    print("\nOptions:")
+    print("\n--read-ahead[=N] = Open and read upcoming files on N background threads while hashing (default 2), for network or high-latency storage")
+    print("--scrub = Read files without pushing other data out of the page cache (posix_fadvise hints)")
+    print("--direct-io = Read files with O_DIRECT, bypassing the page cache entirely where the file system allows it")
+    print("--order=walk|inode|extent = Hash files in directory walk order (default), inode order or physical disk order to reduce seeking")
+    print("--no-hardlinks = Read every hardlink separately instead of reading each linked file once")
+    print("--shard=I/N = With -c, -cm, -cs or -v, only process shard I (from 0) of N, so N processes or machines can share the work")
+    print("--incremental = With -c, -cm or -cs, only list directories changed since the last incremental run, recording them")
+    print("     for the next one. With -v, only verify the files of directories changed since the last incremental checksum run")
+    print("--full-walk = With --incremental, list every directory this time, for example after restoring files with their old times")
+    print("--report=FILE = With -v, save the results to FILE so the reports of every shard can be merged with -m")
+    print("--time-budget=DURATION = With -r, stop starting new files after DURATION, for example 90m or 2h")
+    print("--byte-budget=SIZE = With -r, stop starting new files after reading SIZE, for example 500G")
+    print("--state=FILE = With -r, keep the verification times in FILE instead of the base directory")
+    print("--archive-name=PATH = With -ca or -va, where the archive lives relative to the base directory, needed when reading standard input")
+    print("--verify-copy = With -cp, read every copy back from the disk and check it")
+    print("--check-stored = With -vr, also check the files of each side against that side's stored checksums")
+    print("--algorithm=md5|sha1 = With -e, the checksums to export (default md5)")
+    print("--tag = With -e, write the BSD tag format instead of the default md5sum format")
+    print("--replace = With -i, replace stored checksums that differ from the manifest instead of keeping them")
+    print("--workers=N = With -b, the number of base directories processed at once (default 4). With -d, the number of files hashed at once")
+    print("--per-device=N = With -b, the number of base directories processed at once on the same device (default 1)")
+    print("--history[=FILE] = With -v, -s or -r, append the read throughput and latency of each device to FILE")
+    print("     (default ~/.local/share/bmchecksum/history.jsonl). With -hr, the history to report on")
+    print("--metrics=PATH = With -c, -cm, -cs, -v, -s, -u or -r, write Prometheus metrics to PATH (a .prom file, or a directory")
+    print("     such as the node exporter's textfile directory) every minute while running and when finished")
+    print("--socket=PATH = With -d or -dr, the daemon's Unix socket (default $XDG_RUNTIME_DIR/bmchecksum.sock)")
+    print("--cache-size=N = With -d, the number of file digests kept in memory (default 100000)")
+    print("--trust-cache = With -dr, reuse digests the daemon already holds for files unchanged since it last read them, instead of")
+    print("     reading every file. This only catches changes made through the file system, not data decaying on the disk")
+    print("--profile = Print a breakdown of where the operation spent its time")
+    print("--profile-top=N = Number of slowest files to list in the profile (default 10)")
+    print("--profile-stats=FILE = Also write cProfile statistics for the operation to FILE")
+    print("--settle=SECONDS = With -w, how long a file must be left unchanged before it is checksummed (default 5)")
+    print("--rescan-interval=SECONDS = With -w, also rescan the whole base directory for new files this often")
+    print("--trace=FILE = Write a Chrome trace-event timeline of the operation to FILE (view in Perfetto or chrome://tracing)\n")
+
+def split_arguments(arguments):
+
+    """
+    Separate --name and --name=value options from the positional command-line arguments
+    :param arguments: The command-line arguments without the program name
+    :return: A list of positional arguments and a dictionary of options
+    """
+
+    positional = []
+    options = {}
+    for argument in arguments:
+        if argument.startswith("--"):
+            name, separator, value = argument[2:].partition("=")
+            options[name] = value if separator else True
+        else:
+            positional.append(argument)
+    return positional, options
+
+def enclosed_cancel_handler(cancel_token):
+
+    """
+    Creates a Ctrl-C handler that asks the running operation to stop cleanly. A second
+    Ctrl-C falls back to the normal immediate interrupt.
+    :param cancel_token: The CancellationToken passed to the operation
+    :return: The signal handler
+    """
+
+    def cancel_handler(signal_number, frame):
+        if cancel_token.is_cancelled():
+            raise KeyboardInterrupt
+        cancel_token.cancel()
+        print("\nCancelling after the current file... Press Ctrl-C again to stop immediately.")
+
+    return cancel_handler
+
+def run_command(command, base_directory, absolute_path, profiler, tracer, cancel_token, options, extra_arguments=()):
+
+    """
+    Run the core operation matching the command
+    :param command: The command-line command given
+    :param base_directory: The base directory as given by the user
+    :param absolute_path: The absolute path of the base directory
+    :param profiler: An optional OperationProfiler to pass to the operation
+    :param tracer: An optional TraceWriter to pass to the operation
+    :param cancel_token: The CancellationToken to pass to the operation
+    :param options: The dictionary of command-line options
+    :param extra_arguments: Any positional arguments given after the base directory
+    :return: False if the command was not recognised
+    """
+
+    read_ahead = 0
+    if options.get("read-ahead") is True:
+        read_ahead = 2
+    elif "read-ahead" in options:
+        read_ahead = int(options["read-ahead"])
+    cache_mode = "normal"
+    if "direct-io" in options:
+        cache_mode = "direct"
+    elif "scrub" in options:
+        cache_mode = "scrub"
+    file_order = options.get("order", "walk")
+    hardlinks = "no-hardlinks" not in options
+    shard = bmc.parse_shard(options["shard"]) if "shard" in options else None
+    incremental = "incremental" in options
+    full_walk = "full-walk" in options
+
+    if command == "-c":
+        bmc.start_checksum_process(absolute_path, 0, profiler=profiler, tracer=tracer, cancel_token=cancel_token, read_ahead=read_ahead, cache_mode=cache_mode, file_order=file_order, hardlinks=hardlinks, shard=shard, incremental=incremental, full_walk=full_walk)
+    elif command == "-cm":
+        bmc.start_checksum_process(absolute_path, 1, profiler=profiler, tracer=tracer, cancel_token=cancel_token, read_ahead=read_ahead, cache_mode=cache_mode, file_order=file_order, hardlinks=hardlinks, shard=shard, incremental=incremental, full_walk=full_walk)
+    elif command == "-cs":
+        bmc.start_checksum_process(absolute_path, 2, profiler=profiler, tracer=tracer, cancel_token=cancel_token, read_ahead=read_ahead, cache_mode=cache_mode, file_order=file_order, hardlinks=hardlinks, shard=shard, incremental=incremental, full_walk=full_walk)
+    elif command == "-v":
+        report = bmc.VerificationReport(absolute_path, shard) if "report" in options else None
+        bmc.start_verification_process(absolute_path, False, profiler=profiler, tracer=tracer, cancel_token=cancel_token, read_ahead=read_ahead, cache_mode=cache_mode, file_order=file_order, hardlinks=hardlinks, shard=shard, report=report, incremental=incremental)
+        if report is not None:
+            report.save(options["report"])
+            print("Verification report written to " + options["report"] + "\n")
+    elif command == "-u":
+        bmc.start_upgrade_process(base_directory, profiler=profiler, tracer=tracer, cancel_token=cancel_token)
+    elif command == "-s":
+        bmc.verify_all_checksums_in_all_direct_subdirectories(base_directory, profiler=profiler, tracer=tracer, cancel_token=cancel_token, read_ahead=read_ahead, cache_mode=cache_mode, file_order=file_order, hardlinks=hardlinks)
+    elif command == "-b":
+        jobs = batch.read_batch_list(base_directory)
+        batch.start_batch_process(jobs, worker_count=int(options.get("workers", batch.DEFAULT_BATCH_WORKERS)), device_limit=int(options.get("per-device", 1)), profiler=profiler, tracer=tracer, cancel_token=cancel_token, read_ahead=read_ahead, cache_mode=cache_mode, file_order=file_order, hardlinks=hardlinks)
+    elif command == "-r":
+        time_budget = scrubber.parse_duration(options["time-budget"]) if "time-budget" in options else None
+        byte_budget = scrubber.parse_byte_count(options["byte-budget"]) if "byte-budget" in options else None
+        # A rolling scrub always keeps its reads out of the page cache
+        scrubber.start_scrub_process(absolute_path, time_budget=time_budget, byte_budget=byte_budget, state_path=options.get("state"), profiler=profiler, tracer=tracer, cancel_token=cancel_token, cache_mode="direct" if cache_mode == "direct" else "scrub")
+    elif command == "-ca":
+        archives.start_archive_checksum_process(absolute_path, extra_arguments[0], 0, archive_name=options.get("archive-name"), cancel_token=cancel_token)
+    elif command == "-va":
+        archives.start_archive_verification_process(absolute_path, extra_arguments[0], archive_name=options.get("archive-name"), cancel_token=cancel_token)
+    elif command == "-cp":
+        copier.start_copy_process(absolute_path, os.path.abspath(extra_arguments[0]), 0, verify_copy="verify-copy" in options, cancel_token=cancel_token, cache_mode=cache_mode)
+    elif command == "-vr":
+        replicas.start_compare_process(absolute_path, os.path.abspath(extra_arguments[0]), check_stored="check-stored" in options, cancel_token=cancel_token, cache_mode=cache_mode)
+    elif command == "-i":
+        manifests.start_import_process(absolute_path, extra_arguments, replace="replace" in options, cancel_token=cancel_token)
+    elif command == "-e":
+        manifests.start_export_process(absolute_path, extra_arguments[0], options.get("algorithm", "md5"), tag_format="tag" in options, cancel_token=cancel_token)
+    elif command == "-w":
+        rescan_interval = float(options["rescan-interval"]) if "rescan-interval" in options else None
+        watcher.start_watch_process(absolute_path, 0, settle_time=float(options.get("settle", 5)), rescan_interval=rescan_interval, cancel_token=cancel_token)
+    else:
+        return False
+    return True
 
 def main():
     
@@ -49,11 +228,77 @@ def main():
     print("By Barrie Millar")
     print("A file hashing program to store and later verify the checksums of files\n")
 
-    if len(sys.argv) == 1:
+    arguments, options = split_arguments(sys.argv[1:])
+    for name in VALUE_OPTIONS:
+        if options.get(name) is True or options.get(name) == "":
+            print("The --" + name + " option needs a value, as in --" + name + "=FILE\n")
+            sys.exit(1)
+    for name, (number_type, minimum) in NUMBER_OPTIONS.items():
+        if name not in options or (name == "read-ahead" and options[name] is True):
+            continue
+        try:
+            if options[name] is True or number_type(options[name]) < minimum:
+                raise ValueError
+        except ValueError:
+            print("The --" + name + " option must be " + ("a whole number" if number_type is int else "a number") + " of at least " + str(minimum) + "\n")
+            sys.exit(1)
+    if "metrics" in options and not os.path.isdir(options["metrics"]) and not os.path.isdir(os.path.dirname(os.path.abspath(options["metrics"]))):
+        print("The --metrics option must name a directory, or a file in a directory that exists\n")
+        sys.exit(1)
+    if options.get("order", "walk") not in ("walk", "inode", "extent"):
+        print("The --order option must be walk, inode or extent\n")
+        sys.exit(1)
+    if "shard" in options:
+        try:
+            bmc.parse_shard(str(options["shard"]))
+        except ValueError as error:
+            print("The --shard option is invalid: " + str(error) + "\n")
+            sys.exit(1)
+        if arguments[:1] not in (["-c"], ["-cm"], ["-cs"], ["-v"]):
+            print("The --shard option can only be used with -c, -cm, -cs and -v\n")
+            sys.exit(1)
+
+    if len(arguments) == 0:
         help()
         sys.exit(1)
-    elif len(sys.argv) == 2:
-        command = sys.argv[1]
+    elif arguments[0] == "-hr":
+        history_path = options["history"] if isinstance(options.get("history"), str) else history.default_history_path()
+        if history.start_history_report(history_path) is None:
+            sys.exit(1)
+    elif arguments[0] == "-d":
+        cancel_token = bmc.CancellationToken()
+        signal.signal(signal.SIGINT, enclosed_cancel_handler(cancel_token))
+        signal.signal(signal.SIGTERM, enclosed_cancel_handler(cancel_token))
+        workers = int(options["workers"]) if "workers" in options else None
+        cache_size = int(options.get("cache-size", session.DEFAULT_CACHE_SIZE))
+        if daemon.start_daemon_process(options.get("socket"), workers=workers, cache_size=cache_size, cancel_token=cancel_token) is None:
+            sys.exit(1)
+    elif arguments[0] == "-dr":
+        if len(arguments) == 1:
+            print("Please provide the method to call\n")
+            sys.exit(1)
+        params = None
+        if len(arguments) > 2:
+            params = {"base_directory": os.path.abspath(arguments[2])}
+            if len(arguments) > 3:
+                params["file"] = arguments[3]
+            if "trust-cache" in options:
+                params["trust_cache"] = True
+        try:
+            result = daemon.request(arguments[1], params, options.get("socket"))
+        except daemon.DaemonError as error:
+            print("* " + str(error) + "\n")
+            sys.exit(1)
+        print(json.dumps(result, indent=2) + "\n")
+        if isinstance(result, dict) and result.get("ok") is False:
+            sys.exit(1)
+    elif arguments[0] == "-m":
+        if len(arguments) == 1:
+            print("Please provide the verification reports to merge\n")
+        elif bmc.merge_verification_reports(arguments[1:]) is None:
+            sys.exit(1)
+    elif len(arguments) == 1:
+        command = arguments[0]
         if command == "-c" or command == "-cm" or command == "-cs":
             print("Please provide a base directory name to calculate checksums on\n")
         elif command == "-v":
@@ -62,31 +307,89 @@ def main():
             print("Please provide a base directory name to upgrade checksums on\n")
         elif command == "-s":
             print("Please provide a base directory name to verify checksums in all direct subdirectories in\n")
+        elif command == "-r":
+            print("Please provide a base directory name to scrub\n")
+        elif command == "-w":
+            print("Please provide a base directory name to watch for new files\n")
+        elif command == "-i" or command == "-e":
+            print("Please provide a base directory name and a manifest file\n")
+        elif command == "-vr":
+            print("Please provide a base directory name and a replica directory name to compare\n")
+        elif command == "-cp":
+            print("Please provide a base directory name and a destination directory name to copy to\n")
+        elif command == "-ca" or command == "-va":
+            print("Please provide a base directory name and an archive\n")
+        elif command == "-b":
+            print("Please provide a batch list file, or - to read the list from standard input\n")
         else:
             help()
             sys.exit(1)
     else:
-        command = sys.argv[1]
-        base_directory = sys.argv[2]
-        if not os.path.exists(base_directory):
+        command = arguments[0]
+        base_directory = arguments[1]
+        if not os.path.exists(base_directory) and not (command == "-b" and base_directory == "-"):
             print("Please provide a valid base directory path\n")
+        elif command == "-vr" and (len(arguments) != 3 or not os.path.isdir(arguments[2])):
+            print("Please provide a valid replica directory path to compare with\n")
+        elif (command == "-ca" or command == "-va") and (len(arguments) != 3 or (arguments[2] != "-" and not os.path.isfile(arguments[2]))):
+            print("Please provide a valid archive path, or - to read a tar stream from standard input\n")
+        elif command == "-cp" and len(arguments) != 3:
+            print("Please provide a destination directory name to copy to\n")
+        elif (command == "-i" and len(arguments) < 3) or (command == "-e" and len(arguments) != 3):
+            print("Please provide a base directory name and a manifest file\n")
+        elif command == "-e" and options.get("algorithm", "md5") not in manifests.STORE_LAYOUT:
+            print("The --algorithm option must be md5 or sha1\n")
         else:
             absolute_path = os.path.abspath(base_directory)
-            if command == "-c":
-                bmc.start_checksum_process(absolute_path, 0)
-            elif command == "-cm":
-                bmc.start_checksum_process(absolute_path, 1)
-            elif command == "-cs":
-                bmc.start_checksum_process(absolute_path, 2)
-            elif command == "-v":
-                bmc.start_verification_process(absolute_path, False)
-            elif command == "-u":
-                bmc.start_upgrade_process(base_directory)
-            elif command == "-s":
-                bmc.verify_all_checksums_in_all_direct_subdirectories(base_directory)
-            else:
+            profiler = None
+            if "profile" in options or "profile-top" in options or "profile-stats" in options:
+                profiler = bmc.OperationProfiler(int(options.get("profile-top", 10)))
+            tracer = None
+            if "trace" in options:
+                tracer = bmc.TraceWriter()
+            operation = {"-c": "create", "-cm": "create", "-cs": "create", "-v": "verify", "-s": "verify-subdirectories", "-u": "upgrade", "-r": "scrub"}.get(command)
+            recorder = None
+            if "history" in options and command in ("-v", "-s", "-r"):
+                recorder = history.ThroughputRecorder(absolute_path, operation)
+            metrics_writer = None
+            if "metrics" in options and operation is not None:
+                metrics_writer = metrics.MetricsWriter(options["metrics"], absolute_path, operation)
+                if metrics_writer.failed:
+                    # The reason has been printed, and a run whose metrics cannot be written should not start unnoticed
+                    sys.exit(1)
+            # The recorder and metrics writer are passed in place of the profiler, alongside it if profiling was asked for too
+            profiler_monitor = bmc.combine_monitors(profiler, recorder, metrics_writer)
+            cancel_token = bmc.CancellationToken()
+            signal.signal(signal.SIGINT, enclosed_cancel_handler(cancel_token))
+            metrics_written = False
+            try:
+                if "profile-stats" in options:
+                    # Collect function level statistics alongside the phase breakdown
+                    function_profiler = cProfile.Profile()
+                    command_found = function_profiler.runcall(run_command, command, base_directory, absolute_path, profiler_monitor, tracer, cancel_token, options, arguments[2:])
+                    function_profiler.dump_stats(options["profile-stats"])
+                else:
+                    command_found = run_command(command, base_directory, absolute_path, profiler_monitor, tracer, cancel_token, options, arguments[2:])
+            finally:
+                # Written however the run ends, so the file never keeps showing a run that has stopped
+                if metrics_writer is not None:
+                    metrics_written = metrics_writer.write(cancelled=cancel_token.is_cancelled())
+            if not command_found:
                 help()
                 sys.exit(1)
+            if profiler is not None:
+                profiler.report()
+                if "profile-stats" in options:
+                    print("cProfile statistics written to " + options["profile-stats"] + "\n")
+            if tracer is not None:
+                tracer.write(options["trace"])
+                print("Trace timeline written to " + options["trace"] + "\n")
+            if metrics_written:
+                print("Metrics written to " + metrics_writer.metrics_path + "\n")
+            if recorder is not None:
+                history_path = options["history"] if isinstance(options["history"], str) else history.default_history_path()
+                if history.append_history(history_path, recorder):
+                    print("Read throughput history appended to " + history_path + "\n")
 
 if __name__ == "__main__":
     
@@ -18,18 +18,61 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import threading
+from collections import deque
+from datetime import datetime
 import core as bmc
 
 from kivy.app import App
 from kivy.uix.gridlayout import GridLayout
 from kivy.uix.button import Button
+from kivy.uix.checkbox import CheckBox
 from kivy.uix.textinput import TextInput
 from kivy.uix.label import Label
-from kivy.uix.scrollview import ScrollView
+from kivy.uix.progressbar import ProgressBar
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.tabbedpanel import TabbedPanel, TabbedPanelItem
 from kivy.clock import Clock
+from kivy.metrics import dp
 
 from plyer import filechooser
 
+# The number of most recent lines each output view keeps in memory
+OUTPUT_LINE_LIMIT = 5000
+# How often, in seconds, queued output is moved onto the screen
+OUTPUT_FLUSH_INTERVAL = 0.1
+
+class OutputLine(Label):
+    """
+    A single left-aligned line of output shown inside a RecycleView.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.halign = "left"
+        self.valign = "middle"
+        self.bind(size=self.update_text_size)
+
+    def update_text_size(self, instance, size):
+        """
+        Keeps the text wrapping area the same size as the line so the alignment applies.
+        :instance: The label being resized.
+        :size: The new size of the label.
+        """
+        self.text_size = size
+
+def create_output_view():
+    """
+    Creates a virtualised output view that only builds widgets for the visible lines.
+    :return: The RecycleView to fill with line data.
+    """
+    output_view = RecycleView()
+    output_view.viewclass = OutputLine
+    line_layout = RecycleBoxLayout(default_size=(None, dp(22)), default_size_hint=(1, None), size_hint_y=None, orientation="vertical")
+    line_layout.bind(minimum_height=line_layout.setter("height"))
+    output_view.add_widget(line_layout)
+    return output_view
+
 class BMChecksumGUI(App):
 
     def build(self):
@@ -44,10 +87,56 @@ class BMChecksumGUI(App):
 
         # Output display section
 
-        self.output_display = TextInput(readonly=True, size_hint=(1, 4))
-        self.scroll_container = ScrollView(size_hint=(1, 4))
-        self.scroll_container.add_widget(self.output_display)
-        self.layout.add_widget(self.scroll_container)
+        # Output is shown through virtualised views holding at most OUTPUT_LINE_LIMIT lines, so a
+        # verification reporting millions of lines never builds an ever-growing text block.
+        # Messages arrive from the worker thread into the bounded pending queues and are moved
+        # onto the screen in batches by flush_pending_output. Lines that overflow a pending
+        # queue are counted, and the views say how many were not displayed.
+
+        self.pending_output = deque(maxlen=OUTPUT_LINE_LIMIT)
+        self.pending_mismatches = deque(maxlen=OUTPUT_LINE_LIMIT)
+        self.pending_progress = None
+        # Only ever increased by the worker thread, and compared with the counts already reported by the main thread
+        self.output_dropped = 0
+        self.mismatches_dropped = 0
+        self.output_dropped_shown = 0
+        self.mismatches_dropped_shown = 0
+        self.clear_requested = False
+        self.lines_received = 0
+        self.mismatches_received = 0
+        self.spool_file = None
+        self.spool_path = None
+
+        output_tabs = TabbedPanel(do_default_tab=False, size_hint=(1, 4))
+        self.output_view = create_output_view()
+        self.output_tab = TabbedPanelItem(text="Output")
+        self.output_tab.add_widget(self.output_view)
+        output_tabs.add_widget(self.output_tab)
+        self.mismatch_view = create_output_view()
+        self.mismatch_tab = TabbedPanelItem(text="Problems")
+        self.mismatch_tab.add_widget(self.mismatch_view)
+        output_tabs.add_widget(self.mismatch_tab)
+        output_tabs.default_tab = self.output_tab
+        self.layout.add_widget(output_tabs)
+
+        # Progress section with the file count and an option to save the full output to disk
+
+        progress_layout = GridLayout(cols=5, height=30, size_hint_y=None)
+        self.progress_bar = ProgressBar(max=1, value=0, size_hint_x=6)
+        self.progress_label = Label(text="", size_hint_x=2)
+        self.spool_checkbox = CheckBox(size_hint_x=None, width=30)
+        progress_layout.add_widget(self.progress_bar)
+        progress_layout.add_widget(self.progress_label)
+        progress_layout.add_widget(self.spool_checkbox)
+        progress_layout.add_widget(Label(text="Save full log", size_hint_x=2))
+        # The cancel token is shared with the core functions, which stop between files and read chunks
+        self.cancel_token = bmc.CancellationToken()
+        self.cancel_button = Button(text="Cancel", size_hint_x=2, disabled=True)
+        self.cancel_button.bind(on_release=lambda _: self.cancel_token.cancel())
+        progress_layout.add_widget(self.cancel_button)
+        self.layout.add_widget(progress_layout)
+
+        Clock.schedule_interval(self.flush_pending_output, OUTPUT_FLUSH_INTERVAL)
 
         # Interface controls section with a documentation label, a row with directory entry and a buttons panel
 
@@ -97,13 +186,46 @@ class BMChecksumGUI(App):
         """
         Designed to allow a thread other than the main one to clear the output display.
         """
-        Clock.schedule_once(lambda dt: self.immediately_clear_output_display())
+        self.pending_output.clear()
+        self.pending_mismatches.clear()
+        self.pending_progress = None
+        # The views themselves are cleared on the main thread by the next flush
+        self.clear_requested = True
 
     def immediately_clear_output_display(self):
         """
         Immediately clears the output display.
         """
-        self.output_display.text = ""
+        self.output_dropped_shown = self.output_dropped
+        self.mismatches_dropped_shown = self.mismatches_dropped
+        self.lines_received = 0
+        self.mismatches_received = 0
+        self.output_view.data = []
+        self.mismatch_view.data = []
+        self.output_tab.text = "Output"
+        self.mismatch_tab.text = "Problems"
+        self.progress_bar.value = 0
+        self.progress_label.text = ""
+
+    def open_spool_file(self):
+        """
+        Opens a new log file in the application data directory if saving the full log was requested.
+        """
+        self.spool_path = None
+        if self.spool_checkbox.active:
+            spool_path = os.path.join(self.user_data_dir, "bmchecksum-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".log")
+            self.spool_file = open(spool_path, "w", encoding="utf-8")
+            # Kept once the file is closed, so notices about lines not displayed can still name it
+            self.spool_path = spool_path
+            self.update_output_display("Full output is being saved to " + spool_path + "\n")
+
+    def close_spool_file(self):
+        """
+        Closes the log file of the last operation if one was opened.
+        """
+        if self.spool_file is not None:
+            self.spool_file.close()
+            self.spool_file = None
 
     def start_operation(self, button_index):
         """
@@ -112,24 +234,30 @@ class BMChecksumGUI(App):
         """
         # Clear the output display
         self.clear_output_display()
+        self.open_spool_file()
 
         # Disable all buttons to prevent multiple clicks
         for button in self.button_layout.children:
             button.disabled = True
+        self.cancel_token.reset()
+        Clock.schedule_once(lambda dt: setattr(self.cancel_button, "disabled", False))
         
         # Start the appropriate thread based on the button index
         if button_index == 0:
-            bmc.start_checksum_process(self.dir_input.text, 0, self.update_output_display)
+            bmc.start_checksum_process(self.dir_input.text, 0, self.update_output_display, progress_destination=self.update_progress, cancel_token=self.cancel_token)
         elif button_index == 1:
-            bmc.start_checksum_process(self.dir_input.text, 1, self.update_output_display)
+            bmc.start_checksum_process(self.dir_input.text, 1, self.update_output_display, progress_destination=self.update_progress, cancel_token=self.cancel_token)
         elif button_index == 2:
-            bmc.start_checksum_process(self.dir_input.text, 2, self.update_output_display)
+            bmc.start_checksum_process(self.dir_input.text, 2, self.update_output_display, progress_destination=self.update_progress, cancel_token=self.cancel_token)
         elif button_index == 3:
-            bmc.start_verification_process(self.dir_input.text, False, self.update_output_display)
+            bmc.start_verification_process(self.dir_input.text, False, self.update_output_display, progress_destination=self.update_progress, cancel_token=self.cancel_token)
         elif button_index == 4:
-            bmc.verify_all_checksums_in_all_direct_subdirectories(self.dir_input.text, self.update_output_display)
+            bmc.verify_all_checksums_in_all_direct_subdirectories(self.dir_input.text, self.update_output_display, progress_destination=self.update_progress, cancel_token=self.cancel_token)
         elif button_index == 5:
-            bmc.start_upgrade_process(self.dir_input.text, self.update_output_display)
+            bmc.start_upgrade_process(self.dir_input.text, self.update_output_display, progress_destination=self.update_progress, cancel_token=self.cancel_token)
+
+        self.close_spool_file()
+        Clock.schedule_once(lambda dt: setattr(self.cancel_button, "disabled", True))
 
         # Re-enable buttons after the operation is complete
         for button in self.button_layout.children:
@@ -137,20 +265,84 @@ class BMChecksumGUI(App):
 
     def update_output_display(self, text):
         """
-        Designed to allow the core functionality thread to update the Kivy interface
-        :text: The text to append to output_display.
+        Designed to allow the core functionality thread to update the Kivy interface.
+        The text is only queued here. flush_pending_output shows it on the next clock tick.
+        :text: The text to append to the output views.
+        """
+        if self.spool_file is not None:
+            self.spool_file.write(text + "\n")
+        # A full queue drops its oldest line on append, which the next flush reports
+        if len(self.pending_output) == OUTPUT_LINE_LIMIT:
+            self.output_dropped += 1
+        self.pending_output.append(text)
+        # Problems reported by the core functions are prefixed with an asterisk
+        if text.startswith("*"):
+            if len(self.pending_mismatches) == OUTPUT_LINE_LIMIT:
+                self.mismatches_dropped += 1
+            self.pending_mismatches.append(text)
+
+    def update_progress(self, files_done, files_total):
+        """
+        Designed to allow the core functionality thread to report progress. Only the latest value is kept.
+        :files_done: The number of files processed so far.
+        :files_total: The number of files in the operation.
+        """
+        self.pending_progress = (files_done, files_total)
+
+    def flush_pending_output(self, dt):
+        """
+        Moves all queued output and the latest progress onto the screen in a single batch.
+        :dt: The time since the last flush.
         """
-        # Call the function that actually provides the display update code
-        Clock.schedule_once(lambda dt: self.immediately_update_display(text))
+        if self.clear_requested:
+            self.clear_requested = False
+            self.immediately_clear_output_display()
+        output_dropped = self.output_dropped
+        if self.pending_output or output_dropped != self.output_dropped_shown:
+            self.lines_received += self.move_pending_lines(self.pending_output, self.output_view, output_dropped - self.output_dropped_shown)
+            self.output_dropped_shown = output_dropped
+            self.output_tab.text = "Output (" + str(self.lines_received) + ")"
+        mismatches_dropped = self.mismatches_dropped
+        if self.pending_mismatches or mismatches_dropped != self.mismatches_dropped_shown:
+            self.mismatches_received += self.move_pending_lines(self.pending_mismatches, self.mismatch_view, mismatches_dropped - self.mismatches_dropped_shown)
+            self.mismatches_dropped_shown = mismatches_dropped
+            self.mismatch_tab.text = "Problems (" + str(self.mismatches_received) + ")"
+        progress = self.pending_progress
+        if progress is not None:
+            self.pending_progress = None
+            files_done, files_total = progress
+            self.progress_bar.max = max(files_total, 1)
+            self.progress_bar.value = files_done
+            self.progress_label.text = str(files_done) + " / " + str(files_total)
 
-    def immediately_update_display(self, text):
+    def move_pending_lines(self, pending_lines, output_view, dropped_lines):
         """
-        Immediately updates the display.
-        :text: The text to append.
+        Appends queued lines to a view, removing its oldest lines beyond OUTPUT_LINE_LIMIT.
+        Only the new lines are added, so the cost of a flush does not grow with the lines already shown.
+        :pending_lines: The queue filled by the worker thread.
+        :output_view: The RecycleView to add the lines to.
+        :dropped_lines: The number of lines that overflowed the queue since the last flush.
+        :return: The number of lines received, including the ones not displayed.
         """
-        self.output_display.text += text + "\n"
-        # Scroll to the top of the output display
-        self.scroll_container.scroll_y = 1
+        new_lines = []
+        if dropped_lines > 0:
+            # The queue drops its oldest lines, so the notice goes before the lines still queued
+            if self.spool_path is not None:
+                notice = str(dropped_lines) + " line(s) not displayed, see " + self.spool_path
+            else:
+                notice = str(dropped_lines) + " line(s) not displayed. Tick Save full log to keep the full output"
+            new_lines.append({"text": "... " + notice + " ..."})
+        lines_moved = dropped_lines
+        while pending_lines:
+            new_lines.extend({"text": line} for line in pending_lines.popleft().split("\n"))
+            lines_moved += 1
+        shown_lines = output_view.data
+        shown_lines.extend(new_lines)
+        if len(shown_lines) > OUTPUT_LINE_LIMIT:
+            del shown_lines[:len(shown_lines) - OUTPUT_LINE_LIMIT]
+        # Scroll to the newest output
+        output_view.scroll_y = 0
+        return lines_moved
     
     def check_directory_validity(self, directory, *args):
         """
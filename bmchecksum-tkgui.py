@@ -18,8 +18,15 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import core as bmc
 import tkinter as tk
-from tkinter import filedialog, scrolledtext
+from tkinter import filedialog, scrolledtext, ttk
 import os
+import queue
+import threading
+
+# How often, in milliseconds, the interface collects events from the worker thread
+EVENT_POLL_INTERVAL = 100
+# The maximum number of events handled per poll so the interface stays responsive during busy operations
+EVENT_BATCH_LIMIT = 5000
 
 def browse_directory(directory_textbox):
     """
@@ -35,23 +42,108 @@ def browse_directory(directory_textbox):
         directory_textbox.insert(0, checksum_directory)
 
 
-def enclosed_output_display(output_display):
+def enclosed_event_queue(event_queue, latest_progress):
     """
-    This function passes in the output_display variable to ensure any 
-    internal functions can access it. It has been done to avoid global
-    variable use
-    :param output_display: The scrolled text widget to display output
+    This function passes in the event_queue variable to ensure the callbacks
+    given to the core functions can access it. The callbacks run on the worker
+    thread, so they only queue events and never touch the Tkinter widgets.
+    :param event_queue: The queue shared with the interface thread
+    :param latest_progress: A one item list holding the latest progress, read by the interface thread
+    :return: The message callback and the progress callback
     """
 
     def update_output_display(message):
         """
-        Updates the output display with the given message.
+        Queues a message for the output display.
         :param message: The message to display in the output area
         """
-        output_display.insert(tk.END, message + "\n")
-        output_display.update_idletasks()  # Force the UI to update immediately
+        event_queue.put(("message", message))
+
+    def update_progress(files_done, files_total):
+        """
+        Stores the latest progress for the progress bar. Only the newest value is kept,
+        so progress never builds up in the queue however many files there are.
+        :param files_done: The number of files processed so far
+        :param files_total: The number of files in the operation
+        """
+        latest_progress[0] = (files_done, files_total)
+
+    return update_output_display, update_progress
 
-    return update_output_display
+def run_operation(button_index, directory_textbox, event_queue, latest_progress, cancel_token):
+    """
+    Runs the core operation for a button on the worker thread.
+    :param button_index: The index of the clicked button
+    :param directory_textbox: A string containing the directory path
+    :param event_queue: The queue used to send messages to the interface
+    :param latest_progress: A one item list the latest progress is stored in
+    :param cancel_token: The CancellationToken the Cancel button uses to stop the operation
+    """
+
+    update_output_display, update_progress = enclosed_event_queue(event_queue, latest_progress)
+    try:
+        if button_index == 0:
+            # Calculate all checksums
+            bmc.start_checksum_process(directory_textbox, 0, update_output_display, progress_destination=update_progress, cancel_token=cancel_token)
+        elif button_index == 1:
+            # Calculate MD5 checksums
+            bmc.start_checksum_process(directory_textbox, 1, update_output_display, progress_destination=update_progress, cancel_token=cancel_token)
+        elif button_index == 2:
+            # Calculate SHA-1 checksums
+            bmc.start_checksum_process(directory_textbox, 2, update_output_display, progress_destination=update_progress, cancel_token=cancel_token)
+        elif button_index == 3:
+            # Verify checksums
+            bmc.start_verification_process(directory_textbox, False, update_output_display, progress_destination=update_progress, cancel_token=cancel_token)
+        elif button_index == 4:
+            # Verify checksums in all direct subfolders
+            bmc.verify_all_checksums_in_all_direct_subdirectories(directory_textbox, update_output_display, progress_destination=update_progress, cancel_token=cancel_token)
+        elif button_index == 5:
+            # Upgrade legacy checksums
+            bmc.start_upgrade_process(directory_textbox, update_output_display, progress_destination=update_progress, cancel_token=cancel_token)
+    finally:
+        # Always tell the interface that the operation is over so the buttons come back
+        event_queue.put(("done", None))
+
+def drain_event_queue(event_queue, latest_progress, buttons, output_display, progress_bar, cancel_button):
+    """
+    Collects the queued worker events and applies them to the interface in one batch.
+    All messages collected are inserted with a single call and only the latest progress
+    is shown, so a busy operation costs one repaint per poll rather than one per line.
+    :param event_queue: The queue shared with the worker thread
+    :param latest_progress: A one item list holding the latest progress from the worker thread
+    :param buttons: A list of all buttons widgets
+    :param output_display: The text widget to display output
+    :param progress_bar: The progress bar widget
+    :param cancel_button: The button used to cancel the running operation
+    """
+
+    messages = []
+    finished = False
+    for _ in range(EVENT_BATCH_LIMIT):
+        try:
+            event_type, event_value = event_queue.get_nowait()
+        except queue.Empty:
+            break
+        if event_type == "message":
+            messages.append(event_value)
+        elif event_type == "done":
+            finished = True
+            break
+
+    if messages:
+        output_display.insert(tk.END, "\n".join(messages) + "\n")
+        output_display.see(tk.END)
+    # Read after the queue, so the final progress is shown once the worker reports that it is done
+    progress = latest_progress[0]
+    if progress is not None:
+        files_done, files_total = progress
+        progress_bar.config(maximum=max(files_total, 1), value=files_done)
+
+    if finished:
+        disable_interface_buttons(buttons, False)
+        disable_interface_buttons([cancel_button], True)
+    else:
+        output_display.after(EVENT_POLL_INTERVAL, drain_event_queue, event_queue, latest_progress, buttons, output_display, progress_bar, cancel_button)
 
 def validate_directory(directory_textbox, buttons):
     """
@@ -77,39 +169,30 @@ def disable_interface_buttons(buttons, state):
         else:
             button.config(state=tk.NORMAL)
 
-def handle_button_click(button_index, buttons, directory_textbox, output_display):
+def handle_button_click(button_index, buttons, directory_textbox, output_display, progress_bar, cancel_button, cancel_token):
     """
-    Handles the button click event and performs the corresponding action.
+    Handles the button click event by starting the corresponding action on a worker thread.
     :param button_index: The index of the clicked button
     :param buttons: A list of all buttons widgets
     :param directory_textbox: A string containing the directory path
     :param output_display: The passed text widget to display output
+    :param progress_bar: The progress bar widget
+    :param cancel_button: The button used to cancel the running operation
+    :param cancel_token: The CancellationToken shared with the cancel button
     """
     
-    # Clear the output display and disable buttons
-    output_display.delete(1.0, tk.END), 
+    # Clear the output display and progress bar and disable buttons
+    output_display.delete(1.0, tk.END)
+    progress_bar.config(value=0)
     disable_interface_buttons(buttons, True)
+    cancel_token.reset()
+    disable_interface_buttons([cancel_button], False)
 
-    if button_index == 0:
-        # Calculate all checksums
-        bmc.start_checksum_process(directory_textbox, 0, enclosed_output_display(output_display))
-    elif button_index == 1:
-        # Calculate MD5 checksums
-        bmc.start_checksum_process(directory_textbox, 1, enclosed_output_display(output_display))
-    elif button_index == 2:
-        # Calculate SHA-1 checksums
-        bmc.start_checksum_process(directory_textbox, 2, enclosed_output_display(output_display))
-    elif button_index == 3:
-        # Verify checksums
-        bmc.start_verification_process(directory_textbox, False, enclosed_output_display(output_display))
-    elif button_index == 4:
-        # Verify checksums in all direct subfolders
-        bmc.verify_all_checksums_in_all_direct_subdirectories(directory_textbox, enclosed_output_display(output_display))
-    elif button_index == 5:
-        # Upgrade legacy checksums
-        bmc.start_upgrade_process(directory_textbox, enclosed_output_display(output_display))
-
-    disable_interface_buttons(buttons, False)
+    # The buttons are re-enabled by drain_event_queue once the worker reports that it is done
+    event_queue = queue.Queue()
+    latest_progress = [None]
+    threading.Thread(target=run_operation, args=(button_index, directory_textbox, event_queue, latest_progress, cancel_token), daemon=True).start()
+    output_display.after(EVENT_POLL_INTERVAL, drain_event_queue, event_queue, latest_progress, buttons, output_display, progress_bar, cancel_button)
 
 def main():
     """
@@ -140,18 +223,28 @@ def main():
     
     output_display = scrolledtext.ScrolledText(main_window, wrap=tk.WORD)
     output_display.grid(row=0, column=0, rowspan=4, padx=5, pady=5, sticky=tk.NSEW)
+
+    # Progress bar showing the files processed by the running operation
+
+    progress_frame = tk.Frame(main_window)
+    progress_frame.grid(row=4, column=0, padx=5, pady=5, sticky=tk.EW)
+    progress_bar = ttk.Progressbar(progress_frame, orient=tk.HORIZONTAL, mode="determinate")
+    cancel_token = bmc.CancellationToken()
+    cancel_button = tk.Button(progress_frame, text="Cancel", command=cancel_token.cancel, state=tk.DISABLED)
+    cancel_button.pack(side=tk.RIGHT, padx=5)
+    progress_bar.pack(padx=5, fill=tk.X, expand=True)
     
     # Interface controls section with a documentation label, a row with directory entry and a buttons panel
 
     # Set label to wrap as needed based on window size.
     doc_display = tk.Label(main_window, text="Welcome to BMChecksum. Please select the required directory and then the calculate, verify or upgrade buttons to start.", wraplength=main_window.winfo_width() - 20, justify="center")
     main_window.bind("<Configure>", lambda event: doc_display.config(wraplength=event.width - 20))
-    doc_display.grid(row=4, column=0, padx=5, pady=5, sticky=tk.EW)    
+    doc_display.grid(row=5, column=0, padx=5, pady=5, sticky=tk.EW)    
 
     # Directory selection panel
 
     directory_frame = tk.Frame(main_window)
-    directory_frame.grid(row=5, column=0, padx=5, pady=5, sticky=tk.EW)
+    directory_frame.grid(row=6, column=0, padx=5, pady=5, sticky=tk.EW)
     tk.Label(directory_frame, text="Directory:").pack(side=tk.LEFT, padx=5, pady=5)
     directory_textbox = tk.Entry(directory_frame)
     tk.Button(directory_frame, text="Browse", command=lambda: browse_directory(directory_textbox)).pack(side=tk.RIGHT, padx=5, pady=5)
@@ -160,7 +253,7 @@ def main():
     # Button panel
 
     button_frame = tk.Frame(main_window)
-    button_frame.grid(row=6, column=0, rowspan=3, padx=5, pady=5, sticky=tk.NSEW)
+    button_frame.grid(row=7, column=0, rowspan=3, padx=5, pady=5, sticky=tk.NSEW)
     for cell in range(3):
         button_frame.grid_rowconfigure(cell, weight=1)
         if cell < 2:
@@ -177,7 +270,7 @@ def main():
 
     for index, button in enumerate(buttons):
         buttons[index].grid(row=index // 2, column=index % 2, padx=5, pady=5, sticky=tk.EW)
-        buttons[index].config(command=lambda idx=index: handle_button_click(idx, buttons, directory_textbox.get(), output_display))
+        buttons[index].config(command=lambda idx=index: handle_button_click(idx, buttons, directory_textbox.get(), output_display, progress_bar, cancel_button, cancel_token))
 
     # Disable buttons initially
     disable_interface_buttons(buttons, True)
@@ -0,0 +1,175 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import hashlib
+import os
+import shutil
+from datetime import datetime
+
+def copy_and_hash_file(source_file_path, destination_file_path, algorithms, cancel_token=None, cache_mode="normal"):
+
+    """
+    Copy a file while feeding every chunk read to the digest objects, so the data is read only once.
+    The copy is written to a temporary file that is renamed into place once complete, and the
+    source's timestamps and permissions are copied to it.
+    :param source_file_path: The file to copy
+    :param destination_file_path: Where to copy it to
+    :param algorithms: List of hashing algorithms to use ("md5" and/or "sha1")
+    :param cancel_token: An optional CancellationToken checked between read chunks
+    :param cache_mode: How the source is read with respect to the page cache, as described in core.read_file_chunks
+    :return: List of checksums in the same order as the algorithms
+    """
+
+    file_hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    temporary_path = destination_file_path + ".bmtmp"
+    try:
+        with open(temporary_path, "wb") as destination_file:
+            for file_chunk in bmc.read_file_chunks(source_file_path, cache_mode):
+                bmc.check_cancelled(cancel_token)
+                destination_file.write(file_chunk)
+                for file_hash in file_hashes:
+                    file_hash.update(file_chunk)
+            destination_file.flush()
+            os.fsync(destination_file.fileno())
+        shutil.copystat(source_file_path, temporary_path)
+        os.replace(temporary_path, destination_file_path)
+    except BaseException:
+        # Never leave a partial copy behind, whether the copy failed or was cancelled
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return [file_hash.hexdigest() for file_hash in file_hashes]
+
+def evict_file(file_path):
+
+    """
+    Drop a file that has just been written from the page cache, so reading it back comes from the disk.
+    :param file_path: The file to evict
+    """
+
+    if not hasattr(os, "posix_fadvise"):
+        return
+    file_descriptor = os.open(file_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(file_descriptor)
+
+def start_copy_process(source_path, destination_path, mode, message_destination=print, verify_copy=False, progress_destination=None, cancel_token=None, cache_mode="normal"):
+
+    """
+    Copy the files of a base directory into another directory, calculating their checksums from the
+    same reads and writing them to the destination's checksum folders as each file is copied, so
+    ingesting data reads it once instead of once to copy and once more for start_checksum_process.
+    Files and checksums that already exist at the destination are never replaced. Where the source has stored
+    checksums of its own, the data read is also checked against them.
+    :param source_path: The absolute base path to copy from
+    :param destination_path: The absolute base path to copy to, created if needed
+    :param mode: The checksums to write, as used by start_checksum_process
+    :param message_destination: The function to call to output the message
+    :param verify_copy: Whether to read every copy back from the disk and check it against the checksums of the source data
+    :param progress_destination: An optional function called with the files done and the total after each file
+    :param cancel_token: An optional CancellationToken that stops the copy between read chunks
+    :param cache_mode: How the source is read with respect to the page cache, as described in core.read_file_chunks
+    :return: The number of files copied, or None if the copy failed
+    """
+
+    try:
+        if destination_path == source_path or destination_path.startswith(os.path.join(source_path, "")):
+            bmc.output_message("The destination cannot be inside the directory being copied. Aborting...\n", message_destination)
+            return None
+        start_date = datetime.now()
+        algorithms = []
+        if mode == 0 or mode == 1:
+            algorithms.append("md5")
+        if mode == 0 or mode == 2:
+            algorithms.append("sha1")
+        bmc.output_message("Copying " + source_path + " to " + destination_path + " and calculating checksums...\n", message_destination)
+        file_paths = bmc.create_file_list(source_path)
+        files_copied = 0
+        bytes_copied = 0
+        files_existing = 0
+        problems_found = 0
+        cancelled = False
+        try:
+            for position, source_file_path in enumerate(file_paths):
+                bmc.check_cancelled(cancel_token)
+                relative_path = file_paths.relative_path(position)
+                destination_file_path = os.path.join(destination_path, relative_path)
+                if os.path.lexists(destination_file_path):
+                    files_existing += 1
+                    if progress_destination is not None:
+                        progress_destination(position + 1, len(file_paths))
+                    continue
+                try:
+                    os.makedirs(os.path.dirname(destination_file_path), exist_ok=True)
+                    checksums = copy_and_hash_file(source_file_path, destination_file_path, algorithms, cancel_token, cache_mode)
+                except OSError as error:
+                    bmc.output_message("* Could not copy file: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                    problems_found += 1
+                    continue
+                files_copied += 1
+                bytes_copied += os.path.getsize(destination_file_path)
+                file_checksums = dict(zip(algorithms, checksums))
+                for category, algorithm, problem in bmc.check_file_against_store(source_path, relative_path, {algorithm: checksum for algorithm, checksum in file_checksums.items()
+                        if os.path.isdir(os.path.join(source_path, "bm11-md5sums" if algorithm == "md5" else "bm11-sha1sums"))}):
+                    # A missing source checksum is expected for new data, but a mismatch means the source has changed or decayed
+                    if category == "missing_checksum":
+                        continue
+                    bmc.output_message(problem + " (source)", message_destination)
+                    problems_found += 1
+                if verify_copy:
+                    try:
+                        evict_file(destination_file_path)
+                        copy_checksums = bmc.calculate_checksums(destination_file_path, algorithms, cancel_token=cancel_token, cache_mode="scrub")
+                        if copy_checksums != checksums:
+                            bmc.output_message("* The copy does not match the data read from the source: " + relative_path, message_destination)
+                            problems_found += 1
+                    except OSError as error:
+                        bmc.output_message("* Could not read back the copy of file: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                        problems_found += 1
+                # The checksums of the source data are stored even if the read back failed, so a later verification flags the copy
+                try:
+                    written = bmc.write_missing_checksums(destination_path, relative_path, file_checksums)
+                except OSError as error:
+                    bmc.output_message("* Could not store the checksums of file: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                    problems_found += 1
+                    written = None
+                if written is not None and len(written) < len(file_checksums):
+                    # A checksum left at the destination without its file is kept, but it must describe the data copied
+                    kept_checksums = {algorithm: checksum for algorithm, checksum in file_checksums.items() if algorithm not in written}
+                    for category, algorithm, problem in bmc.check_file_against_store(destination_path, relative_path, kept_checksums):
+                        bmc.output_message(problem + " (existing destination checksum kept)", message_destination)
+                        problems_found += 1
+                if progress_destination is not None:
+                    progress_destination(position + 1, len(file_paths))
+        except bmc.OperationCancelled:
+            cancelled = True
+        time_elapsed = datetime.now() - start_date
+        if problems_found > 0:
+            bmc.output_message("", message_destination)
+        bmc.output_message("Copy " + ("cancelled" if cancelled else "complete") + ". " + str(files_copied) + " file(s) copied and checksummed (" + format(bytes_copied / 1048576, ".1f") + " MB). Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        if files_existing > 0:
+            bmc.output_message(str(files_existing) + " file(s) already existed at the destination and were left alone.", message_destination)
+        if verify_copy and files_copied > 0:
+            bmc.output_message("Each copy was read back from the disk and checked.", message_destination)
+        bmc.output_message("Problems found: " + str(problems_found) + "\n", message_destination)
+        return files_copied
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
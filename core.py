@@ -16,19 +16,522 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import errno
 import hashlib
+import heapq
+import json
+import mmap
 import os
+import queue
+import struct
+import threading
+import time
 import traceback
+import zlib
+from array import array
 from datetime import datetime
 
-def start_upgrade_process(base_directory, message_destination=print):
+# fcntl is only available on Unix-like systems and is only needed to order files by physical location
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The size of each read when hashing a file. Large reads keep the per-call overhead low, especially on network storage
+READ_CHUNK_SIZE = 1048576
+# How far ahead of the current read the kernel is asked to prefetch in scrub mode
+SCRUB_WINDOW = 8 * READ_CHUNK_SIZE
+# The number of chunks each read-ahead thread may hold before it waits for the hashing thread
+READ_AHEAD_DEPTH = 8
+
+# How many times a read that fails with a transient error is retried, and the delay before the first retry in seconds.
+# The delay doubles for every further retry.
+READ_RETRY_LIMIT = 3
+READ_RETRY_DELAY = 0.5
+# Errors that flaky disks and network storage can recover from, unlike missing files or denied permissions
+TRANSIENT_ERRORS = {errno.EIO, errno.EAGAIN, errno.EINTR, errno.ETIMEDOUT, errno.EBUSY, errno.ESTALE, errno.ECONNRESET, errno.EHOSTUNREACH}
+
+# The ioctl request that returns the extent map of a file on Linux, and the sizes of its structures
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct("QQIIII")
+FIEMAP_EXTENT = struct.Struct("QQQQQIIII")
+
+# The file in the base directory that records when each file was last verified by a rolling scrub
+SCRUB_STATE_NAME = "bm11-scrub-state.json"
+
+# The file in the base directory that records each directory's mtime and entry count for incremental runs
+DIRECTORY_STATE_NAME = "bm11-directory-state.json"
+# Files in the base directory starting with these names are never checksummed
+STATE_FILE_NAMES = (SCRUB_STATE_NAME, DIRECTORY_STATE_NAME)
+# Directories modified this close to the time they were last listed are listed again, as a change
+# made within the file system's timestamp granularity may not have moved the mtime
+DIRECTORY_MTIME_WINDOW = 2000000000
+
+# Appended to the path of a tar or zip archive to form the directory its members' checksums are stored under
+ARCHIVE_MEMBERS_SUFFIX = "#members"
+
+# Files up to this size in the walk are read with one os.read call by SmallFileHasher
+SMALL_FILE_LIMIT = 65536
+
+# The categories of problem passed to record_problem by the core functions: a file that does not
+# match its checksum, a file without a checksum, a checksum without a file, a file that could
+# not be read and stored checksums that could not be read or written
+PROBLEM_CATEGORIES = ("mismatch", "missing_checksum", "orphan_checksum", "unreadable", "store_error")
+
+# Upper bounds in microseconds of the buckets used for the read latency histogram
+READ_LATENCY_BUCKETS = [10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 500000]
+
+class OperationCancelled(Exception):
+
+    """
+    Raised inside a core operation when its cancellation token has been cancelled.
+    The core functions catch it themselves, so callers never see it.
+    """
+
+class CancellationToken:
+
+    """
+    A thread-safe flag that lets a user interface or signal handler stop a running core operation.
+    The operation checks the token between files and between read chunks and then reports
+    the statistics gathered so far.
+    """
+
+    def __init__(self):
+
+        """
+        Create a token that has not been cancelled.
+        """
+
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+
+        """
+        Request that the operation using this token stops as soon as possible.
+        """
+
+        self.cancel_event.set()
+
+    def reset(self):
+
+        """
+        Clear a previous cancellation so the token can be reused for another operation.
+        """
+
+        self.cancel_event.clear()
+
+    def is_cancelled(self):
+
+        """
+        :return: True if cancellation has been requested
+        """
+
+        return self.cancel_event.is_set()
+
+    def check(self):
+
+        """
+        Raise OperationCancelled if cancellation has been requested.
+        """
+
+        if self.cancel_event.is_set():
+            raise OperationCancelled()
+
+def is_cancelled(cancel_token):
+
+    """
+    Check an optional cancellation token.
+    :param cancel_token: A CancellationToken or None
+    :return: True if the token exists and has been cancelled
+    """
+
+    return cancel_token is not None and cancel_token.is_cancelled()
+
+def check_cancelled(cancel_token):
+
+    """
+    Raise OperationCancelled if an optional cancellation token has been cancelled.
+    :param cancel_token: A CancellationToken or None
+    """
+
+    if cancel_token is not None:
+        cancel_token.check()
+
+def wait_cancellable(cancel_token, seconds):
+
+    """
+    Sleep, waking early and raising OperationCancelled if the optional cancellation token is cancelled.
+    :param cancel_token: A CancellationToken or None
+    :param seconds: The time to wait
+    """
+
+    if cancel_token is None:
+        time.sleep(seconds)
+    else:
+        cancel_token.cancel_event.wait(seconds)
+        cancel_token.check()
+
+class OperationProfiler:
+
+    """
+    Collects per-phase timings for a checksum operation using the monotonic performance counter.
+    Phases reported by the core functions are walk, open, read, hash, store, makedirs, write, orphans, rename and retry.
+    The profiler is only consulted when passed to a core function, so unprofiled runs pay nothing for it.
+    """
+
+    def __init__(self, top_count=10):
+
+        """
+        Create an empty profiler.
+        :param top_count: The number of slowest files to keep for the report
+        """
+
+        self.top_count = top_count
+        self.phase_times = {}
+        self.phase_counts = {}
+        self.slowest_files = []
+        self.read_histogram = [0] * (len(READ_LATENCY_BUCKETS) + 1)
+        self.bytes_read = 0
+        self.files_profiled = 0
+        self.problem_counts = {}
+        self.first_time = None
+        self.last_time = None
+        self.lock = threading.Lock()
+
+    def record_phase(self, phase, start_time, end_time, file_path=None):
+
+        """
+        Add the time spent in one phase of the operation.
+        :param phase: The name of the phase
+        :param start_time: The performance counter value when the phase started
+        :param end_time: The performance counter value when the phase ended
+        :param file_path: The file the phase belongs to, if any
+        """
+
+        with self.lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + (end_time - start_time)
+            self.phase_counts[phase] = self.phase_counts.get(phase, 0) + 1
+            self.update_time_span(start_time, end_time)
+
+    def record_read(self, seconds, byte_count):
+
+        """
+        Add a single read call to the read latency histogram.
+        :param seconds: The time the read call took
+        :param byte_count: The number of bytes returned by the read call
+        """
+
+        microseconds = seconds * 1000000
+        bucket = 0
+        while bucket < len(READ_LATENCY_BUCKETS) and microseconds >= READ_LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            self.read_histogram[bucket] += 1
+            self.bytes_read += byte_count
+
+    def record_file(self, file_path, start_time, end_time):
+
+        """
+        Record the total time spent on one file, keeping only the slowest files.
+        :param file_path: The path of the file processed
+        :param start_time: The performance counter value when work on the file started
+        :param end_time: The performance counter value when work on the file ended
+        """
+
+        with self.lock:
+            self.files_profiled += 1
+            self.update_time_span(start_time, end_time)
+            entry = (end_time - start_time, file_path)
+            if len(self.slowest_files) < self.top_count:
+                heapq.heappush(self.slowest_files, entry)
+            elif entry > self.slowest_files[0]:
+                heapq.heapreplace(self.slowest_files, entry)
+
+    def record_directory(self, directory_path, start_time, end_time):
+
+        """
+        Accept the span covering a whole subdirectory verification. Its phases are already
+        counted individually, so the profiler does not add it to the breakdown.
+        :param directory_path: The subdirectory verified
+        :param start_time: The performance counter value when the subdirectory was started
+        :param end_time: The performance counter value when the subdirectory was finished
+        """
+
+        pass
+
+    def record_problem(self, category, file_path=None):
+
+        """
+        Count a problem found by the operation.
+        :param category: One of PROBLEM_CATEGORIES
+        :param file_path: The file the problem concerns, if any
+        """
+
+        with self.lock:
+            self.problem_counts[category] = self.problem_counts.get(category, 0) + 1
+
+    def update_time_span(self, start_time, end_time):
+
+        """
+        Widen the overall time span covered by the recorded events.
+        :param start_time: The start of the latest event
+        :param end_time: The end of the latest event
+        """
+
+        if self.first_time is None or start_time < self.first_time:
+            self.first_time = start_time
+        if self.last_time is None or end_time > self.last_time:
+            self.last_time = end_time
+
+    def report(self, message_destination=print):
+
+        """
+        Output the phase breakdown, the slowest files and the read latency histogram.
+        :param message_destination: The function to call to output the message
+        """
+
+        if self.first_time is None:
+            output_message("Profile: no activity was recorded.\n", message_destination)
+            return
+        wall_time = self.last_time - self.first_time
+        output_message("Profile of " + str(self.files_profiled) + " file(s) over " + format(wall_time, ".3f") + " seconds:\n", message_destination)
+        output_message("Phase breakdown:", message_destination)
+        for phase, seconds in sorted(self.phase_times.items(), key=lambda item: item[1], reverse=True):
+            share = (seconds / wall_time * 100) if wall_time > 0 else 0.0
+            output_message("  " + phase.ljust(10) + format(seconds, "10.3f") + "s " + format(share, "6.1f") + "%  (" + str(self.phase_counts[phase]) + " calls)", message_destination)
+        if self.problem_counts:
+            output_message("\nProblems: " + ", ".join(category.replace("_", " ") + " " + str(count) for category, count in sorted(self.problem_counts.items())), message_destination)
+        read_time = self.phase_times.get("read", 0.0)
+        if read_time > 0:
+            output_message("\nBytes read: " + str(self.bytes_read) + " (" + format(self.bytes_read / read_time / 1048576, ".1f") + " MB/s while reading)", message_destination)
+        if self.slowest_files:
+            output_message("\nSlowest files:", message_destination)
+            for seconds, file_path in sorted(self.slowest_files, reverse=True):
+                output_message("  " + format(seconds, "10.3f") + "s  " + file_path, message_destination)
+        total_reads = sum(self.read_histogram)
+        if total_reads > 0:
+            output_message("\nRead latency histogram:", message_destination)
+            for bucket, count in enumerate(self.read_histogram):
+                if bucket < len(READ_LATENCY_BUCKETS):
+                    label = "< " + format_microseconds(READ_LATENCY_BUCKETS[bucket])
+                else:
+                    label = ">= " + format_microseconds(READ_LATENCY_BUCKETS[-1])
+                bar = "#" * round(count / total_reads * 40)
+                output_message("  " + label.ljust(10) + str(count).rjust(10) + " " + bar, message_destination)
+        output_message("", message_destination)
+
+class TraceWriter:
+
+    """
+    Buffers per-file spans in memory and writes them out in the Chrome trace-event JSON format,
+    which can be loaded into Perfetto or chrome://tracing. Each thread doing work is shown as its own worker.
+    """
+
+    def __init__(self):
+
+        """
+        Create an empty trace buffer. Timestamps are relative to the moment the writer is created.
+        """
+
+        self.origin = time.perf_counter()
+        self.events = []
+        self.worker_ids = {}
+        self.lock = threading.Lock()
+
+    def worker_id(self):
+
+        """
+        Return a small, stable number for the thread that is currently running.
+        :return: The worker ID of the current thread
+        """
+
+        thread_ident = threading.get_ident()
+        worker = self.worker_ids.get(thread_ident)
+        if worker is None:
+            with self.lock:
+                worker = self.worker_ids.setdefault(thread_ident, (len(self.worker_ids), threading.current_thread().name))
+        return worker[0]
+
+    def record_phase(self, phase, start_time, end_time, file_path=None):
+
+        """
+        Buffer a span for one phase of the operation.
+        :param phase: The name of the phase
+        :param start_time: The performance counter value when the phase started
+        :param end_time: The performance counter value when the phase ended
+        :param file_path: The file the phase belongs to, if any
+        """
+
+        # list.append is atomic, so worker threads can buffer events without taking the lock
+        self.events.append((phase, start_time, end_time, self.worker_id(), file_path))
+
+    def record_read(self, seconds, byte_count):
+
+        """
+        Individual reads are not traced, as the read phase of each file already covers them.
+        :param seconds: The time the read call took
+        :param byte_count: The number of bytes returned by the read call
+        """
+
+        pass
+
+    def record_file(self, file_path, start_time, end_time):
+
+        """
+        Buffer a span covering all the work done for one file.
+        :param file_path: The path of the file processed
+        :param start_time: The performance counter value when work on the file started
+        :param end_time: The performance counter value when work on the file ended
+        """
+
+        self.events.append(("file", start_time, end_time, self.worker_id(), file_path))
+
+    def record_directory(self, directory_path, start_time, end_time):
+
+        """
+        Buffer a span covering the verification of one subdirectory.
+        :param directory_path: The subdirectory verified
+        :param start_time: The performance counter value when the subdirectory was started
+        :param end_time: The performance counter value when the subdirectory was finished
+        """
+
+        self.events.append(("directory", start_time, end_time, self.worker_id(), directory_path))
+
+    def record_problem(self, category, file_path=None):
+
+        """
+        Buffer a zero length span marking a problem, so it shows on the worker that found it.
+        :param category: One of PROBLEM_CATEGORIES
+        :param file_path: The file the problem concerns, if any
+        """
+
+        problem_time = time.perf_counter()
+        self.events.append((category, problem_time, problem_time, self.worker_id(), file_path))
+
+    def write(self, trace_path):
+
+        """
+        Write all buffered spans to a trace-event JSON file.
+        :param trace_path: The path of the file to write
+        """
+
+        process_id = os.getpid()
+        trace_events = []
+        for worker, thread_name in self.worker_ids.values():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": process_id, "tid": worker, "args": {"name": "Worker " + str(worker) + " (" + thread_name + ")"}})
+        for name, start_time, end_time, worker, file_path in self.events:
+            trace_event = {"name": name, "cat": "bmchecksum", "ph": "X", "pid": process_id, "tid": worker,
+                "ts": round((start_time - self.origin) * 1000000, 3), "dur": round((end_time - start_time) * 1000000, 3)}
+            if file_path is not None:
+                trace_event["args"] = {"path": file_path}
+            trace_events.append(trace_event)
+        with open(trace_path, "w") as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+class MonitorGroup:
+
+    """
+    Forwards every timing event to several monitors, such as a profiler and a trace writer together.
+    """
+
+    def __init__(self, monitors):
+
+        """
+        Create a group from a list of monitors.
+        :param monitors: The monitors to forward events to
+        """
+
+        self.monitors = monitors
+
+    def record_phase(self, phase, start_time, end_time, file_path=None):
+
+        """
+        Forward a phase span to every monitor in the group.
+        """
+
+        for monitor in self.monitors:
+            monitor.record_phase(phase, start_time, end_time, file_path)
+
+    def record_read(self, seconds, byte_count):
+
+        """
+        Forward a read latency to every monitor in the group.
+        """
+
+        for monitor in self.monitors:
+            monitor.record_read(seconds, byte_count)
+
+    def record_file(self, file_path, start_time, end_time):
+
+        """
+        Forward a per-file span to every monitor in the group.
+        """
+
+        for monitor in self.monitors:
+            monitor.record_file(file_path, start_time, end_time)
+
+    def record_directory(self, directory_path, start_time, end_time):
+
+        """
+        Forward a subdirectory span to every monitor in the group.
+        """
+
+        for monitor in self.monitors:
+            monitor.record_directory(directory_path, start_time, end_time)
+
+    def record_problem(self, category, file_path=None):
+
+        """
+        Forward a problem to every monitor in the group.
+        """
+
+        for monitor in self.monitors:
+            monitor.record_problem(category, file_path)
+
+def combine_monitors(*monitors):
+
+    """
+    Combine the monitors passed to a core function into the single object the hot paths check.
+    :param monitors: Any number of monitors, some of which may be None
+    :return: None if no monitors are active, the monitor itself if only one is, or a MonitorGroup
+    """
+
+    active_monitors = [monitor for monitor in monitors if monitor is not None]
+    if len(active_monitors) == 0:
+        return None
+    elif len(active_monitors) == 1:
+        return active_monitors[0]
+    return MonitorGroup(active_monitors)
+
+def format_microseconds(microseconds):
+
+    """
+    Format a microsecond value using the most readable unit.
+    :param microseconds: The number of microseconds
+    :return: A short string such as 50us, 5ms or 1s
+    """
+
+    if microseconds >= 1000000:
+        return str(microseconds // 1000000) + "s"
+    elif microseconds >= 1000:
+        return str(microseconds // 1000) + "ms"
+    return str(microseconds) + "us"
+
+def start_upgrade_process(base_directory, message_destination=print, profiler=None, tracer=None, progress_destination=None, cancel_token=None):
 
     """
     Upgrade version 1.0 checksums to version 1.1 if the older checksums are detected.
     :param base_directory: The base directory to walk through
     :param message_destination: The function to call to output the message
+    :param profiler: An optional OperationProfiler to record phase timings in
+    :param tracer: An optional TraceWriter to record per-file spans in
+    :param progress_destination: An optional function called with the files done and the total after each file
+    :param cancel_token: An optional CancellationToken checked before each checksum folder is upgraded.
+    Renames within a folder are quick and always completed so the folder is never left half upgraded.
     """
 
+    monitor = combine_monitors(profiler, tracer)
+
     # Ensure that any unknown errors are displayed to the user as part of the program execution
     try:
 
@@ -42,27 +545,36 @@ def start_upgrade_process(base_directory, message_destination=print):
             start_date = datetime.now()
             files_processed = 0
             # Check for existing MD5 current version checksum directories
-            if os.path.exists(os.path.join(base_directory, "bm11-md5sums")):
+            if is_cancelled(cancel_token):
+                output_message("Checksum upgrade cancelled before MD5 checksums were upgraded.\n", message_destination)
+            elif os.path.exists(os.path.join(base_directory, "bm11-md5sums")):
                 output_message("Current version of MD5 checksum data found. Skipping MD5 checksum upgrade...\n", message_destination)
             elif os.path.exists(os.path.join(base_directory, "bm-md5sums")):
                 output_message("Upgrading legacy MD5 checksums to current format...\n", message_destination)
                 # Rename the bm-md5sums directory to bm11-md5sums
                 os.rename(os.path.join(base_directory, "bm-md5sums"), os.path.join(base_directory, "bm11-md5sums"))
-                file_paths = create_file_list(os.path.join(base_directory, "bm11-md5sums"))
-                for file_path in file_paths:
+                file_paths = create_file_list(os.path.join(base_directory, "bm11-md5sums"), monitor)
+                # Progress is reported for each checksum folder on its own, from the position in its file list
+                for file_index, file_path in enumerate(file_paths, 1):
                     # Rename the files in the new bm11-md5sums directory to have an .md5 extension
-                    os.rename(file_path, file_path + ".md5")
+                    rename_checksum_file(file_path, ".md5", monitor)
                     files_processed += 1
+                    if progress_destination is not None:
+                        progress_destination(file_index, len(file_paths))
             # Check for existing SHA-1 current version checksum directories
-            if os.path.exists(os.path.join(base_directory, "bm11-sha1sums")):
+            if is_cancelled(cancel_token):
+                output_message("Checksum upgrade cancelled before SHA-1 checksums were upgraded.\n", message_destination)
+            elif os.path.exists(os.path.join(base_directory, "bm11-sha1sums")):
                 output_message("Current version of SHA-1 checksum data found. Skipping SHA-1 checksum upgrade...\n", message_destination)
             elif os.path.exists(os.path.join(base_directory, "bm-sha1sums")):
                 output_message("Upgrading legacy SHA-1 checksums to current format...\n", message_destination)
                 os.rename(os.path.join(base_directory, "bm-sha1sums"), os.path.join(base_directory, "bm11-sha1sums"))
-                file_paths = create_file_list(os.path.join(base_directory, "bm11-sha1sums"))
-                for file_path in file_paths:
-                    os.rename(file_path, file_path + ".sha1")
+                file_paths = create_file_list(os.path.join(base_directory, "bm11-sha1sums"), monitor)
+                for file_index, file_path in enumerate(file_paths, 1):
+                    rename_checksum_file(file_path, ".sha1", monitor)
                     files_processed += 1
+                    if progress_destination is not None:
+                        progress_destination(file_index, len(file_paths))
             end_date = datetime.now()
             time_elapsed = end_date - start_date
             output_message("Checksum upgrade complete. " + str(files_processed) + " checksum files(s) upgraded. The operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
@@ -71,6 +583,25 @@ def start_upgrade_process(base_directory, message_destination=print):
     except Exception as error:
         documentUnknownError(error, message_destination)
 
+def rename_checksum_file(file_path, extension, monitor=None):
+
+    """
+    Rename a version 1.0 checksum file by appending the version 1.1 extension.
+    :param file_path: The path of the checksum file
+    :param extension: The extension to append
+    :param monitor: An optional profiler, trace writer or monitor group to record the rename in
+    """
+
+    if monitor is None:
+        os.rename(file_path, file_path + extension)
+    else:
+        rename_start = time.perf_counter()
+        os.rename(file_path, file_path + extension)
+        rename_end = time.perf_counter()
+        monitor.record_phase("rename", rename_start, rename_end, file_path)
+        # The rename is all the work done for the file, so it also counts as the file's span
+        monitor.record_file(file_path, rename_start, rename_end)
+
 def documentUnknownError(exception_error, message_destination=print):
         
         """
@@ -85,14 +616,24 @@ def documentUnknownError(exception_error, message_destination=print):
         output_message(str(exception_error) + "\n", message_destination)
         output_message("Traceback:\n" + traceback.format_exc(), message_destination)
 
-def verify_all_checksums_in_all_direct_subdirectories(base_directory, message_destination=print):
+def verify_all_checksums_in_all_direct_subdirectories(base_directory, message_destination=print, profiler=None, tracer=None, progress_destination=None, cancel_token=None, read_ahead=0, cache_mode="normal", file_order="walk", hardlinks=True):
     
     """
     Verifies all checksums found in all direct subdirectories in sequence
     :param base_directory: The base directory to walk through
     :param message_destination: The function to call to output the message
+    :param profiler: An optional OperationProfiler shared by every subdirectory verification
+    :param tracer: An optional TraceWriter shared by every subdirectory verification
+    :param progress_destination: An optional function called with the files done and the total of the current subdirectory
+    :param cancel_token: An optional CancellationToken that stops the operation, including the current subdirectory
+    :param read_ahead: The number of background threads opening and reading upcoming files in each subdirectory
+    :param cache_mode: "normal", "scrub" to read without disturbing the page cache, or "direct" to bypass it with O_DIRECT
+    :param file_order: The order files are hashed in, as described in order_file_list
+    :param hardlinks: Whether to read each hardlinked inode only once and reuse its checksums for every link
     """
 
+    monitor = combine_monitors(profiler, tracer)
+
     try:
 
         # Store current date and time for later use
@@ -106,23 +647,54 @@ def verify_all_checksums_in_all_direct_subdirectories(base_directory, message_de
                 dir_list.append(entries)
         # For each directory in the list, verify the checksums
         for directory in dir_list:
+            if is_cancelled(cancel_token):
+                break
             output_message("Verifying files in directory: " + directory + "\n", message_destination)
-            start_verification_process(os.path.join(base_directory, directory), True, message_destination)
+            if monitor is not None:
+                directory_start = time.perf_counter()
+            start_verification_process(os.path.join(base_directory, directory), True, message_destination, profiler, tracer, progress_destination, cancel_token, read_ahead, cache_mode, file_order, hardlinks)
+            if monitor is not None:
+                monitor.record_directory(os.path.join(base_directory, directory), directory_start, time.perf_counter())
         end_date = datetime.now()
         time_elapsed = end_date - start_date
-        output_message("Verification of all direct subdirectories complete. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        if is_cancelled(cancel_token):
+            output_message("Verification of all direct subdirectories cancelled. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        else:
+            output_message("Verification of all direct subdirectories complete. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
     except Exception as error:
         documentUnknownError(error, message_destination)
 
-def start_verification_process(absolute_path, omit_statistics, message_destination=print):
+def start_verification_process(absolute_path, omit_statistics, message_destination=print, profiler=None, tracer=None, progress_destination=None, cancel_token=None, read_ahead=0, cache_mode="normal", file_order="walk", hardlinks=True, shard=None, report=None, incremental=False):
 
     """
     Start the verification process on the base directory.
     :param absolute_path: The absolute base path to walk through
     :param omit_statistics: Whether to omit the statistics at the end of the verification process
     :param message_destination: The function to call to output the message
+    :param profiler: An optional OperationProfiler to record phase timings in
+    :param tracer: An optional TraceWriter to record per-file spans in
+    :param progress_destination: An optional function called with the files done and the total after each file
+    :param cancel_token: An optional CancellationToken that stops the operation between files and read chunks
+    :param read_ahead: The number of background threads opening and reading upcoming files, or 0 to read on the hashing thread
+    :param cache_mode: "normal", "scrub" to read without disturbing the page cache, or "direct" to bypass it with O_DIRECT
+    :param file_order: The order files are hashed in, as described in order_file_list
+    :param hardlinks: Whether to read each hardlinked inode only once and reuse its checksums for every link
+    :param shard: An optional (index, count) tuple to verify only one shard of the files, as described in file_in_shard
+    :param report: An optional VerificationReport that is filled with the totals and problems found
+    :param incremental: Whether to only verify the directories changed since the last incremental checksum run, as recorded in DIRECTORY_STATE_NAME
+    :return: The number of errors found, or None if there was nothing to verify or the verification failed
     """
 
+    monitor = combine_monitors(profiler, tracer)
+
+    def report_problem(message, category, file_path=None):
+        # Output a problem and keep it for the report, if one was requested
+        output_message(message, message_destination)
+        if report is not None:
+            report.problems.append(message)
+        if monitor is not None:
+            monitor.record_problem(category, file_path)
+
     try:
 
         md5_present = 0
@@ -136,220 +708,1709 @@ def start_verification_process(absolute_path, omit_statistics, message_destinati
         # If neither checksum folder is present, abort the verification process        
         if md5_present == 0 and sha1_present == 0:
             output_message("No verification data could be found. Aborting...\n", message_destination)
+            return None
         else:
             # Store current date and time for later use if omit_statistics is False
             if omit_statistics == False:
                 start_date = datetime.now()
             output_message("Verifying based on files and checksums available...\n", message_destination)
-            file_paths = create_file_list(absolute_path)
+            if shard is not None:
+                output_message("Verifying shard " + format_shard(shard) + " only.\n", message_destination)
+            algorithms = []
+            if md5_present == 1:
+                algorithms.append("md5")
+            if sha1_present == 1:
+                algorithms.append("sha1")
+            directory_state = None
+            if incremental:
+                directory_state = DirectoryState.load(os.path.join(absolute_path, DIRECTORY_STATE_NAME))
+                if directory_state.usable(algorithms):
+                    output_message("Verifying only the directories changed since the last incremental checksum run.\n", message_destination)
+                else:
+                    output_message("No usable directory state from an incremental checksum run was found. Verifying the whole tree...\n", message_destination)
+                    directory_state = None
+            # Sizes from the walk let small files be read in a single call
+            small_file_path = SMALL_FILE_LIMIT > 0 and read_ahead == 0 and cache_mode == "normal"
+            file_paths = order_file_list(select_shard(create_file_list(absolute_path, monitor, with_sizes=small_file_path, directory_state=directory_state, with_links=hardlinks), absolute_path, shard), file_order, monitor)
             error_flag = False
-            # Create processed list to hold a count of actual, md5 and sha1 files as well as a count of all errors
-            processed = [0, 0, 0, 0]
-            for file_path in file_paths:
-                processed[0] += 1
-                # Calculate the checksums of the current file based on the checksum directories available
-                if md5_present == 1:
-                    file_md5 = calculate_checksum(file_path, "md5")
-                if sha1_present == 1:
-                    file_sha1 = calculate_checksum(file_path, "sha1")
-                # Calculate the relative paths of the files
-                relative_path = os.path.relpath(file_path, absolute_path)
-                if md5_present == 1:
-                    # Check to see if the md5 checksum file exists and report it if not.
-                    if not os.path.exists(os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5")):
-                        output_message("* MD5 checksum is missing for file: " + os.path.relpath(file_path, absolute_path), message_destination)
-                        processed[3] += 1
-                        error_flag = True
-                    else:
-                        # Add one to the count of md5 files found
-                        processed[1] += 1
-                        # Read the MD5 checksum from the file and check if the stored checksum matches the one from the actual file
-                        with open(os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5"), "r") as md5_file:
-                            # Read md5 checksum after stripping newline character for compatibility with Bash version of program
-                            checksum_md5 = (md5_file.read()).rstrip()
-                            if file_md5 != checksum_md5:
-                                output_message("* File does not match MD5 checksum: " + os.path.relpath(file_path, absolute_path), message_destination)
+            # Create processed list to hold a count of actual, md5 and sha1 files, a count of all errors and a count of files that could not be read
+            processed = [0, 0, 0, 0, 0]
+            cancelled = False
+            links = HardlinkTracker(file_paths, hardlinks, monitor)
+            reader = start_read_ahead(links.unique_paths, read_ahead, monitor, cache_mode)
+            small_files = start_small_file_hasher(file_paths, algorithms, monitor, reader, cache_mode)
+            md5_folder = os.path.join(absolute_path, "bm11-md5sums")
+            sha1_folder = os.path.join(absolute_path, "bm11-sha1sums")
+            try:
+                for position in range(len(file_paths)):
+                    check_cancelled(cancel_token)
+                    if monitor is not None:
+                        file_start = time.perf_counter()
+                    # The index already holds the relative path, which saves a relpath call per file
+                    relative_path = file_paths.relative_path(position)
+                    file_path = os.path.join(absolute_path, relative_path)
+                    # Calculate the checksums of the current file based on the checksum directories available
+                    file_checksums = links.cached_checksums(file_path)
+                    if file_checksums is None:
+                        try:
+                            checksums = None
+                            if small_files is not None:
+                                try:
+                                    checksums = small_files.checksums(position)
+                                except OSError:
+                                    # The usual path retries or reports the error
+                                    checksums = None
+                            if checksums is None:
+                                # A later link whose first link could not be read is not in the read-ahead queue
+                                file_reader = None if file_path in links.link_sources else reader
+                                checksums = calculate_checksums_with_retry(file_path, algorithms, monitor, cancel_token, file_reader, cache_mode, message_destination)
+                            file_checksums = dict(zip(algorithms, checksums))
+                        except OSError as error:
+                            # Report the file and carry on with the rest rather than abandoning the verification
+                            report_problem("* Could not read file: " + relative_path + " (" + (error.strerror or str(error)) + ")", "unreadable", file_path)
+                            processed[3] += 1
+                            processed[4] += 1
+                            error_flag = True
+                            if progress_destination is not None:
+                                progress_destination(processed[0] + processed[4], len(file_paths))
+                            continue
+                        links.remember_checksums(file_path, file_checksums)
+                    file_md5 = file_checksums.get("md5")
+                    file_sha1 = file_checksums.get("sha1")
+                    # Only count the file once it has been fully hashed, so a cancelled file is left out
+                    processed[0] += 1
+                    if monitor is not None:
+                        store_start = time.perf_counter()
+                    try:
+                        if md5_present == 1:
+                            # Opening the checksum file straight away saves a separate exists check per file
+                            try:
+                                with open(os.path.join(md5_folder, relative_path + ".md5"), "r") as md5_file:
+                                    # Read md5 checksum after stripping newline character for compatibility with Bash version of program
+                                    checksum_md5 = (md5_file.read()).rstrip()
+                            except FileNotFoundError:
+                                checksum_md5 = None
+                            # Report the md5 checksum file if it does not exist
+                            if checksum_md5 is None:
+                                report_problem("* MD5 checksum is missing for file: " + relative_path, "missing_checksum", file_path)
                                 processed[3] += 1
                                 error_flag = True
-                            md5_file.close()
-                if sha1_present == 1:
-                    # Check to see if the sha1 checksum file exists and report it if not.
-                    if not os.path.exists(os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1")):
-                        output_message("* SHA-1 checksum is missing for file: " + os.path.relpath(file_path, absolute_path), message_destination)
+                            else:
+                                # Add one to the count of md5 files found
+                                processed[1] += 1
+                                # Check if the stored checksum matches the one from the actual file
+                                if file_md5 != checksum_md5:
+                                    report_problem("* File does not match MD5 checksum: " + relative_path, "mismatch", file_path)
+                                    processed[3] += 1
+                                    error_flag = True
+                        if sha1_present == 1:
+                            try:
+                                with open(os.path.join(sha1_folder, relative_path + ".sha1"), "r") as sha1_file:
+                                    # Read sha1 checksum after stripping newline character for compatibility with Bash version of program
+                                    checksum_sha1 = (sha1_file.read()).rstrip()
+                            except FileNotFoundError:
+                                checksum_sha1 = None
+                            # Report the sha1 checksum file if it does not exist
+                            if checksum_sha1 is None:
+                                report_problem("* SHA-1 checksum is missing for file: " + relative_path, "missing_checksum", file_path)
+                                processed[3] += 1
+                                error_flag = True
+                            else:
+                                # Add one to the count of sha1 files found
+                                processed[2] += 1
+                                if file_sha1 != checksum_sha1:
+                                    report_problem("* File does not match SHA-1 checksum: " + relative_path, "mismatch", file_path)
+                                    processed[3] += 1
+                                    error_flag = True
+                    except OSError as error:
+                        report_problem("* Could not read the stored checksums of file: " + relative_path + " (" + (error.strerror or str(error)) + ")", "store_error", file_path)
                         processed[3] += 1
                         error_flag = True
-                    else:
-                        # Add one to the count of sha1 files found
-                        processed[2] += 1
-                        # Read the SHA1 checksum from the file and check if the stored checksum matches the one from the actual file
-                        with open(os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1"), "r") as sha1_file:
-                            # Read sha1 checksum after stripping newline character for compatibility with Bash version of program
-                            checksum_sha1 = (sha1_file.read()).rstrip()
-                        if file_sha1 != checksum_sha1:
-                            output_message("* File does not match SHA-1 checksum: " + os.path.relpath(file_path, absolute_path), message_destination)           
-                            processed[3] += 1
-                            error_flag = True
-                        sha1_file.close()
-            if md5_present == 1:
-                md5_file_paths = create_file_list(os.path.join(absolute_path, "bm11-md5sums"))
-                for md5_file_path in md5_file_paths:
-                    # Remove bm11-md5sums from the beginning and .md5 from the end of the path
-                    actual_file_path = os.path.relpath(md5_file_path, absolute_path)
-                    if not os.path.exists(os.path.join(absolute_path, actual_file_path[13:-4])):
-                        output_message("* MD5 checksum available for missing file: " + actual_file_path[13:-4], message_destination)
+                    if monitor is not None:
+                        file_end = time.perf_counter()
+                        monitor.record_phase("store", store_start, file_end, file_path)
+                        monitor.record_file(file_path, file_start, file_end)
+                    if progress_destination is not None:
+                        progress_destination(processed[0] + processed[4], len(file_paths))
+                if monitor is not None:
+                    orphans_start = time.perf_counter()
+                # An incremental verification only looks at the checksums of the directories it listed
+                relative_directories = file_paths.directories if directory_state is not None else None
+                if md5_present == 1:
+                    for actual_file_path in find_orphan_checksums(absolute_path, "bm11-md5sums", ".md5", shard, relative_directories):
+                        report_problem("* MD5 checksum available for missing file: " + actual_file_path, "orphan_checksum")
                         processed[3] += 1
                         error_flag = True
-            if sha1_present == 1:
-                sha1_file_paths = create_file_list(os.path.join(absolute_path, "bm11-sha1sums"))
-                for sha1_file_path in sha1_file_paths:
-                    actual_file_path = os.path.relpath(sha1_file_path, absolute_path)
-                    if not os.path.exists(os.path.join(absolute_path, actual_file_path[14:-5])):
-                        output_message("* SHA-1 checksum available for missing file: " + actual_file_path[14:-5], message_destination)
+                if sha1_present == 1:
+                    for actual_file_path in find_orphan_checksums(absolute_path, "bm11-sha1sums", ".sha1", shard, relative_directories):
+                        report_problem("* SHA-1 checksum available for missing file: " + actual_file_path, "orphan_checksum")
                         processed[3] += 1
                         error_flag = True
+                if monitor is not None:
+                    monitor.record_phase("orphans", orphans_start, time.perf_counter())
+            except OperationCancelled:
+                # The orphan scan is skipped when cancelled
+                cancelled = True
+            finally:
+                stop_read_ahead(reader)
+                stop_small_file_hasher(small_files)
+            if report is not None:
+                report.files_processed = processed[0]
+                report.md5_processed = processed[1]
+                report.sha1_processed = processed[2]
+                report.errors = processed[3]
+                report.read_errors = processed[4]
+                report.links_reused = links.links_reused
+                report.cancelled = cancelled
+            if cancelled == True:
+                output_message("\nVerification cancelled after " + str(processed[0]) + " of " + str(len(file_paths)) + " files.", message_destination)
             if omit_statistics == False:
                 end_date = datetime.now()
                 time_elapsed = end_date - start_date
-                if error_flag == True:
+                if cancelled == True:
+                    output_message("Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+                elif error_flag == True:
                     output_message("\nVerification complete. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
                 else:
                     output_message("Verification complete. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
                 output_message("Files processed: " + str(processed[0]), message_destination)
+                if links.links_reused > 0:
+                    output_message("Hardlinked files not re-read: " + str(links.links_reused), message_destination)
                 output_message("MD5 checksums processed: " + str(processed[1]), message_destination)
                 output_message("SHA-1 checksums processed: " + str(processed[2]), message_destination)
+                if processed[4] > 0:
+                    output_message("Files that could not be read: " + str(processed[4]), message_destination)
                 output_message("Errors found: " + str(processed[3]) + "\n", message_destination)
-            elif omit_statistics == True and error_flag == True:
+            elif omit_statistics == True and (error_flag == True or cancelled == True):
                 # Insert a new line to make the display better
                 output_message("", message_destination)
+            return processed[3]
     except Exception as error:
         documentUnknownError(error, message_destination)
 
-def return_human_readable_time_elapsed(time_elapsed):
-    
+def check_file_against_store(absolute_path, relative_path, file_checksums):
+
     """
-    Read in the time in the format hh:mm:ss.000000 and return a human-readable string.
-    :param time_elapsed: The time elapsed in the format hh:mm:ss.000000
-    :return: A human-readable string of the time elapsed
+    Compare freshly calculated checksums with the ones held in the checksum folders.
+    A stored checksum that cannot be read is reported rather than raised, so the caller can carry on with the next file.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param relative_path: The path of the file relative to the base directory
+    :param file_checksums: A dictionary mapping "md5" and/or "sha1" to the calculated checksums
+    :return: A list of (category, algorithm, message) tuples, empty if the file matches, where the category is one of
+    "mismatch", "missing_checksum" or "store_error" from PROBLEM_CATEGORIES
     """
 
-    # Split up the elapsed time into hours, minutes and seconds
-    time_elapsed = str(time_elapsed).split(":")
-    # Ensure all numbers are rounded to the nearest integer
-    for i in range(len(time_elapsed)):
-        time_elapsed[i] = str(round(float(time_elapsed[i])))
-    # Only show the hours and minutes if they are more than zero
-    if int(time_elapsed[0]) > 0:
-        return time_elapsed[0] + " hours, " + time_elapsed[1] + " minutes and " + time_elapsed[2] + " seconds."
-    elif int(time_elapsed[1]) > 0:
-        return time_elapsed[1] + " minutes and " + time_elapsed[2] + " seconds."
+    problems = []
+    for algorithm, folder, extension, name in (("md5", "bm11-md5sums", ".md5", "MD5"), ("sha1", "bm11-sha1sums", ".sha1", "SHA-1")):
+        if algorithm not in file_checksums:
+            continue
+        checksum_path = os.path.join(absolute_path, folder, relative_path + extension)
+        try:
+            with open(checksum_path, "r") as checksum_file:
+                # Strip the newline character for compatibility with the Bash version of the program
+                stored_checksum = checksum_file.read().rstrip()
+        except FileNotFoundError:
+            problems.append(("missing_checksum", algorithm, "* " + name + " checksum is missing for file: " + relative_path))
+            continue
+        except OSError as error:
+            problems.append(("store_error", algorithm, "* Could not read the stored " + name + " checksum of file: " + relative_path + " (" + (error.strerror or str(error)) + ")"))
+            continue
+        if file_checksums[algorithm] != stored_checksum:
+            problems.append(("mismatch", algorithm, "* File does not match " + name + " checksum: " + relative_path))
+    return problems
+
+def find_orphan_checksums(absolute_path, folder, extension, shard=None, relative_directories=None, checksum_files=None):
+
+    """
+    Find stored checksums whose file no longer exists.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param folder: "bm11-md5sums" or "bm11-sha1sums"
+    :param extension: ".md5" or ".sha1"
+    :param shard: An optional (index, count) tuple to only look at the checksums of one shard
+    :param relative_directories: The directories to look in, as listed by an incremental walk, or
+    None for the whole checksum folder. Checksum folders of directories that no longer exist are searched in full.
+    :param checksum_files: An optional FileIndex of the whole checksum folder, already listed by the caller
+    :return: A generator of the relative paths of the missing files
+    """
+
+    checksum_root = os.path.join(absolute_path, folder)
+    if relative_directories is None:
+        if checksum_files is None:
+            checksum_files = create_file_list(checksum_root)
+        checksum_paths = (checksum_files.relative_path(position) for position in range(len(checksum_files)))
     else:
-        return time_elapsed[2] + " seconds."
+        checksum_paths = changed_checksum_paths(absolute_path, checksum_root, relative_directories)
+    for checksum_path in checksum_paths:
+        # Remove the extension from the end of the path, which is relative to the checksum folder
+        actual_file_path = checksum_path[:-len(extension)]
+        # Each shard only reports the checksums of files in its own shard, so merged reports list every orphan once
+        if not file_in_shard(actual_file_path, shard):
+            continue
+        if not os.path.exists(os.path.join(absolute_path, checksum_owner_path(actual_file_path))):
+            yield actual_file_path
+
+def changed_checksum_paths(absolute_path, checksum_root, relative_directories):
 
-def start_checksum_process(absolute_path, mode, message_destination=print):
-    
     """
-    Start the checksumming process on the base directory.
-    :param absolute_path: The absolute base path to walk through
-    :param mode: The mode to run the checksumming process
-    0 = Both MD5 and SHA-1
-    1 = MD5 only
-    2 = SHA-1 only
-    :param message_destination: The function to call to output the message
+    :param absolute_path: The absolute base path
+    :param checksum_root: The checksum folder to look in
+    :param relative_directories: The directories listed by an incremental walk
+    :return: A generator of the checksum files held for those directories, relative to the checksum folder,
+    including everything below checksum directories whose directory no longer exists
     """
 
-    try:
-        addition = False
+    for relative_directory in relative_directories:
+        try:
+            with os.scandir(os.path.join(checksum_root, relative_directory)) as checksum_entries:
+                entries = list(checksum_entries)
+        except OSError:
+            continue
+        for entry in entries:
+            entry_path = os.path.join(relative_directory, entry.name) if relative_directory else entry.name
+            if not entry.is_dir(follow_symlinks=False):
+                yield entry_path
+            elif not os.path.isdir(os.path.join(absolute_path, entry_path)):
+                removed_files = create_file_list(entry.path)
+                for position in range(len(removed_files)):
+                    yield os.path.join(entry_path, removed_files.relative_path(position))
+
+def checksum_owner_path(relative_path):
+
+    """
+    Find the file a stored checksum belongs to. Checksums of archive members are stored under
+    the archive's path followed by ARCHIVE_MEMBERS_SUFFIX, and belong to the archive file itself.
+    :param relative_path: The path of a checksum in the checksum folder, without its extension
+    :return: The relative path of the file that must exist for the checksum not to be an orphan
+    """
+
+    path_parts = relative_path.split(os.sep)
+    for part_index, path_part in enumerate(path_parts[:-1]):
+        if path_part.endswith(ARCHIVE_MEMBERS_SUFFIX):
+            return os.path.join(*path_parts[:part_index], path_part[:-len(ARCHIVE_MEMBERS_SUFFIX)])
+    return relative_path
+
+def parse_shard(shard_text):
+
+    """
+    Read a shard given as I/N, where I counts from 0 and is less than N.
+    :param shard_text: The shard as typed by the user, for example "2/8"
+    :return: An (index, count) tuple
+    """
+
+    index_text, separator, count_text = shard_text.partition("/")
+    if not separator or not index_text.isdigit() or not count_text.isdigit():
+        raise ValueError("a shard must be given as I/N, for example 0/4")
+    index, count = int(index_text), int(count_text)
+    if count < 1 or index >= count:
+        raise ValueError("the shard index must be from 0 to N-1")
+    return index, count
+
+def format_shard(shard):
+
+    """
+    :param shard: An (index, count) tuple
+    :return: The shard in the I/N form accepted by parse_shard
+    """
+
+    return str(shard[0]) + "/" + str(shard[1])
+
+def file_in_shard(relative_path, shard):
+
+    """
+    Decide whether a file belongs to a shard. Files are assigned by a CRC-32 of their path
+    relative to the base directory, with "/" as the separator, so every process and machine
+    given the same tree agrees on the partition without sharing any state.
+    :param relative_path: The path of the file relative to the base directory
+    :param shard: An (index, count) tuple, or None for every file
+    :return: True if the file belongs to the shard
+    """
+
+    if shard is None:
+        return True
+    path_key = relative_path.replace(os.sep, "/").encode("utf-8", "surrogateescape")
+    return zlib.crc32(path_key) % shard[1] == shard[0]
+
+def select_shard(file_paths, absolute_path, shard):
+
+    """
+    :param file_paths: A FileIndex or list of the absolute paths of the files in the base directory
+    :param absolute_path: The absolute base path
+    :param shard: An (index, count) tuple, or None for every file
+    :return: The files belonging to the shard
+    """
+
+    if shard is None:
+        return file_paths
+    if isinstance(file_paths, FileIndex):
+        # The index already holds the relative paths, which saves building and relpathing every absolute path
+        return select_files(file_paths, [position for position in range(len(file_paths)) if file_in_shard(file_paths.relative_path(position), shard)])
+    return select_files(file_paths, [position for position, file_path in enumerate(file_paths) if file_in_shard(os.path.relpath(file_path, absolute_path), shard)])
+
+class VerificationReport:
+
+    """
+    The totals and problems found by one verification, in a form that can be saved and merged.
+    Each shard of a sharded verification saves its own report, and merge_verification_reports
+    combines them into the totals a single verification of the whole tree would have given.
+    """
+
+    def __init__(self, base_directory=None, shard=None):
+
+        """
+        Create an empty report.
+        :param base_directory: The absolute base path that was verified
+        :param shard: The (index, count) tuple of the shard verified, or None for the whole tree
+        """
+
+        self.base_directory = base_directory
+        self.shard = shard
+        self.files_processed = 0
+        self.md5_processed = 0
+        self.sha1_processed = 0
+        self.errors = 0
+        self.read_errors = 0
+        self.links_reused = 0
+        self.cancelled = False
+        self.problems = []
+
+    def save(self, report_path):
+
+        """
+        Write the report as JSON, replacing any earlier report atomically.
+        :param report_path: The path of the report file
+        """
+
+        report_data = {
+            "format": "bmchecksum-verification-report",
+            "version": 1,
+            "base_directory": self.base_directory,
+            "shard": list(self.shard) if self.shard is not None else None,
+            "files_processed": self.files_processed,
+            "md5_processed": self.md5_processed,
+            "sha1_processed": self.sha1_processed,
+            "errors": self.errors,
+            "read_errors": self.read_errors,
+            "links_reused": self.links_reused,
+            "cancelled": self.cancelled,
+            "problems": self.problems,
+        }
+        temporary_path = report_path + ".bmtmp"
+        with open(temporary_path, "w") as report_file:
+            json.dump(report_data, report_file, indent=1)
+        os.replace(temporary_path, report_path)
+
+    @staticmethod
+    def load(report_path):
+
+        """
+        Read a report written by save.
+        :param report_path: The path of the report file
+        :return: The VerificationReport
+        """
+
+        with open(report_path, "r") as report_file:
+            report_data = json.load(report_file)
+        if not isinstance(report_data, dict) or report_data.get("format") != "bmchecksum-verification-report":
+            raise ValueError(report_path + " is not a BMChecksum verification report")
+        report = VerificationReport(report_data["base_directory"], tuple(report_data["shard"]) if report_data["shard"] is not None else None)
+        report.files_processed = report_data["files_processed"]
+        report.md5_processed = report_data["md5_processed"]
+        report.sha1_processed = report_data["sha1_processed"]
+        report.errors = report_data["errors"]
+        report.read_errors = report_data.get("read_errors", 0)
+        report.links_reused = report_data["links_reused"]
+        report.cancelled = report_data["cancelled"]
+        report.problems = report_data["problems"]
+        return report
+
+def merge_verification_reports(report_paths, message_destination=print):
+
+    """
+    Combine the reports of a sharded verification and output the problems and statistics
+    in the same form as start_verification_process. Missing, repeated or cancelled shards
+    are reported, since the totals would then not cover the whole tree exactly once.
+    :param report_paths: The paths of the report files to merge
+    :param message_destination: The function to call to output the message
+    :return: The merged VerificationReport, or None if the reports could not be merged
+    """
+
+    try:
+        reports = [VerificationReport.load(report_path) for report_path in report_paths]
+        shard_counts = set(report.shard[1] if report.shard is not None else 1 for report in reports)
+        if len(shard_counts) != 1:
+            output_message("The reports come from verifications split into different numbers of shards and cannot be merged.\n", message_destination)
+            return None
+        shard_count = shard_counts.pop()
+        merged = VerificationReport(reports[0].base_directory)
+        shards_seen = []
+        for report in reports:
+            shards_seen.append(report.shard[0] if report.shard is not None else 0)
+            merged.files_processed += report.files_processed
+            merged.md5_processed += report.md5_processed
+            merged.sha1_processed += report.sha1_processed
+            merged.errors += report.errors
+            merged.read_errors += report.read_errors
+            merged.links_reused += report.links_reused
+            merged.cancelled = merged.cancelled or report.cancelled
+            merged.problems.extend(report.problems)
+        complete = True
+        missing_shards = [str(index) for index in range(shard_count) if index not in shards_seen]
+        repeated_shards = sorted(set(str(index) for index in shards_seen if shards_seen.count(index) > 1))
+        if missing_shards:
+            output_message("Warning: no report was given for shard(s) " + ", ".join(missing_shards) + " of " + str(shard_count) + ".", message_destination)
+            complete = False
+        if repeated_shards:
+            output_message("Warning: more than one report was given for shard(s) " + ", ".join(repeated_shards) + ".", message_destination)
+            complete = False
+        if merged.cancelled:
+            output_message("Warning: at least one shard was cancelled before it finished.", message_destination)
+            complete = False
+        if not complete:
+            output_message("The merged totals do not cover the whole tree exactly once.\n", message_destination)
+        output_message("Merged " + str(len(reports)) + " report(s) for " + str(merged.base_directory) + "\n", message_destination)
+        for problem in sorted(merged.problems):
+            output_message(problem, message_destination)
+        if merged.problems:
+            output_message("", message_destination)
+        output_message("Files processed: " + str(merged.files_processed), message_destination)
+        if merged.links_reused > 0:
+            output_message("Hardlinked files not re-read: " + str(merged.links_reused), message_destination)
+        output_message("MD5 checksums processed: " + str(merged.md5_processed), message_destination)
+        output_message("SHA-1 checksums processed: " + str(merged.sha1_processed), message_destination)
+        if merged.read_errors > 0:
+            output_message("Files that could not be read: " + str(merged.read_errors), message_destination)
+        output_message("Errors found: " + str(merged.errors) + "\n", message_destination)
+        return merged
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        output_message("Could not merge the verification reports: " + str(error) + "\n", message_destination)
+        return None
+
+def return_human_readable_time_elapsed(time_elapsed):
+    
+    """
+    Read in the time in the format hh:mm:ss.000000 and return a human-readable string.
+    :param time_elapsed: The time elapsed in the format hh:mm:ss.000000
+    :return: A human-readable string of the time elapsed
+    """
+
+    # Split up the elapsed time into hours, minutes and seconds
+    time_elapsed = str(time_elapsed).split(":")
+    # Ensure all numbers are rounded to the nearest integer
+    for i in range(len(time_elapsed)):
+        time_elapsed[i] = str(round(float(time_elapsed[i])))
+    # Only show the hours and minutes if they are more than zero
+    if int(time_elapsed[0]) > 0:
+        return time_elapsed[0] + " hours, " + time_elapsed[1] + " minutes and " + time_elapsed[2] + " seconds."
+    elif int(time_elapsed[1]) > 0:
+        return time_elapsed[1] + " minutes and " + time_elapsed[2] + " seconds."
+    else:
+        return time_elapsed[2] + " seconds."
+
+def start_checksum_process(absolute_path, mode, message_destination=print, profiler=None, tracer=None, progress_destination=None, cancel_token=None, read_ahead=0, cache_mode="normal", file_order="walk", hardlinks=True, shard=None, incremental=False, full_walk=False):
+    
+    """
+    Start the checksumming process on the base directory.
+    :param absolute_path: The absolute base path to walk through
+    :param mode: The mode to run the checksumming process
+    0 = Both MD5 and SHA-1
+    1 = MD5 only
+    2 = SHA-1 only
+    :param message_destination: The function to call to output the message
+    :param profiler: An optional OperationProfiler to record phase timings in
+    :param tracer: An optional TraceWriter to record per-file spans in
+    :param progress_destination: An optional function called with the files done and the total after each file
+    :param cancel_token: An optional CancellationToken that stops the operation between files and read chunks
+    :param read_ahead: The number of background threads opening and reading upcoming files, or 0 to read on the hashing thread
+    :param cache_mode: "normal", "scrub" to read without disturbing the page cache, or "direct" to bypass it with O_DIRECT
+    :param file_order: The order files are hashed in, as described in order_file_list
+    :param hardlinks: Whether to read each hardlinked inode only once and reuse its checksums for every link
+    :param shard: An optional (index, count) tuple to checksum only one shard of the files, as described in file_in_shard
+    :param incremental: Whether to skip directories unchanged since the last incremental run and record the
+    directories in DIRECTORY_STATE_NAME for the next one. The state is not saved when only one shard is checksummed.
+    :param full_walk: With incremental, list every directory this time while still recording them
+    :return: The number of files checksummed, or None if the operation failed
+    """
+
+    monitor = combine_monitors(profiler, tracer)
+
+    try:
+        addition = False
         # Create the directories "bm11-md5sums" and "bm11-sha1sums" if they don't exist
         if not os.path.exists(os.path.join(absolute_path, "bm11-md5sums")) and (mode == 0 or mode == 1):
-            os.makedirs(os.path.join(absolute_path, "bm11-md5sums"))
+            os.makedirs(os.path.join(absolute_path, "bm11-md5sums"), exist_ok=True)
             output_message("MD5 checksum folder not found in starting directory. Creating new checksums for all discovered files...", message_destination)
         elif mode == 0 or mode == 1:
             output_message("MD5 checksum folder found in starting directory. Adding checksums for new files only...", message_destination)
             addition = True
         if not os.path.exists(os.path.join(absolute_path, "bm11-sha1sums")) and (mode == 0 or mode == 2):
-            os.makedirs(os.path.join(absolute_path, "bm11-sha1sums"))
+            os.makedirs(os.path.join(absolute_path, "bm11-sha1sums"), exist_ok=True)
             output_message("SHA-1 checksum folder not found in starting directory. Creating new checksums for all discovered files...", message_destination)
         elif mode == 0 or mode == 2:
             output_message("SHA-1 checksum folder found in starting directory. Adding checksums for new files only...", message_destination)
             addition = True
         if addition == True:
             output_message("Existing checksum will not be replaced.", message_destination)
-        file_paths = create_file_list(absolute_path)
+        if shard is not None:
+            output_message("Checksumming shard " + format_shard(shard) + " only.", message_destination)
+        algorithms = []
+        if mode == 0 or mode == 1:
+            algorithms.append("md5")
+        if mode == 0 or mode == 2:
+            algorithms.append("sha1")
+        directory_state = None
+        if incremental:
+            state_path = os.path.join(absolute_path, DIRECTORY_STATE_NAME)
+            directory_state = DirectoryState.load(state_path)
+            if not directory_state.reliable:
+                output_message("Directory modification times have not been reliable in this tree. Walking the whole tree...", message_destination)
+                directory_state.skip_unchanged = False
+            elif full_walk or addition == False or not directory_state.usable(algorithms):
+                output_message("Walking the whole tree and recording its directories for later incremental runs...", message_destination)
+                directory_state.skip_unchanged = False
+            else:
+                output_message("Only listing directories changed since the last incremental run.", message_destination)
+        # Sizes from the walk let small files be read in a single call
+        small_file_path = SMALL_FILE_LIMIT > 0 and read_ahead == 0 and cache_mode == "normal"
+        file_paths = order_file_list(select_shard(create_file_list(absolute_path, monitor, with_sizes=small_file_path, directory_state=directory_state, with_links=hardlinks), absolute_path, shard), file_order, monitor)
         # Store current date and time for later use
         start_date = datetime.now()
         output_message("\nCalculating new checksums...", message_destination)
         files_processed = 0
-        for file_path in file_paths:
-            checksum_written = False
-            if mode == 0 or mode == 1:
-                md5_checksum = calculate_checksum(file_path, "md5")
-            if mode == 0 or mode == 2:
-                sha1_checksum = calculate_checksum(file_path, "sha1")
-            # Calculate the relative paths of the files and directories
-            relative_path = os.path.relpath(file_path, absolute_path)
-            relative_dir_path = os.path.relpath(os.path.dirname(file_path), absolute_path)
-            # Create a new directory for the new checksums if it doesn't exist
-            if not os.path.exists(os.path.join(absolute_path, "bm11-md5sums", relative_dir_path)) and (mode == 0 or mode == 1):
-                os.makedirs(os.path.join(absolute_path, "bm11-md5sums", relative_dir_path))
-            if not os.path.exists(os.path.join(absolute_path, "bm11-sha1sums", relative_dir_path)) and (mode == 0 or mode == 2):
-                os.makedirs(os.path.join(absolute_path, "bm11-sha1sums", relative_dir_path))
-            # Write the output of the checksum functions to a mirrored directory structure to the 
-            # original files underneath the bm11-md5sums and bm11-sha1sums directories 
-            if not os.path.exists(os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5")) and (mode == 0 or mode == 1):
-                with open(os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5"), "w") as md5_file:
-                    md5_file.write(md5_checksum)
-                    checksum_written = True
-                md5_file.close()
-            if not os.path.exists(os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1")) and (mode == 0 or mode == 2):
-                with open(os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1"), "w") as sha1_file:
-                    sha1_file.write(sha1_checksum)
-                    checksum_written = True
-                sha1_file.close()
-            if checksum_written == True:
-                files_processed += 1
+        files_failed = 0
+        cancelled = False
+        # Positions of files that were not checksummed, whose directories must be listed again by the next incremental run
+        unfinished_positions = []
+        file_index = 1
+        links = HardlinkTracker(file_paths, hardlinks, monitor)
+        reader = start_read_ahead(links.unique_paths, read_ahead, monitor, cache_mode)
+        small_files = start_small_file_hasher(file_paths, algorithms, monitor, reader, cache_mode)
+        # The checksum directory of the previous file, which saves checking it again for every file of a directory
+        last_relative_dir_path = None
+        try:
+            for file_index in range(1, len(file_paths) + 1):
+                check_cancelled(cancel_token)
+                if monitor is not None:
+                    file_start = time.perf_counter()
+                checksum_written = False
+                # Calculate the relative paths of the files and directories
+                relative_path = file_paths.relative_path(file_index - 1)
+                file_path = os.path.join(absolute_path, relative_path)
+                try:
+                    file_checksums = links.cached_checksums(file_path)
+                    if file_checksums is None:
+                        checksums = None
+                        if small_files is not None:
+                            try:
+                                checksums = small_files.checksums(file_index - 1)
+                            except OSError:
+                                # The usual path retries or reports the error
+                                checksums = None
+                        if checksums is None:
+                            # A later link whose first link could not be read is not in the read-ahead queue
+                            file_reader = None if file_path in links.link_sources else reader
+                            checksums = calculate_checksums_with_retry(file_path, algorithms, monitor, cancel_token, file_reader, cache_mode, message_destination)
+                        file_checksums = dict(zip(algorithms, checksums))
+                        links.remember_checksums(file_path, file_checksums)
+                    md5_checksum = file_checksums.get("md5")
+                    sha1_checksum = file_checksums.get("sha1")
+                    if monitor is not None:
+                        makedirs_start = time.perf_counter()
+                    relative_dir_path = os.path.dirname(relative_path)
+                    # Create a new directory for the new checksums if it doesn't exist
+                    if relative_dir_path != last_relative_dir_path:
+                        if not os.path.exists(os.path.join(absolute_path, "bm11-md5sums", relative_dir_path)) and (mode == 0 or mode == 1):
+                            os.makedirs(os.path.join(absolute_path, "bm11-md5sums", relative_dir_path), exist_ok=True)
+                        if not os.path.exists(os.path.join(absolute_path, "bm11-sha1sums", relative_dir_path)) and (mode == 0 or mode == 2):
+                            os.makedirs(os.path.join(absolute_path, "bm11-sha1sums", relative_dir_path), exist_ok=True)
+                        last_relative_dir_path = relative_dir_path
+                    if monitor is not None:
+                        write_start = time.perf_counter()
+                        monitor.record_phase("makedirs", makedirs_start, write_start, file_path)
+                    # Write the output of the checksum functions to a mirrored directory structure to the 
+                    # original files underneath the bm11-md5sums and bm11-sha1sums directories 
+                    if not os.path.exists(os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5")) and (mode == 0 or mode == 1):
+                        write_checksum_file(os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5"), md5_checksum)
+                        checksum_written = True
+                    if not os.path.exists(os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1")) and (mode == 0 or mode == 2):
+                        write_checksum_file(os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1"), sha1_checksum)
+                        checksum_written = True
+                except OSError as error:
+                    # Report the file and carry on, so one unreadable file does not throw away the rest of the run
+                    output_message("* Could not checksum file: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                    files_failed += 1
+                    if monitor is not None:
+                        # The checksums are only known if the failure came when storing them
+                        monitor.record_problem("unreadable" if file_checksums is None else "store_error", file_path)
+                    unfinished_positions.append(file_index - 1)
+                    if progress_destination is not None:
+                        progress_destination(file_index, len(file_paths))
+                    continue
+                if checksum_written == True:
+                    files_processed += 1
+                if monitor is not None:
+                    file_end = time.perf_counter()
+                    monitor.record_phase("write", write_start, file_end, file_path)
+                    monitor.record_file(file_path, file_start, file_end)
+                if progress_destination is not None:
+                    progress_destination(file_index, len(file_paths))
+        except OperationCancelled:
+            # Checksums are only written once both digests of a file are known, so the
+            # store holds complete entries for every file finished before the cancel
+            cancelled = True
+            unfinished_positions.extend(range(file_index - 1, len(file_paths)))
+        finally:
+            stop_read_ahead(reader)
+            stop_small_file_hasher(small_files)
+        if directory_state is not None and shard is None:
+            for position in unfinished_positions:
+                directory_state.forget(file_paths.directories[file_paths.directory_ids[file_paths.entry(position)]])
+            directory_state.algorithms = algorithms
+            directory_state.save(state_path)
         end_date = datetime.now()
         time_elapsed = end_date - start_date
-        output_message("\nChecksum calculation complete. " + str(files_processed) + " files(s) checksummed. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        if cancelled == True:
+            output_message("\nChecksum calculation cancelled. " + str(files_processed) + " files(s) checksummed before cancelling. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        else:
+            output_message("\nChecksum calculation complete. " + str(files_processed) + " files(s) checksummed. Operation took " + return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        if links.links_reused > 0:
+            output_message(str(links.links_reused) + " hardlinked file(s) reused the checksums of an earlier link instead of being read again.\n", message_destination)
+        if files_failed > 0:
+            output_message(str(files_failed) + " file(s) could not be checksummed and were skipped. Running the command again will retry them.\n", message_destination)
+        return files_processed
     except Exception as error:
         documentUnknownError(error, message_destination)
 
-def create_file_list(absolute_path):
+def store_file_checksums(absolute_path, file_path, mode, cancel_token=None):
+
+    """
+    Calculate and store the checksums of a single file, keeping any checksums that already exist.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param file_path: The absolute path of the file to checksum
+    :param mode: The checksum mode, as used by start_checksum_process
+    :param cancel_token: An optional CancellationToken checked between read chunks
+    :return: True if at least one new checksum file was written
+    """
+
+    relative_path = os.path.relpath(file_path, absolute_path)
+    checksum_paths = []
+    if mode == 0 or mode == 1:
+        checksum_paths.append(("md5", os.path.join(absolute_path, "bm11-md5sums", relative_path + ".md5")))
+    if mode == 0 or mode == 2:
+        checksum_paths.append(("sha1", os.path.join(absolute_path, "bm11-sha1sums", relative_path + ".sha1")))
+    # Hash everything first so a cancelled or failed read never leaves one algorithm written without the other
+    missing_paths = [(algorithm, checksum_path) for algorithm, checksum_path in checksum_paths if not os.path.exists(checksum_path)]
+    if len(missing_paths) == 0:
+        return False
+    checksums = calculate_checksums(file_path, [algorithm for algorithm, checksum_path in missing_paths], cancel_token=cancel_token)
+    return write_missing_checksums(absolute_path, relative_path, dict(zip([algorithm for algorithm, checksum_path in missing_paths], checksums))) != []
+
+def write_missing_checksums(absolute_path, relative_path, file_checksums):
+
+    """
+    Store the checksums of a file that do not exist yet, creating their directories as needed.
+    Existing checksums are never replaced.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param relative_path: The path of the file relative to the base directory
+    :param file_checksums: A dictionary mapping "md5" and/or "sha1" to the calculated checksums
+    :return: The algorithms whose checksums were written
+    """
+
+    written = []
+    for algorithm, folder, extension in (("md5", "bm11-md5sums", ".md5"), ("sha1", "bm11-sha1sums", ".sha1")):
+        if algorithm not in file_checksums:
+            continue
+        checksum_path = os.path.join(absolute_path, folder, relative_path + extension)
+        if os.path.exists(checksum_path):
+            continue
+        os.makedirs(os.path.dirname(checksum_path), exist_ok=True)
+        write_checksum_file(checksum_path, file_checksums[algorithm])
+        written.append(algorithm)
+    return written
+
+class FileIndex:
+
+    """
+    A compact, read-only sequence of the files found in a directory walk. Indexing or iterating
+    gives absolute paths, like the list create_file_list used to return, but the paths are only
+    built when asked for. Each directory is stored once and each file only as the id of its
+    directory and its name, encoded into one shared buffer, with sizes in an array. This keeps
+    the index to a few tens of bytes per file plus the length of its name. The device and inode
+    of files with more than one link can be kept too, so hardlinks are found without another stat.
+    A subset shares the storage of the index it was taken from and only adds its own positions.
+    """
+
+    __slots__ = ("base_directory", "directories", "directory_ids", "name_data", "name_offsets", "sizes", "link_keys", "positions")
+
+    def __init__(self, base_directory, with_sizes=False, with_links=False):
+
+        """
+        Create an empty index.
+        :param base_directory: The absolute path the relative paths are relative to
+        :param with_sizes: Whether add_file is given the size of each file
+        :param with_links: Whether add_file is given the device and inode of each file with more than one link
+        """
+
+        self.base_directory = base_directory
+        # Directory paths relative to the base directory, with "" for the base directory itself
+        self.directories = []
+        self.directory_ids = array("I")
+        self.name_data = bytearray()
+        self.name_offsets = array("Q", [0])
+        self.sizes = array("q") if with_sizes else None
+        # Maps the entries of files with more than one link to their (device, inode), or None if links were not recorded
+        self.link_keys = {} if with_links else None
+        # The entries of the shared storage in this view, or None for all of them in order
+        self.positions = None
+
+    def add_directory(self, relative_directory):
+
+        """
+        :param relative_directory: The path of a directory relative to the base directory
+        :return: The id that add_file takes for files in the directory
+        """
+
+        self.directories.append(relative_directory)
+        return len(self.directories) - 1
+
+    def add_file(self, directory_id, name, size=0, link_key=None):
+
+        """
+        Add a file to the end of the index.
+        :param directory_id: The id returned by add_directory for the file's directory
+        :param name: The name of the file
+        :param size: The size of the file, kept if the index was created with sizes
+        :param link_key: The (device, inode) of the file if it has more than one link, kept if the index was created with links
+        """
+
+        if link_key is not None and self.link_keys is not None:
+            self.link_keys[len(self.directory_ids)] = link_key
+
+        self.directory_ids.append(directory_id)
+        self.name_data += os.fsencode(name)
+        self.name_offsets.append(len(self.name_data))
+        if self.sizes is not None:
+            self.sizes.append(size)
+
+    def entry(self, position):
+
+        """
+        :param position: A position in this index
+        :return: The number of the entry in the shared storage
+        """
+
+        if position < 0:
+            position += len(self)
+        return position if self.positions is None else self.positions[position]
+
+    def relative_path(self, position):
+
+        """
+        :param position: A position in this index
+        :return: The path of the file relative to the base directory
+        """
+
+        entry = self.entry(position)
+        name = os.fsdecode(bytes(self.name_data[self.name_offsets[entry]:self.name_offsets[entry + 1]]))
+        directory = self.directories[self.directory_ids[entry]]
+        return os.path.join(directory, name) if directory else name
+
+    def link_key(self, position):
+
+        """
+        :param position: A position in this index
+        :return: The (device, inode) of the file if the walk found it had more than one link, otherwise None
+        """
+
+        return self.link_keys.get(self.entry(position))
+
+    def size(self, position):
+
+        """
+        :param position: A position in this index
+        :return: The size recorded in the walk, or None if the index has no sizes
+        """
+
+        return None if self.sizes is None else self.sizes[self.entry(position)]
+
+    def subset(self, positions):
+
+        """
+        :param positions: Positions in this index, in the order wanted
+        :return: A FileIndex of those files sharing this index's storage
+        """
+
+        view = FileIndex.__new__(FileIndex)
+        view.base_directory = self.base_directory
+        view.directories = self.directories
+        view.directory_ids = self.directory_ids
+        view.name_data = self.name_data
+        view.name_offsets = self.name_offsets
+        view.sizes = self.sizes
+        view.link_keys = self.link_keys
+        view.positions = array("I", (self.entry(position) for position in positions))
+        return view
+
+    def __len__(self):
+        return len(self.directory_ids) if self.positions is None else len(self.positions)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return self.subset(range(len(self))[position])
+        if not -len(self) <= position < len(self):
+            raise IndexError("file index out of range")
+        return os.path.join(self.base_directory, self.relative_path(position))
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield os.path.join(self.base_directory, self.relative_path(position))
+
+def select_files(file_paths, positions):
+
+    """
+    Pick files from a file list by position, keeping a FileIndex compact.
+    :param file_paths: A FileIndex or a list of paths
+    :param positions: The positions wanted, in order
+    :return: The selected files, as the same kind of sequence
+    """
+
+    if isinstance(file_paths, FileIndex):
+        return file_paths.subset(positions)
+    return [file_paths[position] for position in positions]
+
+class DirectoryState:
+
+    """
+    The mtime and entry count of every directory as it was when an incremental checksum run last
+    listed it, with the names of its subdirectories. Adding or removing a file changes the mtime
+    of its directory, so a directory whose mtime has not moved since then holds no new files and
+    does not need listing again, although its subdirectories still have to be checked.
+    If a directory is ever found with the same mtime but a different number of entries, the file
+    system's mtimes cannot be trusted and every later run walks the whole tree.
+    """
+
+    def __init__(self):
+
+        """
+        Create an empty state, under which every directory is listed.
+        """
+
+        # Maps relative directory paths to [mtime in nanoseconds, inode, entry count, subdirectory names]
+        self.directories = {}
+        self.algorithms = []
+        self.reliable = True
+        # When the walk that recorded the state started, in nanoseconds since the epoch
+        self.walk_started = 0
+        self.previous_walk_started = 0
+        # The directories reached by the latest walk, listed or not
+        self.visited = set()
+        # False to list every directory while still recording them
+        self.skip_unchanged = True
+
+    def unchanged_subdirectories(self, relative_directory, directory_stat):
+
+        """
+        :param relative_directory: The path of a directory relative to the base directory
+        :param directory_stat: The result of os.stat on the directory
+        :return: The recorded subdirectory names if the directory has not changed, otherwise None
+        """
+
+        recorded = self.directories.get(relative_directory)
+        self.visited.add(relative_directory)
+        if recorded is None or not self.reliable or not self.skip_unchanged:
+            return None
+        mtime, inode, entry_count, subdirectories = recorded
+        if directory_stat.st_mtime_ns != mtime or directory_stat.st_ino != inode:
+            return None
+        if mtime >= self.previous_walk_started - DIRECTORY_MTIME_WINDOW:
+            return None
+        return subdirectories
+
+    def record(self, relative_directory, directory_path, directory_stat, entry_count, subdirectories):
+
+        """
+        Remember a directory that has just been listed.
+        :param relative_directory: The path of a directory relative to the base directory
+        :param directory_path: The absolute path of the directory
+        :param directory_stat: The result of os.stat on the directory, taken before listing it
+        :param entry_count: The number of entries the listing found
+        :param subdirectories: The names of the subdirectories the walk descends into
+        """
+
+        recorded = self.directories.get(relative_directory)
+        if recorded is not None and recorded[0] == directory_stat.st_mtime_ns and recorded[1] == directory_stat.st_ino and recorded[2] != entry_count:
+            # Only distrust the mtimes if the directory did not change while it was being listed
+            try:
+                if os.stat(directory_path).st_mtime_ns == recorded[0]:
+                    self.reliable = False
+            except OSError:
+                pass
+        self.directories[relative_directory] = [directory_stat.st_mtime_ns, directory_stat.st_ino, entry_count, subdirectories]
+
+    def forget(self, relative_directory):
+
+        """
+        Drop a directory so the next incremental run lists it again.
+        :param relative_directory: The path of a directory relative to the base directory
+        """
+
+        self.directories.pop(relative_directory, None)
+
+    def usable(self, algorithms):
+
+        """
+        :param algorithms: The algorithms of the run about to start
+        :return: Whether the state can be used to skip directories for those algorithms
+        """
+
+        return self.reliable and len(self.directories) > 0 and set(algorithms) <= set(self.algorithms)
+
+    def save(self, state_path):
+
+        """
+        Write the state atomically, so an interrupted save keeps the previous state. Directories
+        the latest walk did not reach no longer exist and are left out.
+        :param state_path: The path of the directory state file
+        """
+
+        self.directories = {relative_directory: recorded for relative_directory, recorded in self.directories.items() if relative_directory in self.visited}
+        temporary_path = state_path + ".bmtmp"
+        with open(temporary_path, "w") as state_file:
+            json.dump({
+                "format": "bmchecksum-directory-state",
+                "version": 1,
+                "algorithms": self.algorithms,
+                "reliable": self.reliable,
+                "walk_started": self.walk_started,
+                "directories": self.directories,
+            }, state_file, separators=(",", ":"))
+        os.replace(temporary_path, state_path)
+
+    @staticmethod
+    def load(state_path):
+
+        """
+        Read a directory state written by save.
+        :param state_path: The path of the directory state file
+        :return: The DirectoryState, empty if the file does not exist
+        """
+
+        directory_state = DirectoryState()
+        if not os.path.exists(state_path):
+            return directory_state
+        with open(state_path, "r") as state_file:
+            state_data = json.load(state_file)
+        if state_data.get("format") != "bmchecksum-directory-state":
+            raise ValueError(state_path + " is not a BMChecksum directory state file")
+        directory_state.directories = state_data["directories"]
+        directory_state.algorithms = state_data["algorithms"]
+        directory_state.reliable = state_data["reliable"]
+        directory_state.previous_walk_started = state_data["walk_started"]
+        return directory_state
+
+def create_file_list(absolute_path, monitor=None, with_sizes=False, directory_state=None, with_links=False):
     
     """
     Create a list of all files in the base directory and all sub-folders
     that are not in the immediate bm11-md5sums and bm11-sha1sums directories.
+    The scrub and directory state files in the base directory are also left out.
     
     :param absolute_path: The absolute base path to walk through
-    :return: List of file paths
+    :param monitor: An optional profiler, trace writer or monitor group to record the walk time in
+    :param with_sizes: Whether to also record the size of each file
+    :param directory_state: An optional DirectoryState. Directories it shows to be unchanged are not
+    listed and their files are left out, and every directory listed is recorded in it.
+    :param with_links: Whether to also record the device and inode of files with more than one link, for HardlinkTracker
+    :return: A FileIndex of the file paths, in walk order. Its directories are the ones that were listed.
     """
     
-    file_paths = []
-    for root, dirs, files in os.walk(absolute_path):
-        for file in files:
-            # Make sure that the "bm11-md5sums" and "bm11-sha1sums" directories are not traversed
-            if not root.startswith(os.path.join(absolute_path, "bm11-md5sums")) and not root.startswith(os.path.join(absolute_path, "bm11-sha1sums")):
-                file_paths.append(os.path.join(root, file))
-    return file_paths
-
-def calculate_checksum(file_path, algorithm):
+    if monitor is not None:
+        walk_start = time.perf_counter()
+    file_index = FileIndex(absolute_path, with_sizes, with_links)
+    if directory_state is not None:
+        directory_state.walk_started = time.time_ns()
+    # The same top-down order as os.walk, but using the scandir entries directly so sizes come
+    # from the entry's own stat call and the checksum folders are never entered at all
+    pending_directories = [""]
+    while pending_directories:
+        relative_directory = pending_directories.pop()
+        directory_path = os.path.join(absolute_path, relative_directory) if relative_directory else absolute_path
+        if directory_state is not None:
+            try:
+                # Taken before listing, so a change made during the listing shows up next time
+                directory_stat = os.stat(directory_path)
+            except OSError:
+                continue
+            unchanged_subdirectories = directory_state.unchanged_subdirectories(relative_directory, directory_stat)
+            if unchanged_subdirectories is not None:
+                pending_directories.extend(reversed([os.path.join(relative_directory, name) if relative_directory else name for name in unchanged_subdirectories]))
+                continue
+        try:
+            with os.scandir(directory_path) as directory_entries:
+                entries = list(directory_entries)
+        except OSError:
+            # Unreadable directories are skipped, as os.walk does
+            continue
+        directory_id = file_index.add_directory(relative_directory)
+        subdirectories = []
+        for entry in entries:
+            try:
+                is_directory = entry.is_dir()
+            except OSError:
+                is_directory = False
+            if is_directory:
+                # Make sure that the "bm11-md5sums" and "bm11-sha1sums" directories are not traversed
+                if not relative_directory and (entry.name.startswith("bm11-md5sums") or entry.name.startswith("bm11-sha1sums")):
+                    continue
+                if not entry.is_symlink():
+                    subdirectories.append(os.path.join(relative_directory, entry.name) if relative_directory else entry.name)
+                continue
+            if not relative_directory and entry.name.startswith(STATE_FILE_NAMES):
+                continue
+            file_size = 0
+            link_key = None
+            if with_sizes or with_links:
+                # One stat call gives both, and later passes over the list need none of their own
+                try:
+                    entry_stat = entry.stat()
+                    file_size = entry_stat.st_size
+                    if entry_stat.st_nlink > 1:
+                        link_key = (entry_stat.st_dev, entry_stat.st_ino)
+                except OSError:
+                    # Reading the file will report the problem
+                    pass
+            file_index.add_file(directory_id, entry.name, file_size, link_key)
+        if directory_state is not None:
+            directory_state.record(relative_directory, directory_path, directory_stat, len(entries), [os.path.basename(subdirectory) for subdirectory in subdirectories])
+        pending_directories.extend(reversed(subdirectories))
+    if monitor is not None:
+        monitor.record_phase("walk", walk_start, time.perf_counter(), absolute_path)
+    return file_index
+
+class HardlinkTracker:
+
+    """
+    Finds files in a work list that are hardlinks to the same inode, so that each inode is
+    only read once and its checksums are reused for every other path linking to it.
+    Checksums are only kept until the last link that needs them has been processed.
+    """
+
+    def __init__(self, file_paths, enabled=True, monitor=None):
+
+        """
+        Examine the work list for hardlinks.
+        :param file_paths: The ordered list of files that will be processed
+        :param enabled: False to treat every path as a separate file without examining them
+        :param monitor: An optional profiler, trace writer or monitor group to record the time taken in
+        """
+
+        # Maps each later link of an inode to the first link in the work list
+        self.link_sources = {}
+        # Counts the later links still waiting for the checksums of each first link
+        self.links_waiting = {}
+        self.saved_checksums = {}
+        self.links_reused = 0
+        self.unique_paths = file_paths
+        if not enabled:
+            return
+        links_start = time.perf_counter()
+        first_links = {}
+        for file_path, link_key in self.linked_files(file_paths):
+            first_link = first_links.setdefault(link_key, file_path)
+            if first_link != file_path:
+                self.link_sources[file_path] = first_link
+                self.links_waiting[first_link] = self.links_waiting.get(first_link, 0) + 1
+        if self.link_sources:
+            self.unique_paths = select_files(file_paths, [position for position, file_path in enumerate(file_paths) if file_path not in self.link_sources])
+        if monitor is not None:
+            monitor.record_phase("links", links_start, time.perf_counter())
+
+    @staticmethod
+    def linked_files(file_paths):
+
+        """
+        :param file_paths: The ordered list of files that will be processed
+        :return: A generator of (path, (device, inode)) tuples for the files with more than one link, in list order
+        """
+
+        if isinstance(file_paths, FileIndex) and file_paths.link_keys is not None:
+            # The walk already recorded the links, so no file needs a stat call of its own
+            if not file_paths.link_keys:
+                return
+            for position in range(len(file_paths)):
+                link_key = file_paths.link_key(position)
+                if link_key is not None:
+                    yield file_paths[position], link_key
+            return
+        for file_path in file_paths:
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                # Hashing the file will report the problem
+                continue
+            if file_stat.st_nlink > 1:
+                yield file_path, (file_stat.st_dev, file_stat.st_ino)
+
+    def cached_checksums(self, file_path):
+
+        """
+        Return the checksums already calculated for another link to the same inode.
+        :param file_path: The file about to be hashed
+        :return: The checksums of the first link, or None if the file must be hashed
+        """
+
+        first_link = self.link_sources.get(file_path)
+        if first_link is None or first_link not in self.saved_checksums:
+            # Not a later link, or the first link could not be read, so the file is hashed itself
+            return None
+        checksums = {algorithm: digest.hex() for algorithm, digest in self.saved_checksums[first_link].items()}
+        self.links_reused += 1
+        self.links_waiting[first_link] -= 1
+        if self.links_waiting[first_link] == 0:
+            del self.saved_checksums[first_link]
+            del self.links_waiting[first_link]
+        return checksums
+
+    def remember_checksums(self, file_path, checksums):
+
+        """
+        Keep the checksums of a file if later links to the same inode will need them.
+        :param file_path: The file that was hashed
+        :param checksums: Its checksums
+        """
+
+        if file_path in self.links_waiting:
+            # Kept as raw digests, which take half the memory of the hexadecimal text
+            self.saved_checksums[file_path] = {algorithm: bytes.fromhex(checksum) for algorithm, checksum in checksums.items()}
+
+class SmallFileHasher:
+
+    """
+    Hashes the small files of a FileIndex with as little work per file as possible. Each file is
+    opened with os.open relative to a descriptor of its directory, which is kept open while the
+    files of that directory are hashed, and read with a single os.read sized from the walk.
+    The hash objects are copied from empty prototypes instead of being looked up by name.
+    Only used without read-ahead or a special cache mode, where none of that work is needed.
+    A monitor is given the same open, read and hash spans as a file hashed the usual way.
+    """
+
+    def __init__(self, file_paths, algorithms, monitor=None):
+
+        """
+        :param file_paths: A FileIndex created with sizes
+        :param algorithms: List of hashing algorithms to use ("md5" and/or "sha1")
+        :param monitor: An optional profiler, trace writer or monitor group to record timings in
+        """
+
+        self.file_paths = file_paths
+        self.monitor = monitor
+        self.hash_prototypes = [hashlib.new(algorithm) for algorithm in algorithms]
+        self.directory_id = None
+        self.directory_descriptor = None
+        self.relative_open = os.open in os.supports_dir_fd
+
+    def checksums(self, position):
+
+        """
+        :param position: A position in the file index
+        :return: List of checksums in the same order as the algorithms, or None if the file is not
+        small or changed size since the walk, in which case it should be hashed the usual way
+        """
+
+        file_paths = self.file_paths
+        file_size = file_paths.size(position)
+        if file_size is None or file_size > SMALL_FILE_LIMIT:
+            return None
+        monitor = self.monitor
+        if monitor is not None:
+            open_start = time.perf_counter()
+        entry = file_paths.entry(position)
+        name = bytes(file_paths.name_data[file_paths.name_offsets[entry]:file_paths.name_offsets[entry + 1]])
+        directory_id = file_paths.directory_ids[entry]
+        if self.relative_open:
+            if directory_id != self.directory_id:
+                self.close()
+                self.directory_descriptor = os.open(os.path.join(file_paths.base_directory, file_paths.directories[directory_id]), os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+                self.directory_id = directory_id
+            file_descriptor = os.open(name, os.O_RDONLY, dir_fd=self.directory_descriptor)
+        else:
+            file_descriptor = os.open(os.path.join(os.fsencode(file_paths.base_directory), os.fsencode(file_paths.directories[directory_id]), name), os.O_RDONLY)
+        try:
+            if monitor is not None:
+                read_start = time.perf_counter()
+                file_path = os.path.join(file_paths.base_directory, file_paths.relative_path(position))
+                monitor.record_phase("open", open_start, read_start, file_path)
+            # Asking for one byte more than expected shows whether the file has grown
+            file_data = os.read(file_descriptor, file_size + 1)
+            if monitor is not None:
+                hash_start = time.perf_counter()
+                monitor.record_read(hash_start - read_start, len(file_data))
+                monitor.record_phase("read", read_start, hash_start, file_path)
+        finally:
+            os.close(file_descriptor)
+        if len(file_data) != file_size:
+            return None
+        file_hashes = [hash_prototype.copy() for hash_prototype in self.hash_prototypes]
+        for file_hash in file_hashes:
+            file_hash.update(file_data)
+        if monitor is not None:
+            monitor.record_phase("hash", hash_start, time.perf_counter(), file_path)
+        return [file_hash.hexdigest() for file_hash in file_hashes]
+
+    def close(self):
+
+        """
+        Close the directory descriptor held open, if any.
+        """
+
+        if self.directory_descriptor is not None:
+            os.close(self.directory_descriptor)
+            self.directory_descriptor = None
+            self.directory_id = None
+
+def start_small_file_hasher(file_paths, algorithms, monitor=None, reader=None, cache_mode="normal"):
+
+    """
+    :param file_paths: The file list being processed
+    :param algorithms: List of hashing algorithms to use
+    :param monitor: The monitor in use, if any, which is given the timings of the small files
+    :param reader: The ReadAheadReader in use, if any
+    :param cache_mode: The cache mode in use
+    :return: A SmallFileHasher, or None if the small file path cannot be used for this run
+    """
+
+    if SMALL_FILE_LIMIT <= 0 or reader is not None or cache_mode != "normal":
+        return None
+    if not isinstance(file_paths, FileIndex) or file_paths.sizes is None:
+        return None
+    return SmallFileHasher(file_paths, algorithms, monitor)
+
+def stop_small_file_hasher(small_files):
+
+    """
+    :param small_files: The SmallFileHasher to close, or None
+    """
+
+    if small_files is not None:
+        small_files.close()
+
+def order_file_list(file_paths, file_order="walk", monitor=None):
+
+    """
+    Sort a file list so that hashing proceeds roughly in on-disk order, which avoids seeking
+    back and forth on spinning disks.
+    "walk" keeps the os.walk order.
+    "inode" sorts by inode number, which most file systems allocate close to the file's data.
+    "extent" sorts by the physical position of the first extent of each file as reported by
+    the Linux FIEMAP ioctl, using the inode number for files where the extent is unavailable.
+
+    :param file_paths: The FileIndex or list of file paths from create_file_list
+    :param file_order: "walk", "inode" or "extent"
+    :param monitor: An optional profiler, trace writer or monitor group to record the sort time in
+    :return: The file paths in the requested order
+    """
+
+    if file_order == "walk":
+        return file_paths
+    order_start = time.perf_counter()
+    # Sort keys are packed into one integer per file: the key type in the top bits and the
+    # offset or inode number below, so that the keys fit in an array rather than tuples
+    sort_keys = array("Q")
+    for file_path in file_paths:
+        try:
+            inode = os.stat(file_path).st_ino
+        except OSError:
+            # Leave files that cannot be examined until the end, where hashing will report them
+            sort_keys.append(2 << 62)
+            continue
+        physical_offset = first_physical_offset(file_path) if file_order == "extent" else None
+        if physical_offset is not None:
+            sort_keys.append(min(physical_offset, (1 << 62) - 1))
+        else:
+            sort_keys.append((1 << 62) | min(inode, (1 << 62) - 1))
+    ordered_paths = select_files(file_paths, sorted(range(len(sort_keys)), key=sort_keys.__getitem__))
+    if monitor is not None:
+        monitor.record_phase("order", order_start, time.perf_counter())
+    return ordered_paths
+
+def first_physical_offset(file_path):
+
+    """
+    Find where the data of a file starts on the underlying device.
+    :param file_path: Path to the file
+    :return: The physical byte offset of the first extent, or None if it cannot be determined
+    """
+
+    if fcntl is None:
+        return None
+    # Ask for the mapping of the whole file, with room for a single extent
+    request = bytearray(FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(FIEMAP_EXTENT.size))
+    try:
+        with open(file_path, "rb", buffering=0) as file:
+            fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request, True)
+    except OSError:
+        return None
+    mapped_extents = FIEMAP_HEADER.unpack_from(request)[3]
+    if mapped_extents == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP_HEADER.size)[1]
+
+def calculate_checksum(file_path, algorithm, monitor=None, cancel_token=None):
     
     """
     Calculate the checksum of a file using the specified algorithm.
     
     :param file_path: Path to the file
     :param algorithm: Hashing algorithm to use ("md5" or "sha1")
+    :param monitor: An optional profiler, trace writer or monitor group to record open, read and hash timings in
+    :param cancel_token: An optional CancellationToken checked between read chunks
     :return: Checksum of the file    
     """
     
-    if algorithm == "md5":
-        file_hash = hashlib.md5()
-    elif algorithm == "sha1":
-        file_hash = hashlib.sha1()
+    return calculate_checksums(file_path, [algorithm], monitor, cancel_token)[0]
+
+def calculate_checksums(file_path, algorithms, monitor=None, cancel_token=None, reader=None, cache_mode="normal"):
+
+    """
+    Calculate the checksums of a file for several algorithms while reading the file only once.
+
+    :param file_path: Path to the file
+    :param algorithms: List of hashing algorithms to use ("md5" and/or "sha1")
+    :param monitor: An optional profiler, trace writer or monitor group to record open, read and hash timings in
+    :param cancel_token: An optional CancellationToken checked between read chunks
+    :param reader: An optional ReadAheadReader that has already been reading this file in the background
+    :param cache_mode: How the file is read with respect to the page cache, as described in read_file_chunks
+    :return: List of checksums in the same order as the algorithms
+    """
+
+    file_hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+
+    if reader is not None:
+        return calculate_read_ahead_checksums(file_path, file_hashes, reader, monitor, cancel_token)
+    if monitor is not None:
+        return calculate_monitored_checksums(file_path, file_hashes, monitor, cancel_token, cache_mode)
+    for file_chunk in read_file_chunks(file_path, cache_mode):
+        check_cancelled(cancel_token)
+        for file_hash in file_hashes:
+            file_hash.update(file_chunk)
+    return [file_hash.hexdigest() for file_hash in file_hashes]
+
+def calculate_checksums_with_retry(file_path, algorithms, monitor=None, cancel_token=None, reader=None, cache_mode="normal", message_destination=print):
+
+    """
+    Calculate the checksums of a file as calculate_checksums does, retrying reads that fail with
+    a transient error such as EIO or a network timeout. Each retry waits twice as long as the one
+    before, starting from READ_RETRY_DELAY, and reads the file directly rather than through the
+    read-ahead reader. Errors that retrying cannot fix, such as a missing file, are raised at once.
+    :param message_destination: The function to call to output each retry
+    The other parameters and the return value are as described in calculate_checksums.
+    """
 
-    with open(file_path, "rb") as file:
-        for file_chunk in iter(lambda: file.read(4096), b""):
+    retry_delay = READ_RETRY_DELAY
+    for attempt in range(READ_RETRY_LIMIT + 1):
+        try:
+            if attempt == 0:
+                return calculate_checksums(file_path, algorithms, monitor, cancel_token, reader, cache_mode)
+            return calculate_checksums(file_path, algorithms, monitor, cancel_token, None, cache_mode)
+        except OSError as error:
+            if error.errno not in TRANSIENT_ERRORS or attempt == READ_RETRY_LIMIT:
+                raise
+            output_message("Read error on " + file_path + " (" + (error.strerror or str(error)) + "). Retrying in " + str(retry_delay) + " seconds...", message_destination)
+            if monitor is not None:
+                retry_start = time.perf_counter()
+            wait_cancellable(cancel_token, retry_delay)
+            if monitor is not None:
+                monitor.record_phase("retry", retry_start, time.perf_counter(), file_path)
+            retry_delay *= 2
+
+def calculate_monitored_checksums(file_path, file_hashes, monitor, cancel_token=None, cache_mode="normal"):
+
+    """
+    Calculate checksums while timing every open, read call and hash update.
+
+    :param file_path: Path to the file
+    :param file_hashes: The hash objects to update
+    :param monitor: The profiler, trace writer or monitor group to record timings in
+    :param cancel_token: An optional CancellationToken checked between read chunks
+    :param cache_mode: How the file is read with respect to the page cache, as described in read_file_chunks
+    :return: List of checksums in the same order as the hash objects
+    """
+
+    for file_chunk in read_file_chunks(file_path, cache_mode, monitor):
+        check_cancelled(cancel_token)
+        hash_start = time.perf_counter()
+        for file_hash in file_hashes:
             file_hash.update(file_chunk)
-    return file_hash.hexdigest()
+        monitor.record_phase("hash", hash_start, time.perf_counter(), file_path)
+    return [file_hash.hexdigest() for file_hash in file_hashes]
+
+def read_file_chunks(file_path, cache_mode="normal", monitor=None):
+
+    """
+    Yield the contents of a file in chunks of READ_CHUNK_SIZE bytes.
+
+    The cache mode decides how the reads treat the page cache:
+    "normal" reads through the page cache with the default hints.
+    "scrub" tells the kernel the file is read once from start to end. Upcoming chunks are requested
+    with POSIX_FADV_WILLNEED and chunks already read are dropped with POSIX_FADV_DONTNEED, so
+    verifying a large archive does not push other services' data out of the page cache.
+    "direct" bypasses the page cache with O_DIRECT and a page-aligned buffer. File systems that do
+    not support O_DIRECT, whether they refuse the open or the first read, fall back to "scrub".
+    Platforms without these calls read normally.
+
+    :param file_path: Path to the file
+    :param cache_mode: "normal", "scrub" or "direct"
+    :param monitor: An optional profiler, trace writer or monitor group to record open and read timings in
+    :return: A generator of the chunks of the file
+    """
+
+    if cache_mode == "direct" and hasattr(os, "O_DIRECT"):
+        open_start = time.perf_counter()
+        try:
+            file_descriptor = os.open(file_path, os.O_RDONLY | os.O_DIRECT)
+        except OSError as error:
+            if error.errno != errno.EINVAL:
+                raise
+            cache_mode = "scrub"
+        else:
+            if (yield from read_direct_file_chunks(file_path, file_descriptor, open_start, monitor)):
+                return
+            cache_mode = "scrub"
+
+    open_start = time.perf_counter()
+    with open(file_path, "rb", buffering=0) as file:
+        if monitor is not None:
+            monitor.record_phase("open", open_start, time.perf_counter(), file_path)
+        advise = cache_mode != "normal" and hasattr(os, "posix_fadvise")
+        if advise:
+            file_descriptor = file.fileno()
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        offset = 0
+        while True:
+            if advise:
+                os.posix_fadvise(file_descriptor, offset + READ_CHUNK_SIZE, SCRUB_WINDOW, os.POSIX_FADV_WILLNEED)
+            read_start = time.perf_counter()
+            file_chunk = file.read(READ_CHUNK_SIZE)
+            if monitor is not None:
+                read_end = time.perf_counter()
+                monitor.record_read(read_end - read_start, len(file_chunk))
+                monitor.record_phase("read", read_start, read_end, file_path)
+            if not file_chunk:
+                break
+            yield file_chunk
+            if advise:
+                # The chunk has been hashed, so its pages are of no further use
+                os.posix_fadvise(file_descriptor, offset, len(file_chunk), os.POSIX_FADV_DONTNEED)
+            offset += len(file_chunk)
+
+def read_direct_file_chunks(file_path, file_descriptor, open_start, monitor=None):
+
+    """
+    Yield the contents of a file opened with O_DIRECT, reading into a page-aligned buffer.
+    Each chunk is copied out of the buffer so chunks can be queued by the read-ahead threads.
+
+    :param file_path: Path to the file
+    :param file_descriptor: The file descriptor opened with O_DIRECT, which is closed when done
+    :param open_start: The performance counter value before the file was opened
+    :param monitor: An optional profiler, trace writer or monitor group to record open and read timings in
+    :return: A generator of the chunks of the file, which returns False without yielding anything if the
+    file system accepted the O_DIRECT open but refused the first read, and True otherwise
+    """
+
+    try:
+        if monitor is not None:
+            monitor.record_phase("open", open_start, time.perf_counter(), file_path)
+        # Anonymous memory maps are page aligned, which satisfies the O_DIRECT alignment rules
+        with mmap.mmap(-1, READ_CHUNK_SIZE) as buffer:
+            first_read = True
+            while True:
+                read_start = time.perf_counter()
+                try:
+                    byte_count = os.readv(file_descriptor, [buffer])
+                except OSError as error:
+                    # Some file systems only reject O_DIRECT when it is first used, before any data has been yielded
+                    if first_read and error.errno == errno.EINVAL:
+                        return False
+                    raise
+                first_read = False
+                if monitor is not None:
+                    read_end = time.perf_counter()
+                    monitor.record_read(read_end - read_start, byte_count)
+                    monitor.record_phase("read", read_start, read_end, file_path)
+                if byte_count == 0:
+                    break
+                yield buffer[:byte_count]
+                # A short read means the end of the file, and the next offset would not be aligned
+                if byte_count < READ_CHUNK_SIZE:
+                    break
+    finally:
+        os.close(file_descriptor)
+    return True
+
+def calculate_read_ahead_checksums(file_path, file_hashes, reader, monitor=None, cancel_token=None):
+
+    """
+    Calculate checksums from chunks that a ReadAheadReader has already read in the background.
+    When monitored, the time spent blocked on the reader is recorded as the wait phase.
+
+    :param file_path: Path to the file, which must be the next file the reader is handling
+    :param file_hashes: The hash objects to update
+    :param reader: The ReadAheadReader reading the files
+    :param monitor: An optional profiler, trace writer or monitor group to record wait and hash timings in
+    :param cancel_token: An optional CancellationToken checked between chunks
+    :return: List of checksums in the same order as the hash objects
+    """
+
+    file_chunks = reader.file_chunks(file_path)
+    if monitor is None:
+        for file_chunk in file_chunks:
+            check_cancelled(cancel_token)
+            for file_hash in file_hashes:
+                file_hash.update(file_chunk)
+    else:
+        wait_start = time.perf_counter()
+        for file_chunk in file_chunks:
+            hash_start = time.perf_counter()
+            monitor.record_phase("wait", wait_start, hash_start, file_path)
+            check_cancelled(cancel_token)
+            for file_hash in file_hashes:
+                file_hash.update(file_chunk)
+            wait_start = time.perf_counter()
+            monitor.record_phase("hash", hash_start, wait_start, file_path)
+    return [file_hash.hexdigest() for file_hash in file_hashes]
+
+class ReadAheadReader:
+
+    """
+    Opens and reads files on background threads while the calling thread hashes earlier files,
+    so that on high-latency storage the next open and read round trips overlap with hashing.
+    Files are shared round robin between the reader threads and each thread has its own bounded
+    queue of chunks, so memory use is limited to thread_count x READ_AHEAD_DEPTH x READ_CHUNK_SIZE.
+    The files must be hashed in the order given to the reader.
+    """
+
+    def __init__(self, file_paths, thread_count=2, monitor=None, cache_mode="normal"):
+
+        """
+        Start the reader threads.
+        :param file_paths: The list of files that will be hashed, in order
+        :param thread_count: The number of files to read at the same time
+        :param monitor: An optional profiler, trace writer or monitor group to record open and read timings in
+        :param cache_mode: How files are read with respect to the page cache, as described in read_file_chunks
+        """
+
+        self.thread_count = thread_count
+        self.cache_mode = cache_mode
+        self.next_file_index = 0
+        self.stop_event = threading.Event()
+        self.chunk_queues = [queue.Queue(maxsize=READ_AHEAD_DEPTH) for _ in range(thread_count)]
+        for thread_index in range(thread_count):
+            threading.Thread(target=self.read_files, args=(file_paths[thread_index::thread_count], self.chunk_queues[thread_index], monitor),
+                name="read-ahead-" + str(thread_index), daemon=True).start()
+
+    def queue_chunk(self, chunk_queue, item):
+
+        """
+        Put an item on a chunk queue, giving up if the reader is closed while the queue is full.
+        :param chunk_queue: The queue of the current reader thread
+        :param item: A (file_path, chunk or exception) tuple
+        :return: False if the reader has been closed
+        """
+
+        while not self.stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_files(self, file_paths, chunk_queue, monitor):
+
+        """
+        Read files into a chunk queue. An empty chunk marks the end of each file and any
+        error is queued in place of the chunks so it is raised on the hashing thread.
+        :param file_paths: The files this thread is responsible for
+        :param chunk_queue: The queue of this thread
+        :param monitor: An optional profiler, trace writer or monitor group to record timings in
+        """
+
+        for file_path in file_paths:
+            try:
+                for file_chunk in read_file_chunks(file_path, self.cache_mode, monitor):
+                    if not self.queue_chunk(chunk_queue, (file_path, file_chunk)):
+                        return
+                if not self.queue_chunk(chunk_queue, (file_path, b"")):
+                    return
+            except OSError as error:
+                if not self.queue_chunk(chunk_queue, (file_path, error)):
+                    return
+
+    def file_chunks(self, file_path):
+
+        """
+        Yield the chunks of the next file in the list.
+        :param file_path: The file expected next, used to check the files are hashed in order
+        :return: A generator of the chunks of the file
+        """
+
+        chunk_queue = self.chunk_queues[self.next_file_index % self.thread_count]
+        self.next_file_index += 1
+        while True:
+            queued_path, file_chunk = chunk_queue.get()
+            if queued_path != file_path:
+                raise RuntimeError("Read-ahead expected " + queued_path + " but " + file_path + " was requested")
+            if isinstance(file_chunk, Exception):
+                raise file_chunk
+            if not file_chunk:
+                return
+            yield file_chunk
+
+    def close(self):
+
+        """
+        Stop the reader threads. Files already queued are discarded.
+        """
+
+        self.stop_event.set()
+
+def start_read_ahead(file_paths, thread_count, monitor=None, cache_mode="normal"):
+
+    """
+    Create a ReadAheadReader if read-ahead was requested.
+    :param file_paths: The list of files that will be hashed, in order
+    :param thread_count: The number of reader threads, or 0 to read on the hashing thread
+    :param monitor: An optional profiler, trace writer or monitor group to record timings in
+    :param cache_mode: How files are read with respect to the page cache, as described in read_file_chunks
+    :return: A ReadAheadReader, or None if read-ahead is off
+    """
+
+    if thread_count > 0 and len(file_paths) > 0:
+        return ReadAheadReader(file_paths, thread_count, monitor, cache_mode)
+    return None
+
+def stop_read_ahead(reader):
+
+    """
+    Close an optional ReadAheadReader.
+    :param reader: A ReadAheadReader or None
+    """
+
+    if reader is not None:
+        reader.close()
+
+def write_checksum_file(checksum_path, checksum):
+
+    """
+    Write a checksum file atomically by writing a temporary file next to it and renaming it
+    into place, so an interrupted write never leaves a truncated checksum in the store.
+    :param checksum_path: The path of the checksum file
+    :param checksum: The checksum to store
+    """
+
+    temporary_path = checksum_path + ".bmtmp"
+    with open(temporary_path, "w") as checksum_file:
+        checksum_file.write(checksum)
+    os.replace(temporary_path, checksum_path)
 
 def output_message(message, output_destination=print):
 
@@ -0,0 +1,528 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+import core as bmc
+import dataclasses
+import json
+import os
+import session
+import socket
+import socketserver
+import stat
+import threading
+import time
+from datetime import datetime
+
+# The longest request line the daemon reads, which is far more than any valid request needs
+MAX_REQUEST_SIZE = 1048576
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+# Reserved by JSON-RPC 2.0 for server errors, used when the operation itself fails
+OPERATION_ERROR = -32000
+
+# The parameters each queued method accepts, with their types and defaults. base_directory is required by all of them
+QUEUED_METHODS = {
+    "verify": {"trust_cache": (bool, False), "include_ok": (bool, False)},
+    "verify_file": {"file": (str, None), "trust_cache": (bool, False)},
+    "verify_subdirectories": {"trust_cache": (bool, False), "include_ok": (bool, False)},
+    "create": {"mode": (int, 0), "include_existing": (bool, False)},
+}
+# The methods answered straight away instead of waiting in the queue
+IMMEDIATE_METHODS = ("ping", "status", "shutdown")
+
+class DaemonError(Exception):
+
+    """
+    An error response from the daemon, or a request it could not be sent. The code is one of the
+    JSON-RPC error codes above, or None if the daemon could not be reached.
+    """
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+def default_socket_path():
+
+    """
+    :return: The socket used when --socket is not given, under XDG_RUNTIME_DIR where it is set
+    """
+
+    runtime_directory = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_directory:
+        return os.path.join(runtime_directory, "bmchecksum.sock")
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(data_home, "bmchecksum", "daemon.sock")
+
+def validate_params(method, params):
+
+    """
+    Check the parameters of a queued method and fill in their defaults.
+    :param method: One of QUEUED_METHODS
+    :param params: The params member of the request, which may be missing
+    :return: The complete parameters, with the base directory normalised
+    :raises ValueError: If a parameter is missing, unknown or of the wrong type
+    """
+
+    if params is None:
+        params = {}
+    if not isinstance(params, dict):
+        raise ValueError("params must be an object")
+    accepted = QUEUED_METHODS[method]
+    for name in params:
+        if name != "base_directory" and name not in accepted:
+            raise ValueError("Unknown parameter: " + name)
+    base_directory = params.get("base_directory")
+    # The daemon's working directory means nothing to the client, so relative paths are refused
+    if not isinstance(base_directory, str) or not os.path.isabs(base_directory):
+        raise ValueError("base_directory must be an absolute path")
+    base_directory = os.path.normpath(base_directory)
+    if not os.path.isdir(base_directory):
+        raise ValueError("base_directory is not a directory: " + base_directory)
+    complete = {"base_directory": base_directory}
+    for name, (value_type, default) in accepted.items():
+        value = params.get(name, default)
+        # bool is a subclass of int, so check it separately for integer parameters
+        if value is None or not isinstance(value, value_type) or (value_type is int and isinstance(value, bool)):
+            raise ValueError(name + " must be " + ("a boolean" if value_type is bool else "an integer" if value_type is int else "a string"))
+        complete[name] = value
+    if method == "create" and complete["mode"] not in (0, 1, 2):
+        raise ValueError("mode must be 0 (MD5 and SHA-1), 1 (MD5) or 2 (SHA-1)")
+    return complete
+
+def summary_result(summary):
+
+    """
+    :param summary: A summary dataclass, or a list of them
+    :return: The summary as plain JSON values, with its ok property included
+    """
+
+    if isinstance(summary, list):
+        return [summary_result(item) for item in summary]
+    result = dataclasses.asdict(summary)
+    if hasattr(summary, "ok"):
+        result["ok"] = summary.ok
+    return result
+
+class QueuedRequest:
+
+    """
+    One operation waiting for or being run by the scheduler, shared by every identical request
+    that arrived while it was still waiting.
+    """
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.key = (method, json.dumps(params, sort_keys=True))
+        self.callers = 1
+        self.finished = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+
+        """
+        Wait for the operation to finish.
+        :return: The result, as plain JSON values
+        :raises DaemonError: If the operation failed or was never run
+        """
+
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class RequestScheduler:
+
+    """
+    Runs queued requests one at a time, in the order they arrived, on one thread. Every operation
+    goes through the shared ChecksumSession, so its hashing threads and cache are never contended
+    by two trees at once. A request identical to one still waiting in the queue, with the same
+    method, base directory and parameters, is merged with it and gets the same result. A request
+    identical to one already running is queued afresh, since files may have changed after the
+    running operation read them.
+    """
+
+    def __init__(self, checksum_session, cancel_token):
+
+        """
+        Start the scheduler thread.
+        :param checksum_session: The ChecksumSession that runs the operations
+        :param cancel_token: The CancellationToken that stops the daemon, also passed to each operation
+        """
+
+        self.checksum_session = checksum_session
+        self.cancel_token = cancel_token
+        self.queue = collections.deque()
+        self.waiting = {}
+        self.running = None
+        self.running_since = None
+        self.requests_run = 0
+        self.requests_merged = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="bmchecksum-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, method, params):
+
+        """
+        Queue an operation, or join an identical one that is still waiting.
+        :param method: One of QUEUED_METHODS
+        :param params: The parameters returned by validate_params
+        :return: The QueuedRequest to wait on
+        """
+
+        queued_request = QueuedRequest(method, params)
+        with self.condition:
+            if self.stopped:
+                queued_request.error = DaemonError("The daemon is shutting down", OPERATION_ERROR)
+                queued_request.finished.set()
+                return queued_request
+            existing = self.waiting.get(queued_request.key)
+            if existing is not None:
+                existing.callers += 1
+                self.requests_merged += 1
+                return existing
+            self.waiting[queued_request.key] = queued_request
+            self.queue.append(queued_request)
+            self.condition.notify()
+        return queued_request
+
+    def execute(self, queued_request):
+
+        """
+        Run one operation on the session.
+        :param queued_request: The QueuedRequest to run
+        :return: The result, as plain JSON values
+        """
+
+        params = queued_request.params
+        base_directory = params["base_directory"]
+        if queued_request.method == "verify":
+            summary = self.checksum_session.verify(base_directory, params["trust_cache"], params["include_ok"], self.cancel_token)
+        elif queued_request.method == "verify_file":
+            summary = self.checksum_session.verify_file(base_directory, params["file"], params["trust_cache"], self.cancel_token)
+        elif queued_request.method == "verify_subdirectories":
+            summary = self.checksum_session.verify_subdirectories(base_directory, params["trust_cache"], params["include_ok"], self.cancel_token)
+        else:
+            summary = self.checksum_session.create(base_directory, params["mode"], params["include_existing"], self.cancel_token)
+        return summary_result(summary)
+
+    def run(self):
+
+        """
+        Take requests from the queue and run them until the scheduler is stopped.
+        """
+
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                queued_request = self.queue.popleft()
+                # Once it starts, later identical requests must not share its result
+                del self.waiting[queued_request.key]
+                self.running = queued_request
+                self.running_since = time.time()
+            try:
+                queued_request.result = self.execute(queued_request)
+            except ValueError as error:
+                queued_request.error = DaemonError(str(error), INVALID_PARAMS)
+            except OSError as error:
+                queued_request.error = DaemonError(str(error), OPERATION_ERROR)
+            except Exception as error:
+                queued_request.error = DaemonError("Unexpected error: " + str(error), INTERNAL_ERROR)
+            with self.condition:
+                self.running = None
+                self.running_since = None
+                self.requests_run += 1
+            queued_request.finished.set()
+
+    def status(self):
+
+        """
+        :return: The state of the scheduler, as plain JSON values
+        """
+
+        with self.condition:
+            running = None
+            if self.running is not None:
+                running = {"method": self.running.method, "base_directory": self.running.params["base_directory"], "callers": self.running.callers, "seconds": round(time.time() - self.running_since, 3)}
+            return {
+                "running": running,
+                "queued": [{"method": queued_request.method, "base_directory": queued_request.params["base_directory"], "callers": queued_request.callers} for queued_request in self.queue],
+                "requests_run": self.requests_run,
+                "requests_merged": self.requests_merged,
+                "cached_digests": len(self.checksum_session.digests.entries),
+                "cached_trees": len(self.checksum_session.trees.entries),
+            }
+
+    def stop(self):
+
+        """
+        Stop taking requests, fail the ones still waiting and wait for the running one, which
+        stops after its current file once the cancel token is cancelled.
+        """
+
+        with self.condition:
+            self.stopped = True
+            abandoned = list(self.queue)
+            self.queue.clear()
+            self.waiting.clear()
+            self.condition.notify()
+        for queued_request in abandoned:
+            queued_request.error = DaemonError("The daemon is shutting down", OPERATION_ERROR)
+            queued_request.finished.set()
+        self.thread.join()
+
+def error_response(request_id, code, message):
+
+    """
+    :param request_id: The id of the request, or None if it could not be read
+    :param code: The JSON-RPC error code
+    :param message: A description of the error
+    :return: A JSON-RPC error response
+    """
+
+    return {"jsonrpc": "2.0", "error": {"code": code, "message": message}, "id": request_id}
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    """
+    Reads newline-delimited JSON-RPC 2.0 requests from one connection and writes a response line
+    for each, in order. Notifications, which have no id, are run without a response.
+    """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_SIZE)
+            if not line:
+                return
+            if not line.endswith(b"\n") and len(line) >= MAX_REQUEST_SIZE:
+                self.send(error_response(None, INVALID_REQUEST, "The request is too long"))
+                return
+            if not line.strip():
+                continue
+            response = self.server.daemon.handle_request(line)
+            if response is not None:
+                self.send(response)
+
+    def send(self, response):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+class ChecksumDaemon:
+
+    """
+    A long-running service that answers verify and create requests over a Unix socket. The
+    ChecksumSession it holds keeps the file list of each tree and file digests in memory between
+    requests, so a tree none of whose directories has changed is not walked again. Verification
+    still reads every file unless a request asks to trust the cache.
+    Only the user running the daemon can connect, as the socket is created with mode 0600.
+    """
+
+    def __init__(self, socket_path, workers=None, cache_size=session.DEFAULT_CACHE_SIZE, cancel_token=None):
+
+        """
+        Bind the socket and start the session and scheduler. Call serve to start answering requests.
+        :param socket_path: The Unix socket to listen on
+        :param workers: The number of files hashed at once, as in ChecksumSession
+        :param cache_size: The number of file digests to remember, as in ChecksumSession
+        :param cancel_token: An optional CancellationToken that stops the daemon
+        :raises DaemonError: If another daemon is already listening on the socket
+        """
+
+        self.socket_path = socket_path
+        self.cancel_token = cancel_token or bmc.CancellationToken()
+        self.start_time = time.time()
+        remove_stale_socket(socket_path)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o700, exist_ok=True)
+        previous_umask = os.umask(0o077)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(socket_path, RequestHandler)
+        finally:
+            os.umask(previous_umask)
+        self.server.daemon_threads = True
+        self.server.daemon = self
+        self.checksum_session = session.ChecksumSession(workers, cache_size)
+        self.scheduler = RequestScheduler(self.checksum_session, self.cancel_token)
+        self.server_thread = None
+
+    def handle_request(self, line):
+
+        """
+        Answer one request line.
+        :param line: The bytes of the request, without its newline
+        :return: The response, or None for a notification
+        """
+
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return error_response(None, PARSE_ERROR, "Parse error: " + str(error))
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" or not isinstance(request.get("method"), str):
+            return error_response(request.get("id") if isinstance(request, dict) else None, INVALID_REQUEST, "Not a JSON-RPC 2.0 request")
+        request_id = request.get("id")
+        notification = "id" not in request
+        method = request["method"]
+        try:
+            if method == "ping":
+                result = "pong"
+            elif method == "status":
+                result = self.scheduler.status()
+                result["uptime_seconds"] = round(time.time() - self.start_time, 3)
+            elif method == "shutdown":
+                self.cancel_token.cancel()
+                result = True
+            elif method in QUEUED_METHODS:
+                try:
+                    params = validate_params(method, request.get("params"))
+                except ValueError as error:
+                    raise DaemonError(str(error), INVALID_PARAMS)
+                queued_request = self.scheduler.submit(method, params)
+                if notification:
+                    return None
+                result = queued_request.wait()
+            else:
+                raise DaemonError("Method not found: " + method, METHOD_NOT_FOUND)
+        except DaemonError as error:
+            return None if notification else error_response(request_id, error.code, str(error))
+        return None if notification else {"jsonrpc": "2.0", "result": result, "id": request_id}
+
+    def serve(self):
+
+        """
+        Answer requests on background threads until the cancel token is cancelled, then stop.
+        """
+
+        self.server_thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.5}, name="bmchecksum-daemon", daemon=True)
+        self.server_thread.start()
+        # A timed wait lets Ctrl-C be handled promptly on the main thread
+        while not self.cancel_token.cancel_event.wait(1.0):
+            pass
+        self.close()
+
+    def close(self):
+
+        """
+        Stop listening, finish the running operation and remove the socket.
+        """
+
+        if self.server_thread is not None:
+            self.server.shutdown()
+            self.server_thread = None
+        self.scheduler.stop()
+        self.server.server_close()
+        self.checksum_session.close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+def remove_stale_socket(socket_path):
+
+    """
+    Remove a socket left behind by a daemon that did not stop cleanly.
+    :param socket_path: The Unix socket the daemon will listen on
+    :raises DaemonError: If a daemon is still listening on the socket, or something other than a socket is in the way
+    """
+
+    try:
+        socket_stat = os.lstat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(socket_stat.st_mode):
+        raise DaemonError(socket_path + " exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(socket_path)
+        return
+    finally:
+        probe.close()
+    raise DaemonError("A daemon is already listening on " + socket_path)
+
+def request(method, params=None, socket_path=None, timeout=None):
+
+    """
+    Send one request to a running daemon and wait for its result.
+    :param method: The method to call, such as "verify"
+    :param params: The parameters of the method, which for queued methods include an absolute base_directory
+    :param socket_path: The daemon's socket, by default default_socket_path()
+    :param timeout: Seconds to wait for the result, or None to wait as long as the operation takes
+    :return: The result of the method
+    :raises DaemonError: If the daemon could not be reached or returned an error
+    """
+
+    socket_path = socket_path or default_socket_path()
+    message = {"jsonrpc": "2.0", "method": method, "id": 1}
+    if params is not None:
+        message["params"] = params
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(timeout)
+            client.connect(socket_path)
+            client.sendall(json.dumps(message).encode("utf-8") + b"\n")
+            with client.makefile("rb") as response_file:
+                line = response_file.readline()
+    except OSError as error:
+        raise DaemonError("Could not reach the daemon on " + socket_path + ": " + str(error))
+    if not line:
+        raise DaemonError("The daemon closed the connection without responding")
+    response = json.loads(line)
+    if "error" in response:
+        raise DaemonError(response["error"]["message"], response["error"]["code"])
+    return response["result"]
+
+def start_daemon_process(socket_path=None, message_destination=print, workers=None, cache_size=session.DEFAULT_CACHE_SIZE, cancel_token=None):
+
+    """
+    Run the daemon until it is cancelled or asked to shut down.
+    :param socket_path: The Unix socket to listen on, by default default_socket_path()
+    :param message_destination: The function to call to output the message
+    :param workers: The number of files hashed at once, as in ChecksumSession
+    :param cache_size: The number of file digests to remember, as in ChecksumSession
+    :param cancel_token: An optional CancellationToken that stops the daemon
+    :return: The number of requests run, or None if the daemon could not start
+    """
+
+    try:
+        socket_path = socket_path or default_socket_path()
+        try:
+            checksum_daemon = ChecksumDaemon(socket_path, workers, cache_size, cancel_token)
+        except (DaemonError, OSError) as error:
+            bmc.output_message("* Could not start the daemon: " + str(error) + "\n", message_destination)
+            return None
+        start_date = datetime.now()
+        bmc.output_message("Listening for requests on " + socket_path + ". Press Ctrl-C to stop.\n", message_destination)
+        checksum_daemon.serve()
+        requests_run = checksum_daemon.scheduler.requests_run
+        time_elapsed = datetime.now() - start_date
+        bmc.output_message("\nDaemon stopped. " + str(requests_run) + " request(s) run and " + str(checksum_daemon.scheduler.requests_merged) + " merged with a queued request in " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        return requests_run
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
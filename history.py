@@ -0,0 +1,400 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import heapq
+import json
+import math
+import os
+import statistics
+import threading
+from datetime import datetime
+
+# Only files at least this large count towards a device's sustained throughput, as the read
+# time of smaller files is dominated by seeks and open calls rather than transfer speed
+SUSTAINED_FILE_SIZE = 1048576
+# The read latency histogram has this many buckets for every doubling of the latency
+LATENCY_BUCKETS_PER_DOUBLING = 8
+# The number of slowest files kept for each run
+SLOWEST_FILE_COUNT = 10
+# The report compares the median of the latest runs of a device with the median of the runs before them
+RECENT_RUNS = 3
+BASELINE_MINIMUM_RUNS = 3
+# A device is flagged when its throughput falls by this fraction, or its 99th percentile latency
+# grows by this factor and is above the floor, compared with its baseline
+THROUGHPUT_DROP = 0.25
+LATENCY_RISE = 2.0
+LATENCY_FLOOR = 0.001
+
+def default_history_path():
+
+    """
+    :return: The history file used when --history is given without a file, under XDG_DATA_HOME
+    """
+
+    data_home = os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share")
+    return os.path.join(data_home, "bmchecksum", "history.jsonl")
+
+def read_mount_sources():
+
+    """
+    :return: A dictionary mapping device numbers to the device or share each is mounted from, empty where /proc is unavailable
+    """
+
+    mount_sources = {}
+    try:
+        with open("/proc/self/mountinfo", "r") as mountinfo_file:
+            for line in mountinfo_file:
+                fields = line.split()
+                if " - " not in line or len(fields) < 3:
+                    continue
+                major, minor = fields[2].split(":")
+                source = line.split(" - ", 1)[1].split()
+                mount_sources.setdefault(os.makedev(int(major), int(minor)), source[1] if len(source) > 1 else source[0])
+    except (OSError, ValueError):
+        pass
+    return mount_sources
+
+def latency_bucket(seconds):
+
+    """
+    :param seconds: The time a read call took
+    :return: The histogram bucket the latency falls in, counting from 1 microsecond
+    """
+
+    microseconds = seconds * 1000000
+    if microseconds <= 1:
+        return 0
+    return int(math.log2(microseconds) * LATENCY_BUCKETS_PER_DOUBLING) + 1
+
+def latency_percentile(histogram, fraction):
+
+    """
+    :param histogram: A dictionary mapping latency buckets to read counts
+    :param fraction: The percentile wanted, from 0 to 1
+    :return: The upper bound in seconds of the bucket holding the percentile, or None if the histogram is empty
+    """
+
+    total_reads = sum(histogram.values())
+    if total_reads == 0:
+        return None
+    target = fraction * total_reads
+    running_total = 0
+    for bucket in sorted(histogram):
+        running_total += histogram[bucket]
+        if running_total >= target:
+            return round(2 ** (bucket / LATENCY_BUCKETS_PER_DOUBLING) / 1000000, 9)
+    return round(2 ** (max(histogram) / LATENCY_BUCKETS_PER_DOUBLING) / 1000000, 9)
+
+class ThroughputRecorder:
+
+    """
+    A monitor, used like OperationProfiler, that collects the read throughput and read latencies
+    of each device and each top level directory of a run, and the slowest files, so they can be
+    appended to the history once the run is over.
+    """
+
+    def __init__(self, base_directory, operation):
+
+        """
+        Create an empty recorder.
+        :param base_directory: The absolute base path of the run
+        :param operation: The name of the operation, such as "verify" or "scrub"
+        """
+
+        self.base_directory = base_directory
+        self.operation = operation
+        self.mount_sources = read_mount_sources()
+        # Device names by directory, so each directory is only examined once
+        self.directory_devices = {}
+        # Read seconds and bytes of files still being read, by file path
+        self.file_reads = {}
+        self.devices = {}
+        self.directories = {}
+        self.slowest_files = []
+        self.first_time = None
+        self.last_time = None
+        self.read_bytes = threading.local()
+        self.lock = threading.Lock()
+
+    def device_name(self, file_path):
+
+        """
+        :param file_path: A file being read
+        :return: A name for the device holding the file
+        """
+
+        directory_path = os.path.dirname(file_path)
+        device = self.directory_devices.get(directory_path)
+        if device is None:
+            try:
+                device_number = os.stat(directory_path).st_dev
+                device = self.mount_sources.get(device_number) or ("device " + str(os.major(device_number)) + ":" + str(os.minor(device_number)))
+            except (OSError, AttributeError):
+                device = "unknown"
+            self.directory_devices[directory_path] = device
+        return device
+
+    def device_totals(self, device):
+
+        """
+        :param device: A device name
+        :return: The running totals of the device, created if needed
+        """
+
+        return self.devices.setdefault(device, {"files": 0, "bytes": 0, "read_seconds": 0.0, "sustained_bytes": 0, "sustained_seconds": 0.0, "latencies": {}})
+
+    def record_phase(self, phase, start_time, end_time, file_path=None):
+
+        """
+        Note the time of each read call against its file and device.
+        The parameters are as described in OperationProfiler.record_phase.
+        """
+
+        if phase != "read" or file_path is None:
+            return
+        # record_read is always called just before on the same thread, with the size of the same read
+        byte_count = getattr(self.read_bytes, "pending", 0)
+        self.read_bytes.pending = 0
+        with self.lock:
+            file_read = self.file_reads.setdefault(file_path, [0.0, 0])
+            file_read[0] += end_time - start_time
+            file_read[1] += byte_count
+            latencies = self.device_totals(self.device_name(file_path))["latencies"]
+            bucket = latency_bucket(end_time - start_time)
+            latencies[bucket] = latencies.get(bucket, 0) + 1
+            self.update_time_span(start_time, end_time)
+
+    def record_read(self, seconds, byte_count):
+
+        """
+        Keep the size of a read call until record_phase reports which file it belonged to.
+        The parameters are as described in OperationProfiler.record_read.
+        """
+
+        self.read_bytes.pending = byte_count
+
+    def record_file(self, file_path, start_time, end_time):
+
+        """
+        Add a finished file to the totals of its device and directory.
+        The parameters are as described in OperationProfiler.record_file.
+        """
+
+        with self.lock:
+            self.update_time_span(start_time, end_time)
+            read_seconds, byte_count = self.file_reads.pop(file_path, (0.0, 0))
+            device = self.device_totals(self.device_name(file_path))
+            device["files"] += 1
+            device["bytes"] += byte_count
+            device["read_seconds"] += read_seconds
+            if byte_count >= SUSTAINED_FILE_SIZE:
+                device["sustained_bytes"] += byte_count
+                device["sustained_seconds"] += read_seconds
+            relative_path = os.path.relpath(file_path, self.base_directory)
+            top_directory = relative_path.split(os.sep)[0] if os.sep in relative_path else "."
+            directory = self.directories.setdefault(top_directory, {"files": 0, "bytes": 0, "read_seconds": 0.0})
+            directory["files"] += 1
+            directory["bytes"] += byte_count
+            directory["read_seconds"] += read_seconds
+            entry = (end_time - start_time, file_path)
+            if len(self.slowest_files) < SLOWEST_FILE_COUNT:
+                heapq.heappush(self.slowest_files, entry)
+            elif entry > self.slowest_files[0]:
+                heapq.heapreplace(self.slowest_files, entry)
+
+    def record_directory(self, directory_path, start_time, end_time):
+
+        """
+        Accept the span covering a whole subdirectory verification, which adds nothing to the history.
+        """
+
+        pass
+
+    def record_problem(self, category, file_path=None):
+
+        """
+        Accept a problem found by the operation, which adds nothing to the history.
+        """
+
+        pass
+
+    def update_time_span(self, start_time, end_time):
+
+        """
+        Widen the overall time span covered by the recorded events.
+        :param start_time: The start of the latest event
+        :param end_time: The end of the latest event
+        """
+
+        if self.first_time is None or start_time < self.first_time:
+            self.first_time = start_time
+        if self.last_time is None or end_time > self.last_time:
+            self.last_time = end_time
+
+    def history_entry(self):
+
+        """
+        :return: A dictionary describing the run, as stored in the history
+        """
+
+        devices = {}
+        for device, totals in self.devices.items():
+            latencies = totals["latencies"]
+            devices[device] = {
+                "files": totals["files"],
+                "bytes": totals["bytes"],
+                "read_seconds": round(totals["read_seconds"], 6),
+                "mb_per_second": round(totals["bytes"] / totals["read_seconds"] / 1048576, 3) if totals["read_seconds"] > 0 else None,
+                "sustained_mb_per_second": round(totals["sustained_bytes"] / totals["sustained_seconds"] / 1048576, 3) if totals["sustained_seconds"] > 0 else None,
+                "reads": sum(latencies.values()),
+                "latency_p50": latency_percentile(latencies, 0.5),
+                "latency_p95": latency_percentile(latencies, 0.95),
+                "latency_p99": latency_percentile(latencies, 0.99),
+            }
+        directories = {}
+        for directory, totals in self.directories.items():
+            directories[directory] = {
+                "files": totals["files"],
+                "bytes": totals["bytes"],
+                "mb_per_second": round(totals["bytes"] / totals["read_seconds"] / 1048576, 3) if totals["read_seconds"] > 0 else None,
+            }
+        return {
+            "format": "bmchecksum-history",
+            "version": 1,
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "operation": self.operation,
+            "base_directory": self.base_directory,
+            "seconds": round(self.last_time - self.first_time, 3) if self.first_time is not None else 0.0,
+            "devices": devices,
+            "directories": directories,
+            "slowest_files": [[round(seconds, 6), file_path] for seconds, file_path in sorted(self.slowest_files, reverse=True)],
+        }
+
+def append_history(history_path, recorder):
+
+    """
+    Add a run to the end of the history file, creating the file if needed. Runs that read nothing are not added.
+    :param history_path: The history file, which holds one JSON object per line
+    :param recorder: The ThroughputRecorder that watched the run
+    :return: True if the run was added
+    """
+
+    entry = recorder.history_entry()
+    if len(entry["devices"]) == 0:
+        return False
+    history_directory = os.path.dirname(history_path)
+    if history_directory:
+        os.makedirs(history_directory, exist_ok=True)
+    # A single write of a whole line keeps concurrent runs from interleaving their entries
+    with open(history_path, "a") as history_file:
+        history_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+    return True
+
+def load_history(history_path):
+
+    """
+    :param history_path: The history file
+    :return: The runs in the history, oldest first. Lines that cannot be read, such as one cut short by a crash, are skipped.
+    """
+
+    entries = []
+    with open(history_path, "r") as history_file:
+        for line in history_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and entry.get("format") == "bmchecksum-history":
+                entries.append(entry)
+    return entries
+
+def format_latency(seconds):
+
+    """
+    :param seconds: A latency in seconds, or None
+    :return: The latency in milliseconds for the report
+    """
+
+    return "-" if seconds is None else format(seconds * 1000, ".2f") + " ms"
+
+def start_history_report(history_path, message_destination=print):
+
+    """
+    Compare the latest runs of every device in the history with its earlier runs, and flag
+    devices whose read throughput has dropped or whose tail latency has grown. A disk that is
+    starting to fail usually slows down well before it returns data that fails a checksum.
+    The sustained throughput of large files is used where a run read any, and the throughput
+    of all files otherwise.
+    :param history_path: The history file
+    :param message_destination: The function to call to output the message
+    :return: The number of devices flagged, or None if there is no history or the report failed
+    """
+
+    try:
+        if not os.path.exists(history_path):
+            bmc.output_message("No history could be found at " + history_path + ". Aborting...\n", message_destination)
+            return None
+        entries = load_history(history_path)
+        device_runs = {}
+        for entry in entries:
+            for device, figures in entry["devices"].items():
+                throughput = figures.get("sustained_mb_per_second") or figures.get("mb_per_second")
+                if throughput is None:
+                    continue
+                device_runs.setdefault(device, []).append((throughput, figures.get("latency_p99"), entry))
+        if len(device_runs) == 0:
+            bmc.output_message("The history at " + history_path + " holds no read timings. Aborting...\n", message_destination)
+            return None
+        bmc.output_message("Read throughput history of " + str(len(device_runs)) + " device(s) over " + str(len(entries)) + " run(s):\n", message_destination)
+        devices_flagged = 0
+        for device, runs in sorted(device_runs.items()):
+            bmc.output_message(device + " (" + str(len(runs)) + " runs, last on " + runs[-1][2]["time"].replace("T", " ") + ")", message_destination)
+            baseline_runs = runs[:-RECENT_RUNS]
+            recent_runs = runs[-RECENT_RUNS:]
+            recent_throughput = statistics.median(run[0] for run in recent_runs)
+            recent_latencies = [run[1] for run in recent_runs if run[1] is not None]
+            recent_latency = statistics.median(recent_latencies) if recent_latencies else None
+            if len(baseline_runs) < BASELINE_MINIMUM_RUNS:
+                bmc.output_message("  Recent: " + format(recent_throughput, ".1f") + " MB/s, 99th percentile read " + format_latency(recent_latency), message_destination)
+                bmc.output_message("  Not enough runs for a baseline yet (" + str(BASELINE_MINIMUM_RUNS + RECENT_RUNS) + " needed)\n", message_destination)
+                continue
+            baseline_throughput = statistics.median(run[0] for run in baseline_runs)
+            baseline_latencies = [run[1] for run in baseline_runs if run[1] is not None]
+            baseline_latency = statistics.median(baseline_latencies) if baseline_latencies else None
+            bmc.output_message("  Baseline: " + format(baseline_throughput, ".1f") + " MB/s, 99th percentile read " + format_latency(baseline_latency), message_destination)
+            bmc.output_message("  Recent: " + format(recent_throughput, ".1f") + " MB/s, 99th percentile read " + format_latency(recent_latency), message_destination)
+            flagged = False
+            if recent_throughput < baseline_throughput * (1 - THROUGHPUT_DROP):
+                bmc.output_message("* Read throughput has dropped by " + format((1 - recent_throughput / baseline_throughput) * 100, ".0f") + "% on " + device, message_destination)
+                flagged = True
+            if recent_latency is not None and baseline_latency is not None and recent_latency > LATENCY_FLOOR and recent_latency > baseline_latency * LATENCY_RISE:
+                bmc.output_message("* Tail read latency has grown " + format(recent_latency / baseline_latency, ".1f") + " times on " + device, message_destination)
+                flagged = True
+            if flagged:
+                devices_flagged += 1
+                slowest_files = runs[-1][2].get("slowest_files", [])[:3]
+                if slowest_files:
+                    bmc.output_message("  Slowest files of the last run:", message_destination)
+                    for seconds, file_path in slowest_files:
+                        bmc.output_message("  " + format(seconds, "10.3f") + "s  " + file_path, message_destination)
+            bmc.output_message("", message_destination)
+        bmc.output_message("Devices flagged: " + str(devices_flagged) + "\n", message_destination)
+        return devices_flagged
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
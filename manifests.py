@@ -0,0 +1,234 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import os
+import re
+import sys
+from datetime import datetime
+
+# The checksum folder and extension used for each algorithm the checksum store holds
+STORE_LAYOUT = {"md5": ("bm11-md5sums", ".md5"), "sha1": ("bm11-sha1sums", ".sha1")}
+# The algorithm names used by the BSD tag format, as written by md5sum --tag and friends
+TAG_NAMES = {"md5": "MD5", "sha1": "SHA1"}
+# Digest lengths in hexadecimal characters, used to tell the algorithm of an untagged line
+DIGEST_LENGTHS = {32: "md5", 40: "sha1", 56: "sha224", 64: "sha256", 96: "sha384", 128: "sha512"}
+# The expected digest length of each algorithm, used to check tagged lines
+ALGORITHM_LENGTHS = {algorithm: length for length, algorithm in DIGEST_LENGTHS.items()}
+
+TAG_LINE = re.compile(rb"^(\\?)([A-Z0-9-]+) \((.*)\) = ([0-9a-fA-F]+)$")
+UNTAGGED_LINE = re.compile(rb"^(\\?)([0-9a-fA-F]+) [ *](.*)$")
+
+def unescape_manifest_name(name):
+
+    """
+    Undo the escaping coreutils applies to file names holding a backslash, newline or carriage return.
+    :param name: The escaped name as bytes
+    :return: The original name as bytes
+    """
+
+    return re.sub(rb"\\(.)", lambda match: {b"n": b"\n", b"r": b"\r"}.get(match.group(1), match.group(1)), name)
+
+def escape_manifest_name(name):
+
+    """
+    Escape a file name the way coreutils does.
+    :param name: The file name as bytes
+    :return: The escaped name and whether the line must start with a backslash
+    """
+
+    if b"\\" not in name and b"\n" not in name and b"\r" not in name:
+        return name, False
+    return name.replace(b"\\", b"\\\\").replace(b"\n", b"\\n").replace(b"\r", b"\\r"), True
+
+def parse_manifest_line(line):
+
+    """
+    Read one line of a md5sum, sha1sum or sha256sum style manifest, in either the default or the BSD tag format.
+    :param line: The line as bytes, without its line ending
+    :return: An (algorithm, digest, path) tuple with the path as bytes, or None if the line is not recognised
+    """
+
+    match = TAG_LINE.match(line)
+    if match:
+        escaped, tag_name, name, digest = match.groups()
+        algorithm = tag_name.decode("ascii").lower().replace("-", "")
+        if ALGORITHM_LENGTHS.get(algorithm, len(digest)) != len(digest):
+            return None
+    else:
+        match = UNTAGGED_LINE.match(line)
+        if not match:
+            return None
+        escaped, digest, name = match.groups()
+        algorithm = DIGEST_LENGTHS.get(len(digest))
+        if algorithm is None:
+            return None
+    if escaped:
+        name = unescape_manifest_name(name)
+    return algorithm, digest.decode("ascii").lower(), name
+
+def open_manifest(manifest_path):
+
+    """
+    :param manifest_path: The path of a manifest, or "-" for standard input
+    :return: A binary file object to read the manifest from
+    """
+
+    if manifest_path == "-":
+        return os.fdopen(os.dup(sys.stdin.fileno()), "rb")
+    return open(manifest_path, "rb")
+
+def start_import_process(absolute_path, manifest_paths, message_destination=print, replace=False, cancel_token=None):
+
+    """
+    Add the digests listed in coreutils manifests to the checksum store without reading any files.
+    Manifests are streamed line by line, so their size does not affect memory use. Paths in the
+    manifests are taken as relative to the base directory. Absolute paths inside the base directory
+    are accepted, while paths outside it and algorithms the store does not hold are skipped.
+    Existing checksums are kept unless replace is True, and any that disagree with a manifest are reported.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param manifest_paths: The manifests to import, with "-" for standard input
+    :param message_destination: The function to call to output the message
+    :param replace: Whether a manifest digest replaces a different stored checksum
+    :param cancel_token: An optional CancellationToken that stops the import between lines
+    :return: The number of checksums written, or None if the import failed
+    """
+
+    try:
+        start_date = datetime.now()
+        checksums_written = 0
+        checksums_present = 0
+        conflicts = 0
+        lines_skipped = 0
+        unsupported = {}
+        cancelled = False
+        last_directory = None
+        try:
+            for manifest_path in manifest_paths:
+                bmc.output_message("Importing " + ("standard input" if manifest_path == "-" else manifest_path) + "...", message_destination)
+                with open_manifest(manifest_path) as manifest_file:
+                    for line_number, line in enumerate(manifest_file, 1):
+                        if line_number % 1000 == 0:
+                            bmc.check_cancelled(cancel_token)
+                        line = line.rstrip(b"\r\n")
+                        if not line:
+                            continue
+                        entry = parse_manifest_line(line)
+                        if entry is None:
+                            bmc.output_message("* Unrecognised line " + str(line_number) + " in " + manifest_path, message_destination)
+                            lines_skipped += 1
+                            continue
+                        algorithm, digest, name = entry
+                        if algorithm not in STORE_LAYOUT:
+                            unsupported[algorithm] = unsupported.get(algorithm, 0) + 1
+                            continue
+                        file_path = os.path.normpath(os.path.join(absolute_path, os.fsdecode(name)))
+                        relative_path = os.path.relpath(file_path, absolute_path)
+                        if relative_path.split(os.sep)[0] in (os.pardir, "bm11-md5sums", "bm11-sha1sums"):
+                            bmc.output_message("* Skipped path outside the base directory: " + os.fsdecode(name), message_destination)
+                            lines_skipped += 1
+                            continue
+                        # A checksum can only belong to a file, and "." would be written beside the checksum folder itself
+                        if relative_path == os.curdir or name.endswith(b"/") or os.path.isdir(file_path):
+                            bmc.output_message("* Skipped path that is not a file: " + os.fsdecode(name), message_destination)
+                            lines_skipped += 1
+                            continue
+                        folder, extension = STORE_LAYOUT[algorithm]
+                        checksum_path = os.path.join(absolute_path, folder, relative_path + extension)
+                        if os.path.exists(checksum_path):
+                            with open(checksum_path, "r") as checksum_file:
+                                stored_checksum = checksum_file.read().rstrip()
+                            if stored_checksum == digest:
+                                checksums_present += 1
+                                continue
+                            conflicts += 1
+                            bmc.output_message("* Manifest " + TAG_NAMES[algorithm] + " digest differs from the stored checksum for file: " + relative_path, message_destination)
+                            if not replace:
+                                continue
+                        # Only the directory of the previous line is remembered, which keeps memory use constant
+                        # while still saving a check for every file of a directory listed together
+                        checksum_directory = os.path.dirname(checksum_path)
+                        if checksum_directory != last_directory:
+                            os.makedirs(checksum_directory, exist_ok=True)
+                            last_directory = checksum_directory
+                        bmc.write_checksum_file(checksum_path, digest)
+                        checksums_written += 1
+        except bmc.OperationCancelled:
+            cancelled = True
+        time_elapsed = datetime.now() - start_date
+        bmc.output_message("\nImport " + ("cancelled" if cancelled else "complete") + ". " + str(checksums_written) + " checksum(s) written. Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        bmc.output_message("Already stored: " + str(checksums_present), message_destination)
+        bmc.output_message("Differing from the store: " + str(conflicts) + (" (replaced)" if replace else " (kept)"), message_destination)
+        bmc.output_message("Lines skipped: " + str(lines_skipped), message_destination)
+        for algorithm, count in sorted(unsupported.items()):
+            bmc.output_message("Not stored, " + algorithm + " is not an algorithm the checksum store holds: " + str(count), message_destination)
+        bmc.output_message("", message_destination)
+        return checksums_written
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
+
+def start_export_process(absolute_path, manifest_path, algorithm="md5", message_destination=print, tag_format=False, cancel_token=None):
+
+    """
+    Write the checksums of one algorithm from the checksum store as a manifest that md5sum -c or
+    sha1sum -c can check from the base directory. The store is walked one directory at a time and
+    each line is written as it is read, so memory use does not grow with the size of the store.
+    :param absolute_path: The absolute base path holding the checksum folders
+    :param manifest_path: The manifest to write
+    :param algorithm: "md5" or "sha1"
+    :param message_destination: The function to call to output the message
+    :param tag_format: Whether to write the BSD tag format instead of the default format
+    :param cancel_token: An optional CancellationToken that stops the export between directories
+    :return: The number of checksums exported, or None if the export failed
+    """
+
+    try:
+        folder, extension = STORE_LAYOUT[algorithm]
+        store_path = os.path.join(absolute_path, folder)
+        if not os.path.isdir(store_path):
+            bmc.output_message("No " + TAG_NAMES[algorithm] + " checksums could be found. Aborting...\n", message_destination)
+            return None
+        start_date = datetime.now()
+        checksums_exported = 0
+        cancelled = False
+        with open(manifest_path, "wb") as manifest_file:
+            try:
+                for root, dirs, files in os.walk(store_path):
+                    bmc.check_cancelled(cancel_token)
+                    # Sorting each directory gives the same manifest for the same store on every run
+                    dirs.sort()
+                    for file in sorted(files):
+                        if not file.endswith(extension):
+                            continue
+                        relative_path = os.path.relpath(os.path.join(root, file), store_path)[:-len(extension)]
+                        with open(os.path.join(root, file), "r") as checksum_file:
+                            checksum = checksum_file.read().rstrip()
+                        name, escaped = escape_manifest_name(os.fsencode(relative_path.replace(os.sep, "/")))
+                        prefix = b"\\" if escaped else b""
+                        if tag_format:
+                            manifest_file.write(prefix + TAG_NAMES[algorithm].encode("ascii") + b" (" + name + b") = " + checksum.encode("ascii") + b"\n")
+                        else:
+                            manifest_file.write(prefix + checksum.encode("ascii") + b"  " + name + b"\n")
+                        checksums_exported += 1
+            except bmc.OperationCancelled:
+                cancelled = True
+        time_elapsed = datetime.now() - start_date
+        bmc.output_message("Export " + ("cancelled" if cancelled else "complete") + ". " + str(checksums_exported) + " " + TAG_NAMES[algorithm] + " checksum(s) written to " + manifest_path + ". Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        return checksums_exported
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
@@ -0,0 +1,216 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import os
+import re
+import threading
+import time
+
+# How often, in seconds, the metrics file is rewritten while an operation is running
+METRICS_WRITE_INTERVAL = 60
+
+# The help text of each metric, in the order they are written
+METRIC_HELP = (
+    ("bmchecksum_running", "1 while the operation is running, 0 once it has finished"),
+    ("bmchecksum_cancelled", "1 if the operation was cancelled"),
+    ("bmchecksum_start_timestamp_seconds", "Unix time the operation started"),
+    ("bmchecksum_last_update_timestamp_seconds", "Unix time this file was written"),
+    ("bmchecksum_completion_timestamp_seconds", "Unix time the operation finished, 0 while it is running"),
+    ("bmchecksum_duration_seconds", "Seconds the operation has been running"),
+    ("bmchecksum_files", "Files processed"),
+    ("bmchecksum_bytes_read", "Bytes read from files"),
+    ("bmchecksum_read_bytes_per_second", "Bytes read per second spent in read calls"),
+    ("bmchecksum_errors", "Problems found, by category"),
+    ("bmchecksum_phase_seconds", "Seconds spent in each phase of the operation"),
+    ("bmchecksum_phase_calls", "Number of times each phase of the operation ran"),
+)
+
+def escape_label_value(value):
+
+    """
+    :param value: A label value
+    :return: The value escaped for the Prometheus text format
+    """
+
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def default_metrics_name(base_directory, operation):
+
+    """
+    :param base_directory: The absolute base path of the operation
+    :param operation: The name of the operation
+    :return: A file name for the metrics when --metrics names a directory, unique to the base directory and operation
+    """
+
+    return "bmchecksum_" + operation.replace("-", "_") + re.sub(r"[^A-Za-z0-9]+", "_", base_directory).rstrip("_") + ".prom"
+
+class MetricsWriter:
+
+    """
+    A monitor, used like OperationProfiler, that keeps running totals of an operation and writes
+    them as a Prometheus text exposition file for the node exporter's textfile collector. The file
+    is replaced atomically, at most every METRICS_WRITE_INTERVAL seconds while the operation runs
+    and once more when it finishes, so a scrape never sees a partly written file. A write that
+    fails is reported and otherwise ignored, so the metrics can never stop the operation itself.
+    """
+
+    def __init__(self, metrics_path, base_directory, operation, write_interval=METRICS_WRITE_INTERVAL, message_destination=print):
+
+        """
+        Create the writer and write the first file, showing the operation as running.
+        :param metrics_path: The .prom file to write, or a directory to write it in
+        :param base_directory: The absolute base path of the operation, used as a label
+        :param operation: The name of the operation, such as "verify", used as a label
+        :param write_interval: The seconds between writes while the operation runs
+        :param message_destination: The function to call to report a failed write
+        """
+
+        if os.path.isdir(metrics_path):
+            metrics_path = os.path.join(metrics_path, default_metrics_name(base_directory, operation))
+        self.metrics_path = metrics_path
+        self.labels = "base_directory=\"" + escape_label_value(base_directory) + "\",operation=\"" + escape_label_value(operation) + "\""
+        self.write_interval = write_interval
+        self.start_time = time.time()
+        self.last_write = time.monotonic()
+        self.phase_times = {}
+        self.phase_counts = {}
+        self.problem_counts = dict.fromkeys(bmc.PROBLEM_CATEGORIES, 0)
+        self.bytes_read = 0
+        self.files_processed = 0
+        self.lock = threading.Lock()
+        self.message_destination = message_destination
+        # Whether the latest write failed, so a failure is only reported once until a write succeeds again
+        self.failed = False
+        self.write(running=True)
+
+    def record_phase(self, phase, start_time, end_time, file_path=None):
+
+        """
+        Add the time spent in one phase of the operation.
+        The parameters are as described in OperationProfiler.record_phase.
+        """
+
+        with self.lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + (end_time - start_time)
+            self.phase_counts[phase] = self.phase_counts.get(phase, 0) + 1
+
+    def record_read(self, seconds, byte_count):
+
+        """
+        Add the bytes of a read call.
+        The parameters are as described in OperationProfiler.record_read.
+        """
+
+        with self.lock:
+            self.bytes_read += byte_count
+
+    def record_file(self, file_path, start_time, end_time):
+
+        """
+        Count a finished file, and rewrite the metrics file if the write interval has passed.
+        The parameters are as described in OperationProfiler.record_file.
+        """
+
+        with self.lock:
+            self.files_processed += 1
+            write_due = time.monotonic() - self.last_write >= self.write_interval
+            if write_due:
+                self.last_write = time.monotonic()
+        if write_due:
+            self.write(running=True)
+
+    def record_directory(self, directory_path, start_time, end_time):
+
+        """
+        Accept the span covering a whole subdirectory verification, whose files are already counted.
+        """
+
+        pass
+
+    def record_problem(self, category, file_path=None):
+
+        """
+        Count a problem found by the operation.
+        The parameters are as described in OperationProfiler.record_problem.
+        """
+
+        with self.lock:
+            self.problem_counts[category] = self.problem_counts.get(category, 0) + 1
+
+    def metric_lines(self, running, cancelled):
+
+        """
+        :param running: Whether the operation is still running
+        :param cancelled: Whether the operation was cancelled
+        :return: The lines of the metrics file
+        """
+
+        now = time.time()
+        with self.lock:
+            read_time = self.phase_times.get("read", 0.0)
+            samples = {
+                "bmchecksum_running": [("", 1 if running else 0)],
+                "bmchecksum_cancelled": [("", 1 if cancelled else 0)],
+                "bmchecksum_start_timestamp_seconds": [("", round(self.start_time, 3))],
+                "bmchecksum_last_update_timestamp_seconds": [("", round(now, 3))],
+                "bmchecksum_completion_timestamp_seconds": [("", 0 if running else round(now, 3))],
+                "bmchecksum_duration_seconds": [("", round(now - self.start_time, 3))],
+                "bmchecksum_files": [("", self.files_processed)],
+                "bmchecksum_bytes_read": [("", self.bytes_read)],
+                "bmchecksum_read_bytes_per_second": [("", round(self.bytes_read / read_time, 3) if read_time > 0 else 0)],
+                "bmchecksum_errors": [(",category=\"" + category + "\"", count) for category, count in sorted(self.problem_counts.items())],
+                "bmchecksum_phase_seconds": [(",phase=\"" + phase + "\"", round(seconds, 6)) for phase, seconds in sorted(self.phase_times.items())],
+                "bmchecksum_phase_calls": [(",phase=\"" + phase + "\"", count) for phase, count in sorted(self.phase_counts.items())],
+            }
+        lines = []
+        for name, help_text in METRIC_HELP:
+            if not samples[name]:
+                continue
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " gauge")
+            for extra_labels, value in samples[name]:
+                lines.append(name + "{" + self.labels + extra_labels + "} " + str(value))
+        return lines
+
+    def write(self, running=False, cancelled=False):
+
+        """
+        Replace the metrics file with the current totals. The file is written under a temporary
+        name without the .prom extension, which the textfile collector ignores, and renamed into place.
+        :param running: Whether the operation is still running
+        :param cancelled: Whether the operation was cancelled
+        :return: True if the file was written
+        """
+
+        temporary_path = self.metrics_path + ".bmtmp"
+        try:
+            with open(temporary_path, "w") as metrics_file:
+                metrics_file.write("\n".join(self.metric_lines(running, cancelled)) + "\n")
+            os.replace(temporary_path, self.metrics_path)
+        except OSError as error:
+            if not self.failed:
+                bmc.output_message("* Could not write the metrics file " + self.metrics_path + " (" + (error.strerror or str(error)) + ")", self.message_destination)
+            self.failed = True
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+            return False
+        self.failed = False
+        return True
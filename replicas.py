@@ -0,0 +1,184 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+# The number of hashed files each side may get ahead of the comparison before it waits
+COMPARE_QUEUE_DEPTH = 64
+
+def hash_replica_side(base_path, relative_paths, algorithms, result_queue, stop_token, cache_mode, side_times, side_name):
+
+    """
+    Hash the given files under one of the two trees, in order, and queue the results for comparison.
+    Runs on its own thread so the two trees are read at the same time.
+    :param base_path: The absolute base path of the tree
+    :param relative_paths: The files to hash, relative to the base path
+    :param algorithms: The algorithms to calculate
+    :param result_queue: The queue receiving a dictionary of checksums, or the OSError, for each file
+    :param stop_token: The CancellationToken set once the comparison stops for any reason, which stops the thread
+    :param cache_mode: How files are read with respect to the page cache, as described in core.read_file_chunks
+    :param side_times: A dictionary the total hashing time of this side is stored in
+    :param side_name: The key used in side_times
+    """
+
+    side_start = time.perf_counter()
+    try:
+        for relative_path in relative_paths:
+            try:
+                result = dict(zip(algorithms, bmc.calculate_checksums_with_retry(os.path.join(base_path, relative_path), algorithms, cancel_token=stop_token, cache_mode=cache_mode, message_destination=lambda message: None)))
+            except OSError as error:
+                result = error
+            while True:
+                bmc.check_cancelled(stop_token)
+                try:
+                    result_queue.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+    except bmc.OperationCancelled:
+        pass
+    side_times[side_name] = time.perf_counter() - side_start
+
+def start_compare_process(source_path, replica_path, message_destination=print, check_stored=False, progress_destination=None, cancel_token=None, cache_mode="normal"):
+
+    """
+    Compare a replica of a tree with its source by hashing the files present in both at the same
+    time, one thread per tree, so that when the trees are on different devices the comparison takes
+    about as long as the slower device rather than both devices one after the other.
+    Files that differ, that are missing from the replica or that only exist in the replica are reported.
+    The bm11 checksum folders of both trees are left out of the comparison.
+    :param source_path: The absolute base path of the source tree
+    :param replica_path: The absolute base path of the replica tree
+    :param message_destination: The function to call to output the message
+    :param check_stored: Whether to also check each file against the stored checksums of its own tree
+    :param progress_destination: An optional function called with the files compared and the total after each file
+    :param cancel_token: An optional CancellationToken that stops the comparison between read chunks
+    :param cache_mode: How files are read with respect to the page cache, as described in core.read_file_chunks
+    :return: The number of problems found, or None if the comparison failed
+    """
+
+    try:
+        start_date = datetime.now()
+        bmc.output_message("Comparing " + replica_path + " with " + source_path + "...\n", message_destination)
+        source_index = bmc.create_file_list(source_path)
+        replica_index = bmc.create_file_list(replica_path)
+        replica_paths = set(replica_index.relative_path(position) for position in range(len(replica_index)))
+        common_paths = []
+        missing_files = 0
+        for position in range(len(source_index)):
+            relative_path = source_index.relative_path(position)
+            if relative_path in replica_paths:
+                common_paths.append(relative_path)
+                replica_paths.discard(relative_path)
+            else:
+                bmc.output_message("* Missing from the replica: " + relative_path, message_destination)
+                missing_files += 1
+        # Whatever is left was not found in the source
+        extra_files = len(replica_paths)
+        for relative_path in sorted(replica_paths):
+            bmc.output_message("* Only in the replica: " + relative_path, message_destination)
+        del replica_paths
+
+        algorithms = ["md5"]
+        if check_stored:
+            algorithms = [algorithm for algorithm, folder in (("md5", "bm11-md5sums"), ("sha1", "bm11-sha1sums"))
+                if os.path.isdir(os.path.join(source_path, folder)) or os.path.isdir(os.path.join(replica_path, folder))] or ["md5"]
+
+        source_queue = queue.Queue(maxsize=COMPARE_QUEUE_DEPTH)
+        replica_queue = queue.Queue(maxsize=COMPARE_QUEUE_DEPTH)
+        side_times = {}
+        # Set however the comparison ends, including on an unexpected error, so the side threads never wait on a full queue
+        # forever. A cancellation through cancel_token reaches them this way too, as the comparison checks it while waiting.
+        side_stop = bmc.CancellationToken()
+        side_threads = [
+            threading.Thread(target=hash_replica_side, args=(source_path, common_paths, algorithms, source_queue, side_stop, cache_mode, side_times, "source"), name="compare-source", daemon=True),
+            threading.Thread(target=hash_replica_side, args=(replica_path, common_paths, algorithms, replica_queue, side_stop, cache_mode, side_times, "replica"), name="compare-replica", daemon=True),
+        ]
+        for side_thread in side_threads:
+            side_thread.start()
+
+        files_compared = 0
+        differing_files = 0
+        stored_problems = 0
+        read_errors = 0
+        cancelled = False
+        try:
+            for relative_path in common_paths:
+                source_result = None
+                replica_result = None
+                while source_result is None or replica_result is None:
+                    bmc.check_cancelled(cancel_token)
+                    try:
+                        if source_result is None:
+                            source_result = source_queue.get(timeout=0.1)
+                        if replica_result is None:
+                            replica_result = replica_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                files_compared += 1
+                if isinstance(source_result, OSError) or isinstance(replica_result, OSError):
+                    for side_name, result in (("source", source_result), ("replica", replica_result)):
+                        if isinstance(result, OSError):
+                            bmc.output_message("* Could not read the " + side_name + " file: " + relative_path + " (" + (result.strerror or str(result)) + ")", message_destination)
+                            read_errors += 1
+                elif source_result != replica_result:
+                    bmc.output_message("* Replica differs from the source: " + relative_path, message_destination)
+                    differing_files += 1
+                if check_stored:
+                    for side_name, side_path, result in (("source", source_path, source_result), ("replica", replica_path, replica_result)):
+                        if isinstance(result, OSError):
+                            continue
+                        # Only check the algorithms whose checksum folder exists on this side
+                        side_checksums = {algorithm: checksum for algorithm, checksum in result.items()
+                            if os.path.isdir(os.path.join(side_path, "bm11-md5sums" if algorithm == "md5" else "bm11-sha1sums"))}
+                        for category, algorithm, problem in bmc.check_file_against_store(side_path, relative_path, side_checksums):
+                            bmc.output_message(problem + " (" + side_name + ")", message_destination)
+                            stored_problems += 1
+                if progress_destination is not None:
+                    progress_destination(files_compared, len(common_paths))
+        except bmc.OperationCancelled:
+            cancelled = True
+        finally:
+            side_stop.cancel()
+            for side_thread in side_threads:
+                side_thread.join()
+
+        time_elapsed = datetime.now() - start_date
+        problems_found = missing_files + extra_files + differing_files + stored_problems + read_errors
+        if problems_found > 0:
+            bmc.output_message("", message_destination)
+        bmc.output_message("Comparison " + ("cancelled" if cancelled else "complete") + ". Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        bmc.output_message("Files compared: " + str(files_compared) + " of " + str(len(common_paths)), message_destination)
+        bmc.output_message("Files that differ: " + str(differing_files), message_destination)
+        bmc.output_message("Missing from the replica: " + str(missing_files), message_destination)
+        bmc.output_message("Only in the replica: " + str(extra_files), message_destination)
+        if check_stored:
+            bmc.output_message("Stored checksum problems: " + str(stored_problems), message_destination)
+        if read_errors > 0:
+            bmc.output_message("Files that could not be read: " + str(read_errors), message_destination)
+        if "source" in side_times and "replica" in side_times:
+            bmc.output_message("Hashing time: " + format(side_times["source"], ".1f") + " seconds for the source and " + format(side_times["replica"], ".1f") + " seconds for the replica, read at the same time", message_destination)
+        bmc.output_message("Problems found: " + str(problems_found) + "\n", message_destination)
+        return problems_found
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
@@ -0,0 +1,206 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+# How often, in seconds, the scrub state is saved while a scrub is running, so a crash loses little progress
+STATE_SAVE_INTERVAL = 60
+
+# Multipliers for the suffixes accepted by parse_duration and parse_byte_count
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+BYTE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+def parse_duration(duration_text):
+
+    """
+    Read a duration such as 90, 45m, 2h or 1d. A number without a suffix is in seconds.
+    :param duration_text: The duration as typed by the user
+    :return: The duration in seconds
+    """
+
+    duration_text = duration_text.strip().lower()
+    if duration_text[-1:] in DURATION_UNITS:
+        return float(duration_text[:-1]) * DURATION_UNITS[duration_text[-1]]
+    return float(duration_text)
+
+def parse_byte_count(byte_text):
+
+    """
+    Read a size such as 4096, 500M, 500G or 2T, using binary multiples.
+    :param byte_text: The size as typed by the user
+    :return: The size in bytes
+    """
+
+    byte_text = byte_text.strip().upper().rstrip("B")
+    if byte_text[-1:] in BYTE_UNITS:
+        return int(float(byte_text[:-1]) * BYTE_UNITS[byte_text[-1]])
+    return int(byte_text)
+
+def load_scrub_state(state_path):
+
+    """
+    Read the time each file was last scrubbed.
+    :param state_path: The path of the scrub state file
+    :return: A dictionary mapping relative file paths to the Unix time they were last verified
+    """
+
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as state_file:
+        state_data = json.load(state_file)
+    if state_data.get("format") != "bmchecksum-scrub-state":
+        raise ValueError(state_path + " is not a BMChecksum scrub state file")
+    return state_data["verified"]
+
+def save_scrub_state(state_path, last_verified):
+
+    """
+    Write the scrub state atomically, so an interrupted save keeps the previous state.
+    :param state_path: The path of the scrub state file
+    :param last_verified: A dictionary mapping relative file paths to the Unix time they were last verified
+    """
+
+    temporary_path = state_path + ".bmtmp"
+    with open(temporary_path, "w") as state_file:
+        json.dump({"format": "bmchecksum-scrub-state", "version": 1, "verified": last_verified}, state_file, separators=(",", ":"))
+    os.replace(temporary_path, state_path)
+
+def start_scrub_process(absolute_path, message_destination=print, time_budget=None, byte_budget=None, state_path=None, profiler=None, tracer=None, progress_destination=None, cancel_token=None, cache_mode="scrub"):
+
+    """
+    Verify part of the base directory, picking the files that have gone longest without being
+    verified, until a time or byte budget is used up. The time each file was verified is kept in
+    a state file, so running this regularly from cron spreads a full verification of the tree
+    evenly over time instead of reading everything at once. Files never verified come first.
+    :param absolute_path: The absolute base path to scrub
+    :param message_destination: The function to call to output the message
+    :param time_budget: The number of seconds to spend verifying, or None for no time limit
+    :param byte_budget: The number of bytes to read, or None for no size limit
+    :param state_path: The path of the state file, by default SCRUB_STATE_NAME in the base directory
+    :param profiler: An optional OperationProfiler to record phase timings in
+    :param tracer: An optional TraceWriter to record per-file spans in
+    :param progress_destination: An optional function called with the files done and the files selected after each file
+    :param cancel_token: An optional CancellationToken that stops the scrub between files and read chunks
+    :param cache_mode: How files are read with respect to the page cache, as described in core.read_file_chunks
+    :return: The number of errors found, or None if there was nothing to verify or the scrub failed
+    """
+
+    monitor = bmc.combine_monitors(profiler, tracer)
+
+    try:
+        algorithms = []
+        if os.path.exists(os.path.join(absolute_path, "bm11-md5sums")):
+            algorithms.append("md5")
+        if os.path.exists(os.path.join(absolute_path, "bm11-sha1sums")):
+            algorithms.append("sha1")
+        if len(algorithms) == 0:
+            bmc.output_message("No verification data could be found. Aborting...\n", message_destination)
+            return None
+        if state_path is None:
+            state_path = os.path.join(absolute_path, bmc.SCRUB_STATE_NAME)
+        start_date = datetime.now()
+        scrub_start = time.monotonic()
+        stored_state = load_scrub_state(state_path)
+        file_paths = bmc.create_file_list(absolute_path, monitor, with_sizes=True)
+        relative_paths = [file_paths.relative_path(position) for position in range(len(file_paths))]
+        # Forget files that no longer exist so the state does not grow forever
+        last_verified = {relative_path: stored_state[relative_path] for relative_path in relative_paths if relative_path in stored_state}
+        # Oldest first, with files never verified before all others
+        scrub_order = sorted(range(len(file_paths)), key=lambda index: (last_verified.get(relative_paths[index], 0), relative_paths[index]))
+        budget_text = []
+        if time_budget is not None:
+            budget_text.append(bmc.return_human_readable_time_elapsed(timedelta(seconds=time_budget)).rstrip("."))
+        if byte_budget is not None:
+            budget_text.append(format(byte_budget / 1048576, ".0f") + " MB")
+        bmc.output_message("Scrubbing the least recently verified files" + (" for up to " + " or ".join(budget_text) if budget_text else "") + "...\n", message_destination)
+
+        files_verified = 0
+        bytes_verified = 0
+        errors_found = 0
+        cancelled = False
+        last_save = time.monotonic()
+        try:
+            for index in scrub_order:
+                if time_budget is not None and time.monotonic() - scrub_start >= time_budget:
+                    break
+                if byte_budget is not None and bytes_verified >= byte_budget:
+                    break
+                bmc.check_cancelled(cancel_token)
+                file_path = file_paths[index]
+                relative_path = relative_paths[index]
+                if monitor is not None:
+                    file_start = time.perf_counter()
+                try:
+                    file_size = file_paths.size(index)
+                    file_checksums = dict(zip(algorithms, bmc.calculate_checksums_with_retry(file_path, algorithms, monitor, cancel_token, cache_mode=cache_mode, message_destination=message_destination)))
+                except OSError as error:
+                    bmc.output_message("* Could not read file: " + relative_path + " (" + (error.strerror or str(error)) + ")", message_destination)
+                    errors_found += 1
+                    if monitor is not None:
+                        monitor.record_problem("unreadable", file_path)
+                    # Forgetting the time puts the file first in the next scrub, so the problem is reported again
+                    last_verified.pop(relative_path, None)
+                    continue
+                if monitor is not None:
+                    store_start = time.perf_counter()
+                problems = bmc.check_file_against_store(absolute_path, relative_path, file_checksums)
+                for category, algorithm, problem in problems:
+                    bmc.output_message(problem, message_destination)
+                    if monitor is not None:
+                        monitor.record_problem(category, file_path)
+                errors_found += len(problems)
+                files_verified += 1
+                bytes_verified += file_size
+                # Only a clean file goes to the back of the rotation. A failing one is checked first next time
+                if problems:
+                    last_verified.pop(relative_path, None)
+                else:
+                    last_verified[relative_path] = time.time()
+                if monitor is not None:
+                    file_end = time.perf_counter()
+                    monitor.record_phase("store", store_start, file_end, file_path)
+                    monitor.record_file(file_path, file_start, file_end)
+                if progress_destination is not None:
+                    progress_destination(files_verified, len(file_paths))
+                if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+                    save_scrub_state(state_path, last_verified)
+                    last_save = time.monotonic()
+        except bmc.OperationCancelled:
+            cancelled = True
+        save_scrub_state(state_path, last_verified)
+
+        never_verified = sum(1 for relative_path in relative_paths if relative_path not in last_verified)
+        time_elapsed = datetime.now() - start_date
+        if cancelled:
+            bmc.output_message("\nScrub cancelled. Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        else:
+            bmc.output_message("\nScrub complete. Operation took " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+        bmc.output_message("Files verified: " + str(files_verified) + " of " + str(len(file_paths)), message_destination)
+        bmc.output_message("Data verified: " + format(bytes_verified / 1048576, ".1f") + " MB", message_destination)
+        bmc.output_message("Files never verified: " + str(never_verified), message_destination)
+        if never_verified == 0 and len(last_verified) > 0:
+            oldest_verification = datetime.fromtimestamp(min(last_verified.values()))
+            bmc.output_message("Oldest verification: " + oldest_verification.strftime("%Y-%m-%d %H:%M"), message_destination)
+        bmc.output_message("Errors found: " + str(errors_found) + "\n", message_destination)
+        return errors_found
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)
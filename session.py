@@ -0,0 +1,508 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import collections
+import core as bmc
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List
+
+# The checksum folder, extension and display name of each algorithm
+STORE_LAYOUT = {"md5": ("bm11-md5sums", ".md5", "MD5"), "sha1": ("bm11-sha1sums", ".sha1", "SHA-1")}
+# The number of file digests a session remembers by default
+DEFAULT_CACHE_SIZE = 100000
+# The number of trees whose file lists a session keeps between calls
+TREE_CACHE_SIZE = 64
+
+@dataclass
+class FileResult:
+
+    """
+    The outcome for one file. The status is "ok", "created" or "existing", or one of
+    core.PROBLEM_CATEGORIES. The detail names the algorithm or the error, where there is one.
+    """
+
+    relative_path: str
+    status: str
+    detail: str = ""
+
+@dataclass
+class VerificationSummary:
+
+    """
+    The totals of a verification, matching the statistics printed by core.start_verification_process.
+    Iterating over the summary gives its results. checksums_found is False when the base directory
+    has no checksum folders, in which case nothing was verified.
+    """
+
+    base_directory: str
+    checksums_found: bool = True
+    files_processed: int = 0
+    md5_processed: int = 0
+    sha1_processed: int = 0
+    errors: int = 0
+    read_errors: int = 0
+    files_from_cache: int = 0
+    cancelled: bool = False
+    seconds: float = 0.0
+    results: List[FileResult] = field(default_factory=list)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    @property
+    def ok(self):
+        return self.checksums_found and self.errors == 0 and not self.cancelled
+
+@dataclass
+class ChecksumSummary:
+
+    """
+    The totals of a checksum creation. Iterating over the summary gives its results.
+    """
+
+    base_directory: str
+    files_checksummed: int = 0
+    files_existing: int = 0
+    files_failed: int = 0
+    files_from_cache: int = 0
+    cancelled: bool = False
+    seconds: float = 0.0
+    results: List[FileResult] = field(default_factory=list)
+
+    def __iter__(self):
+        return iter(self.results)
+
+    @property
+    def ok(self):
+        return self.files_failed == 0 and not self.cancelled
+
+@dataclass
+class UpgradeSummary:
+
+    """
+    The totals of an upgrade of version 1.0 checksums, with the messages core.start_upgrade_process output.
+    """
+
+    base_directory: str
+    legacy_found: bool = False
+    files_upgraded: int = 0
+    seconds: float = 0.0
+    messages: List[str] = field(default_factory=list)
+
+class DigestCache:
+
+    """
+    A bounded, thread-safe map from keys to values that forgets the least recently used entries first.
+    """
+
+    def __init__(self, capacity):
+
+        """
+        :param capacity: The number of entries to keep, or 0 to keep none
+        """
+
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+
+        """
+        :param key: The key to look up
+        :return: The value, or None if it is not in the cache
+        """
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+
+        """
+        :param key: The key to store the value under
+        :param value: The value, which must not be None
+        """
+
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+
+        """
+        Forget every entry.
+        """
+
+        with self.lock:
+            self.entries.clear()
+
+def tree_unchanged(absolute_path, directory_state):
+
+    """
+    Check whether any directory of a tree has gained, lost or renamed an entry since a walk, with
+    one stat call per directory and no listings.
+    :param absolute_path: The absolute base path of the tree
+    :param directory_state: The DirectoryState recorded by the walk
+    :return: True if the file list of the walk is still complete
+    """
+
+    pending_directories = [""]
+    while pending_directories:
+        relative_directory = pending_directories.pop()
+        try:
+            directory_stat = os.stat(os.path.join(absolute_path, relative_directory) if relative_directory else absolute_path)
+        except OSError:
+            return False
+        subdirectories = directory_state.unchanged_subdirectories(relative_directory, directory_stat)
+        if subdirectories is None:
+            return False
+        pending_directories.extend(os.path.join(relative_directory, name) if relative_directory else name for name in subdirectories)
+    return True
+
+def stat_key(file_stat):
+
+    """
+    :param file_stat: The result of os.stat on a file
+    :return: A key that changes whenever the file is replaced or written to
+    """
+
+    return (file_stat.st_dev, file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ctime_ns)
+
+class ChecksumSession:
+
+    """
+    A long-lived handle for using BMChecksum from other Python programs. Results are returned as
+    dataclasses instead of being printed, and every call shares one pool of hashing threads and
+    one cache of file digests keyed by their device, inode, size and change times. The file list
+    of each tree is kept too, with the mtime of every directory, and is reused as long as no
+    directory has changed, so a tree that has not gained or lost files is not walked again.
+    Verification always reads every file by default, since a checksum verifier exists to find data
+    that has decayed on the disk without its metadata changing. Passing trust_cache=True instead
+    reuses the digest of any file that has not been written to since the session last read it.
+    That is a quick check for changes made through the file system, not a verification of the data.
+    Creating checksums always uses the cache, as a digest the session read is as good as a new one.
+    The session can be used as a context manager, which closes it at the end.
+    """
+
+    def __init__(self, workers=None, cache_size=DEFAULT_CACHE_SIZE, cache_mode="normal"):
+
+        """
+        Start the session and its hashing threads.
+        :param workers: The number of files hashed at once, by default up to four depending on the processors available
+        :param cache_size: The number of file digests to remember, or 0 to turn the cache off
+        :param cache_mode: How files are read with respect to the page cache, as described in core.read_file_chunks
+        """
+
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.cache_mode = cache_mode
+        self.digests = DigestCache(cache_size)
+        # Maps absolute base paths to the FileIndex and DirectoryState of their last walk
+        self.trees = DigestCache(TREE_CACHE_SIZE if cache_size > 0 else 0)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bmchecksum-session")
+        # Enough files in flight to keep every thread busy without queuing the whole tree
+        self.window = self.workers * 4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.close()
+
+    def close(self):
+
+        """
+        Stop the hashing threads and forget the cache.
+        """
+
+        self.executor.shutdown(wait=True)
+        self.digests.clear()
+        self.trees.clear()
+
+    def hash_file(self, file_path, algorithms, trust_cache, cancel_token):
+
+        """
+        Calculate the checksums of a file, or take them from the cache. Runs on the hashing threads.
+        :param file_path: The absolute path of the file
+        :param algorithms: The algorithms wanted
+        :param trust_cache: Whether to reuse cached digests instead of reading the file
+        :param cancel_token: An optional CancellationToken checked between read chunks
+        :return: A (checksums, from cache) tuple, or the OSError if the file could not be read
+        """
+
+        try:
+            file_key = stat_key(os.stat(file_path))
+            cached = self.digests.get(file_key)
+            if trust_cache and cached is not None and all(algorithm in cached for algorithm in algorithms):
+                return {algorithm: cached[algorithm] for algorithm in algorithms}, True
+            checksums = dict(zip(algorithms, bmc.calculate_checksums_with_retry(file_path, algorithms, cancel_token=cancel_token, cache_mode=self.cache_mode, message_destination=lambda message: None)))
+            # Only keep the digests if the file did not change while it was being read
+            if stat_key(os.stat(file_path)) == file_key:
+                self.digests.put(file_key, dict(cached or {}, **checksums))
+            return checksums, False
+        except OSError as error:
+            return error
+
+    def file_list(self, absolute_path):
+
+        """
+        List the files of a tree, reusing the list from the session's last walk of it if no directory has changed since.
+        :param absolute_path: The absolute base path
+        :return: A FileIndex of the files, in walk order
+        """
+
+        cached = self.trees.get(absolute_path)
+        if cached is not None and tree_unchanged(absolute_path, cached[1]):
+            return cached[0]
+        # An empty state lists every directory and records each one
+        directory_state = bmc.DirectoryState()
+        file_paths = bmc.create_file_list(absolute_path, directory_state=directory_state)
+        # Directories changed just before the walk are listed again next time, as DirectoryState does between runs
+        directory_state.previous_walk_started = directory_state.walk_started
+        self.trees.put(absolute_path, (file_paths, directory_state))
+        return file_paths
+
+    def hashed_files(self, file_paths, algorithms_for, trust_cache, cancel_token):
+
+        """
+        Hash files on the session's threads, keeping a bounded number in flight, and yield the results in order.
+        :param file_paths: A FileIndex of the files
+        :param algorithms_for: A function giving the algorithms needed for a relative path, or an empty list to skip the file
+        :param trust_cache: Whether to reuse cached digests instead of reading the files
+        :param cancel_token: An optional CancellationToken
+        :return: A generator of (relative path, algorithms, result of hash_file or None if skipped) tuples
+        """
+
+        pending = collections.deque()
+        try:
+            for position in range(len(file_paths)):
+                bmc.check_cancelled(cancel_token)
+                relative_path = file_paths.relative_path(position)
+                algorithms = algorithms_for(relative_path)
+                future = None
+                if algorithms:
+                    future = self.executor.submit(self.hash_file, os.path.join(file_paths.base_directory, relative_path), algorithms, trust_cache, cancel_token)
+                pending.append((relative_path, algorithms, future))
+                while len(pending) >= self.window or (pending and pending[0][2] is None):
+                    relative_path, algorithms, future = pending.popleft()
+                    yield relative_path, algorithms, None if future is None else future.result()
+            while pending:
+                relative_path, algorithms, future = pending.popleft()
+                yield relative_path, algorithms, None if future is None else future.result()
+        finally:
+            # Files not yet started are dropped if the caller stopped early or was cancelled
+            for relative_path, algorithms, future in pending:
+                if future is not None:
+                    future.cancel()
+
+    def check_result(self, summary, absolute_path, relative_path, result, include_ok):
+
+        """
+        Compare the checksums of a file with the stored checksums and add the outcome to a summary.
+        :param summary: The VerificationSummary to add to
+        :param absolute_path: The absolute base path holding the checksum folders
+        :param relative_path: The path of the file relative to the base directory
+        :param result: What hash_file returned for the file
+        :param include_ok: Whether to add a result if the file matches
+        """
+
+        if isinstance(result, OSError):
+            summary.results.append(FileResult(relative_path, "unreadable", result.strerror or str(result)))
+            summary.errors += 1
+            summary.read_errors += 1
+            return
+        checksums, from_cache = result
+        summary.files_processed += 1
+        summary.files_from_cache += from_cache
+        problems = bmc.check_file_against_store(absolute_path, relative_path, checksums)
+        unchecked = set()
+        for category, algorithm, message in problems:
+            # A stored checksum that could not be read is described by its error, the others by the algorithm
+            summary.results.append(FileResult(relative_path, category, message[2:] if category == "store_error" else STORE_LAYOUT[algorithm][2]))
+            summary.errors += 1
+            if category != "mismatch":
+                unchecked.add(algorithm)
+        summary.md5_processed += "md5" in checksums and "md5" not in unchecked
+        summary.sha1_processed += "sha1" in checksums and "sha1" not in unchecked
+        if not problems and include_ok:
+            summary.results.append(FileResult(relative_path, "ok"))
+
+    def verify(self, base_directory, trust_cache=False, include_ok=False, cancel_token=None):
+
+        """
+        Verify the files of a base directory against the stored checksums, as the -v command does,
+        including the search for checksums whose file has gone.
+        :param base_directory: The base directory to verify
+        :param trust_cache: Whether to reuse the digests of files unchanged since the session last read them, rather than reading every file
+        :param include_ok: Whether to add a result for every file that matched, not just the problems
+        :param cancel_token: An optional CancellationToken that stops the verification
+        :return: A VerificationSummary
+        """
+
+        start_time = time.perf_counter()
+        absolute_path = os.path.abspath(base_directory)
+        summary = VerificationSummary(absolute_path)
+        algorithms = [algorithm for algorithm in STORE_LAYOUT if os.path.isdir(os.path.join(absolute_path, STORE_LAYOUT[algorithm][0]))]
+        if len(algorithms) == 0:
+            summary.checksums_found = False
+            return summary
+
+        file_paths = self.file_list(absolute_path)
+        try:
+            for relative_path, file_algorithms, result in self.hashed_files(file_paths, lambda relative_path: algorithms, trust_cache, cancel_token):
+                self.check_result(summary, absolute_path, relative_path, result, include_ok)
+            for algorithm in algorithms:
+                folder, extension, name = STORE_LAYOUT[algorithm]
+                # The checksum folder's listing is kept like the tree's, so it is only listed again once it changes
+                for relative_path in bmc.find_orphan_checksums(absolute_path, folder, extension, checksum_files=self.file_list(os.path.join(absolute_path, folder))):
+                    summary.results.append(FileResult(relative_path, "orphan_checksum", name))
+                    summary.errors += 1
+        except bmc.OperationCancelled:
+            summary.cancelled = True
+        summary.seconds = time.perf_counter() - start_time
+        return summary
+
+    def verify_file(self, base_directory, file_path, trust_cache=False, cancel_token=None):
+
+        """
+        Verify a single file against its stored checksums.
+        :param base_directory: The base directory holding the checksum folders
+        :param file_path: The file, either absolute or relative to the base directory
+        :param trust_cache: Whether to reuse the digest of the file if it is unchanged since the session last read it
+        :param cancel_token: An optional CancellationToken that stops the verification
+        :return: A VerificationSummary covering the one file
+        """
+
+        start_time = time.perf_counter()
+        absolute_path = os.path.abspath(base_directory)
+        summary = VerificationSummary(absolute_path)
+        algorithms = [algorithm for algorithm in STORE_LAYOUT if os.path.isdir(os.path.join(absolute_path, STORE_LAYOUT[algorithm][0]))]
+        if len(algorithms) == 0:
+            summary.checksums_found = False
+            return summary
+        relative_path = os.path.relpath(os.path.join(absolute_path, file_path), absolute_path)
+        if relative_path.split(os.sep)[0] in (os.pardir, "bm11-md5sums", "bm11-sha1sums"):
+            raise ValueError(file_path + " is not a file in " + absolute_path)
+        # A single file list keeps one code path for checking the results
+        file_paths = bmc.FileIndex(absolute_path)
+        file_paths.add_file(file_paths.add_directory(os.path.dirname(relative_path)), os.path.basename(relative_path))
+        try:
+            for relative_path, file_algorithms, result in self.hashed_files(file_paths, lambda relative_path: algorithms, trust_cache, cancel_token):
+                self.check_result(summary, absolute_path, relative_path, result, True)
+        except bmc.OperationCancelled:
+            summary.cancelled = True
+        summary.seconds = time.perf_counter() - start_time
+        return summary
+
+    def verify_subdirectories(self, base_directory, trust_cache=False, include_ok=False, cancel_token=None):
+
+        """
+        Verify each direct subdirectory of the base directory as a base directory of its own, as the -s command does.
+        :param base_directory: The directory holding the base directories
+        :param trust_cache: Whether to reuse the digests of files unchanged since the session last read them, rather than reading every file
+        :param include_ok: Whether to add a result for every file that matched, not just the problems
+        :param cancel_token: An optional CancellationToken that stops the verification
+        :return: A list of VerificationSummary, one for each subdirectory verified before any cancellation
+        """
+
+        summaries = []
+        for entry in sorted(os.listdir(base_directory)):
+            if bmc.is_cancelled(cancel_token):
+                break
+            directory_path = os.path.join(base_directory, entry)
+            if os.path.isdir(directory_path):
+                summaries.append(self.verify(directory_path, trust_cache, include_ok, cancel_token))
+        return summaries
+
+    def create(self, base_directory, mode=0, include_existing=False, cancel_token=None):
+
+        """
+        Add the missing checksums of a base directory, as the -c, -cm and -cs commands do.
+        Existing checksums are never replaced.
+        :param base_directory: The base directory to checksum
+        :param mode: 0 for both MD5 and SHA-1, 1 for MD5 only and 2 for SHA-1 only
+        :param include_existing: Whether to add a result for every file that already had all its checksums
+        :param cancel_token: An optional CancellationToken that stops the operation
+        :return: A ChecksumSummary
+        """
+
+        start_time = time.perf_counter()
+        absolute_path = os.path.abspath(base_directory)
+        summary = ChecksumSummary(absolute_path)
+        algorithms = [algorithm for algorithm in STORE_LAYOUT if mode == 0 or (mode == 1 and algorithm == "md5") or (mode == 2 and algorithm == "sha1")]
+        for algorithm in algorithms:
+            os.makedirs(os.path.join(absolute_path, STORE_LAYOUT[algorithm][0]), exist_ok=True)
+
+        def missing_algorithms(relative_path):
+            return [algorithm for algorithm in algorithms
+                if not os.path.exists(os.path.join(absolute_path, STORE_LAYOUT[algorithm][0], relative_path + STORE_LAYOUT[algorithm][1]))]
+
+        file_paths = self.file_list(absolute_path)
+        try:
+            for relative_path, file_algorithms, result in self.hashed_files(file_paths, missing_algorithms, True, cancel_token):
+                if result is None:
+                    summary.files_existing += 1
+                    if include_existing:
+                        summary.results.append(FileResult(relative_path, "existing"))
+                    continue
+                if isinstance(result, OSError):
+                    summary.results.append(FileResult(relative_path, "unreadable", result.strerror or str(result)))
+                    summary.files_failed += 1
+                    continue
+                checksums, from_cache = result
+                summary.files_from_cache += from_cache
+                try:
+                    bmc.write_missing_checksums(absolute_path, relative_path, checksums)
+                except OSError as error:
+                    summary.results.append(FileResult(relative_path, "store_error", error.strerror or str(error)))
+                    summary.files_failed += 1
+                    continue
+                summary.files_checksummed += 1
+                summary.results.append(FileResult(relative_path, "created", ", ".join(STORE_LAYOUT[algorithm][2] for algorithm in checksums)))
+        except bmc.OperationCancelled:
+            summary.cancelled = True
+        summary.seconds = time.perf_counter() - start_time
+        return summary
+
+    def upgrade(self, base_directory, cancel_token=None):
+
+        """
+        Upgrade version 1.0 checksums to the current layout, as the -u command does.
+        :param base_directory: The base directory to upgrade
+        :param cancel_token: An optional CancellationToken checked before each checksum folder is upgraded
+        :return: An UpgradeSummary
+        """
+
+        start_time = time.perf_counter()
+        summary = UpgradeSummary(os.path.abspath(base_directory))
+        summary.legacy_found = any(os.path.exists(os.path.join(base_directory, folder)) for folder in ("bm-md5sums", "bm-sha1sums"))
+        # The profiler counts every checksum file renamed
+        profiler = bmc.OperationProfiler()
+        bmc.start_upgrade_process(base_directory, summary.messages.append, profiler=profiler, cancel_token=cancel_token)
+        summary.files_upgraded = profiler.phase_counts.get("rename", 0)
+        summary.seconds = time.perf_counter() - start_time
+        return summary
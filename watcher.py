@@ -0,0 +1,288 @@
+"""
+BMChecksum: A file hashing program to store and later verify the checksums of files
+Copyright (C) 2025 Barrie Millar
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import core as bmc
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from datetime import datetime
+
+# inotify event flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+
+# Rescan interval in seconds used when inotify cannot be used at all
+DEFAULT_RESCAN_INTERVAL = 300
+
+class WatchUnavailable(Exception):
+
+    """
+    Raised when inotify cannot be used on this system, or when it runs out of watches.
+    """
+
+class InotifyWatcher:
+
+    """
+    A thin ctypes wrapper around the Linux inotify interface that watches a whole directory tree.
+    The bm11 checksum folders in the base directory are never watched.
+    """
+
+    def __init__(self, base_directory):
+
+        """
+        Create the inotify instance. No directories are watched until add_tree is called.
+        :param base_directory: The absolute base directory being checksummed
+        """
+
+        if not hasattr(os, "uname") or os.uname().sysname != "Linux":
+            raise WatchUnavailable("inotify is only available on Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise WatchUnavailable("the C library does not provide inotify")
+        self.libc = libc
+        self.file_descriptor = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.file_descriptor < 0:
+            raise WatchUnavailable("inotify_init1 failed: " + os.strerror(ctypes.get_errno()))
+        self.base_directory = base_directory
+        self.excluded_directories = (os.path.join(base_directory, "bm11-md5sums"), os.path.join(base_directory, "bm11-sha1sums"))
+        self.watched_directories = {}
+
+    def is_excluded(self, directory):
+
+        """
+        :param directory: An absolute directory path
+        :return: True if the directory is, or is inside, one of the checksum folders
+        """
+
+        for excluded_directory in self.excluded_directories:
+            if directory == excluded_directory or directory.startswith(excluded_directory + os.sep):
+                return True
+        return False
+
+    def add_tree(self, directory):
+
+        """
+        Watch a directory and every directory below it.
+        :param directory: The absolute path of the directory
+        :return: The files already present in the tree, which were created before the watches existed
+        """
+
+        existing_files = []
+        for root, dirs, files in os.walk(directory):
+            if self.is_excluded(root):
+                dirs[:] = []
+                continue
+            watch_descriptor = self.libc.inotify_add_watch(self.file_descriptor, os.fsencode(root), WATCH_MASK)
+            if watch_descriptor < 0:
+                error_number = ctypes.get_errno()
+                if error_number == errno.ENOSPC:
+                    raise WatchUnavailable("the inotify watch limit was reached (see fs.inotify.max_user_watches)")
+                # The directory vanished or cannot be read, so there is nothing to watch in it
+                continue
+            self.watched_directories[watch_descriptor] = root
+            for file in files:
+                existing_files.append(os.path.join(root, file))
+        return existing_files
+
+    def read_events(self, timeout):
+
+        """
+        Wait for and decode inotify events.
+        :param timeout: The longest time in seconds to wait for events
+        :return: A list of (kind, path) tuples where kind is "file", "directory" or "overflow"
+        """
+
+        readable, _, _ = select.select([self.file_descriptor], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.file_descriptor, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            watch_descriptor, mask, cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + name_length
+            if mask & IN_Q_OVERFLOW:
+                events.append(("overflow", None))
+                continue
+            directory = self.watched_directories.get(watch_descriptor)
+            if mask & IN_IGNORED:
+                self.watched_directories.pop(watch_descriptor, None)
+                continue
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if directory == self.base_directory and os.fsdecode(name).startswith(bmc.STATE_FILE_NAMES):
+                # The scrub and directory states are rewritten by later runs and are never checksummed
+                continue
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not self.is_excluded(path):
+                    events.append(("directory", path))
+            elif mask & (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO):
+                events.append(("file", path))
+        return events
+
+    def close(self):
+
+        """
+        Release the inotify instance and all of its watches.
+        """
+
+        os.close(self.file_descriptor)
+
+def start_watch_process(absolute_path, mode, message_destination=print, settle_time=5, rescan_interval=None, cancel_token=None):
+
+    """
+    Watch the base directory and add checksums for new files as they are written.
+    Files are only hashed once no events have been seen for them for settle_time seconds and
+    their size and modification time have stopped changing, so files still being written are
+    not hashed early. Existing checksums are never replaced, as with start_checksum_process.
+    If inotify is unavailable, runs out of watches or overflows, the whole tree is rescanned
+    for files without checksums instead.
+    :param absolute_path: The absolute base path to watch
+    :param mode: The mode to run the checksumming process, as used by start_checksum_process
+    :param message_destination: The function to call to output the message
+    :param settle_time: The number of quiet seconds before a file is hashed
+    :param rescan_interval: Seconds between full rescans, or None to rescan only when needed
+    :param cancel_token: An optional CancellationToken that stops the watch
+    """
+
+    try:
+        # The watches are added before the catch-up run, so a file is either already there when the
+        # catch-up walk reaches its directory or raises an event, and none can slip between the two
+        watcher = None
+        watch_error = None
+        try:
+            watcher = InotifyWatcher(absolute_path)
+            watcher.add_tree(absolute_path)
+        except WatchUnavailable as error:
+            if watcher is not None:
+                watcher.close()
+                watcher = None
+            if rescan_interval is None:
+                rescan_interval = DEFAULT_RESCAN_INTERVAL
+            watch_error = error
+        bmc.output_message("Adding checksums for files created before the watch started...", message_destination)
+        bmc.start_checksum_process(absolute_path, mode, message_destination, cancel_token=cancel_token)
+        if watcher is not None:
+            bmc.output_message("Watching " + str(len(watcher.watched_directories)) + " directories for new files. Press Ctrl-C to stop.\n", message_destination)
+        else:
+            bmc.output_message("File watching is unavailable (" + str(watch_error) + "). Rescanning every " + str(rescan_interval) + " seconds instead.\n", message_destination)
+
+        # Maps each path waiting to settle to the time of its last event and its last seen size and modification time
+        pending_files = {}
+        files_processed = 0
+        start_date = datetime.now()
+        next_rescan = time.monotonic() + rescan_interval if rescan_interval is not None else None
+        rescan_needed = False
+        while not bmc.is_cancelled(cancel_token):
+            if watcher is not None:
+                for kind, path in watcher.read_events(1.0):
+                    if kind == "file":
+                        pending_files[path] = (time.monotonic(), None)
+                    elif kind == "directory":
+                        # Files may have been written into the directory before its watch was added
+                        try:
+                            for file_path in watcher.add_tree(path):
+                                pending_files[file_path] = (time.monotonic(), None)
+                        except WatchUnavailable as error:
+                            bmc.output_message("Stopped watching new directories (" + str(error) + "). Falling back to rescans.", message_destination)
+                            watcher.close()
+                            watcher = None
+                            if rescan_interval is None:
+                                rescan_interval = DEFAULT_RESCAN_INTERVAL
+                                next_rescan = time.monotonic() + rescan_interval
+                            rescan_needed = True
+                            break
+                    elif kind == "overflow":
+                        bmc.output_message("The file event queue overflowed. Rescanning for files without checksums...", message_destination)
+                        rescan_needed = True
+                        # Directories created while events were dropped have no watch yet. Directories
+                        # already watched keep their watch, as inotify_add_watch returns the same descriptor
+                        try:
+                            watcher.add_tree(absolute_path)
+                        except WatchUnavailable as error:
+                            bmc.output_message("Stopped watching new directories (" + str(error) + "). Falling back to rescans.", message_destination)
+                            watcher.close()
+                            watcher = None
+                            if rescan_interval is None:
+                                rescan_interval = DEFAULT_RESCAN_INTERVAL
+                                next_rescan = time.monotonic() + rescan_interval
+                            break
+            else:
+                time.sleep(1.0)
+
+            now = time.monotonic()
+            for file_path, (last_event, last_state) in list(pending_files.items()):
+                if now - last_event < settle_time:
+                    continue
+                try:
+                    file_stat = os.stat(file_path)
+                except OSError:
+                    # The file was removed or renamed before it settled
+                    del pending_files[file_path]
+                    continue
+                file_state = (file_stat.st_size, file_stat.st_mtime_ns)
+                if file_state != last_state:
+                    # Still changing, so wait another settle period
+                    pending_files[file_path] = (now, file_state)
+                    continue
+                del pending_files[file_path]
+                try:
+                    if bmc.store_file_checksums(absolute_path, file_path, mode, cancel_token):
+                        files_processed += 1
+                        bmc.output_message("Checksummed: " + os.path.relpath(file_path, absolute_path), message_destination)
+                except bmc.OperationCancelled:
+                    break
+                except OSError as error:
+                    bmc.output_message("* Could not checksum file: " + os.path.relpath(file_path, absolute_path) + " (" + str(error) + ")", message_destination)
+
+            if next_rescan is not None and now >= next_rescan:
+                rescan_needed = True
+            if rescan_needed and not bmc.is_cancelled(cancel_token):
+                rescan_needed = False
+                bmc.start_checksum_process(absolute_path, mode, message_destination, cancel_token=cancel_token)
+                if rescan_interval is not None:
+                    next_rescan = time.monotonic() + rescan_interval
+
+        if watcher is not None:
+            watcher.close()
+        time_elapsed = datetime.now() - start_date
+        bmc.output_message("\nWatch stopped. " + str(files_processed) + " new file(s) checksummed while watching for " + bmc.return_human_readable_time_elapsed(time_elapsed) + "\n", message_destination)
+    except Exception as error:
+        bmc.documentUnknownError(error, message_destination)